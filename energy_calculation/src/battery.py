@@ -0,0 +1,223 @@
+import logging, math, sys
+
+import numpy as np
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('battery')
+
+BATTERY_KEYS = ['total_battery_charged', 'total_battery_discharged', 'battery_state_of_charge']
+
+SCAN_BLOCK = 64
+
+
+class Battery:
+    # Storage of the green energy not used by the works. capacity and
+    # state_of_charge are in J, the power limits in W. The green energy left
+    # in a segment charges the battery (losing 1 - charge_efficiency of it)
+    # and the battery discharges against the energy not covered by the green
+    # power (losing 1 - discharge_efficiency of what it releases).
+    #
+    # The state of charge is kept between calls, so consecutive pieces of a
+    # trace (calc_green_energy_usage_chunked) continue the same battery.
+
+    def __init__(self, capacity, max_charge_power=math.inf, max_discharge_power=math.inf, charge_efficiency=1, discharge_efficiency=1, state_of_charge=0):
+        self.capacity = capacity
+        self.max_charge_power = max_charge_power
+        self.max_discharge_power = max_discharge_power
+        self.charge_efficiency = charge_efficiency
+        self.discharge_efficiency = discharge_efficiency
+        self.state_of_charge = state_of_charge
+
+    def __limit(self, energy, time, max_power):
+        return energy if math.isinf(max_power) else np.minimum(energy, max_power * time)
+
+    def charge(self, energy, time):
+        # Green energy taken from energy (J) left over during time seconds
+        state_of_charge = min(self.state_of_charge + self.__limit(energy, time, self.max_charge_power) * self.charge_efficiency, self.capacity)
+        taken = (state_of_charge - self.state_of_charge) / self.charge_efficiency
+        self.state_of_charge = state_of_charge
+        return taken
+
+    def discharge(self, energy, time):
+        # Energy delivered against energy (J) needed during time seconds
+        state_of_charge = max(self.state_of_charge - self.__limit(energy, time, self.max_discharge_power) / self.discharge_efficiency, 0)
+        delivered = (self.state_of_charge - state_of_charge) * self.discharge_efficiency
+        self.state_of_charge = state_of_charge
+        return delivered
+
+    def steps(self, surplus, deficit, times):
+        # Change of the state of charge of each segment, before it is limited
+        # by the capacity: what charge or discharge would do with an
+        # unlimited battery
+        charge = self.__limit(surplus, times, self.max_charge_power) * self.charge_efficiency
+        discharge = self.__limit(deficit, times, self.max_discharge_power) / self.discharge_efficiency
+        return np.where(surplus > 0, charge, -discharge)
+
+
+# The state of charge after a segment is clamp(s + x, 0, capacity), with s the
+# state before it. Functions s -> clamp(s + a, lo, hi) are closed under
+# composition:
+#
+#   f2(f1(s)) = clamp(s + a1 + a2, clamp(lo1 + a2, lo2, hi2), clamp(hi1 + a2, lo2, hi2))
+#
+# so the state after every segment comes from a prefix scan of the segments,
+# where a run of segments that fills or empties the battery is reduced to its
+# bound.
+
+def _compose(first, second):
+    a1, lo1, hi1 = first
+    a2, lo2, hi2 = second
+    return a1 + a2, np.clip(lo1 + a2, lo2, hi2), np.clip(hi1 + a2, lo2, hi2)
+
+
+def _scan_rows(f):
+    # Inclusive scan along the last axis (Hillis and Steele)
+    a, lo, hi = [np.array(values, dtype=np.float64) for values in f]
+    n = a.shape[-1]
+    d = 1
+    while d < n:
+        a_d, lo_d, hi_d = _compose(
+            (a[..., :-d], lo[..., :-d], hi[..., :-d]),
+            (a[..., d:], lo[..., d:], hi[..., d:])
+        )
+        a[..., d:], lo[..., d:], hi[..., d:] = a_d, lo_d, hi_d
+        d *= 2
+    return a, lo, hi
+
+
+def clamp_scan(a, lo, hi, block=SCAN_BLOCK):
+    # Compositions f_k o ... o f_0 of the functions f_i(s) = clamp(s + a[i],
+    # lo[i], hi[i]), as (a, lo, hi) arrays. Blocks of segments are scanned
+    # together and the scan of the blocks is applied to them.
+    a, lo, hi = [np.asarray(values, dtype=np.float64) for values in [a, lo, hi]]
+    n = len(a)
+    if n <= block:
+        return _scan_rows((a, lo, hi))
+
+    # Padded with the identity, clamp(s + 0, -inf, inf)
+    blocks = -(-n // block)
+    pad = blocks * block - n
+    rows = _scan_rows([
+        np.concatenate((values, np.full(pad, fill))).reshape(blocks, block)
+        for values, fill in [(a, 0), (lo, -np.inf), (hi, np.inf)]
+    ])
+
+    prefix = clamp_scan(rows[0][:, -1], rows[1][:, -1], rows[2][:, -1], block)
+    composed = _compose(
+        [v[:-1, None] for v in prefix],
+        [v[1:] for v in rows]
+    )
+    return [np.concatenate((row[0], c.ravel()))[:n] for row, c in zip(rows, composed)]
+
+
+def calc_battery_usage(times, powers, green_powers, battery):
+    # Totals of the green accounting of segments of time seconds with a
+    # constant power and green power (the segments of
+    # calc_green_energy_usage_batch) with battery, whose state of charge is
+    # updated. The green energy used includes the energy discharged by the
+    # battery, and the green energy not used is the one that did not fit in it.
+    times = np.asarray(times, dtype=np.float64)
+    energy = times * np.asarray(powers, dtype=np.float64)
+    green_energy = times * np.asarray(green_powers, dtype=np.float64)
+
+    surplus = np.maximum(green_energy - energy, 0)
+    deficit = np.maximum(energy - green_energy, 0)
+
+    state_of_charge = battery.state_of_charge
+    charged = 0.0
+    discharged = 0.0
+    if len(times) > 0:
+        a, lo, hi = clamp_scan(battery.steps(surplus, deficit, times), np.zeros(len(times)), np.full(len(times), battery.capacity))
+        states = np.clip(state_of_charge + a, lo, hi)
+        # Charges only increase the state of charge and discharges decrease it
+        changes = np.diff(states, prepend=state_of_charge)
+        charged = changes[changes > 0].sum().item() / battery.charge_efficiency
+        discharged = -changes[changes < 0].sum().item() * battery.discharge_efficiency
+        state_of_charge = states[-1].item()
+    battery.state_of_charge = state_of_charge
+
+    total_energy = energy.sum().item()
+    total_green_energy_used = np.minimum(energy, green_energy).sum().item() + discharged
+
+    return {
+        'total_energy': total_energy,
+        'total_brown_energy_used': total_energy - total_green_energy_used,
+        'total_green_energy_used': total_green_energy_used,
+        'total_green_energy_not_used': surplus.sum().item() - charged,
+        'total_battery_charged': charged,
+        'total_battery_discharged': discharged,
+        'battery_state_of_charge': state_of_charge
+    }
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_clamp_scan():
+    rng = np.random.default_rng(5)
+
+    for n in [1, 7, 64, 65, 1000, 5000]:
+        a = rng.normal(0, 10, n)
+        lo = rng.uniform(-20, 0, n)
+        hi = lo + rng.uniform(0, 40, n)
+
+        for block in [4, SCAN_BLOCK]:
+            scan = clamp_scan(a, lo, hi, block)
+            for s0 in [-50, 0, 3, 50]:
+                s = s0
+                for i in range(n):
+                    s = min(max(s + a[i], lo[i]), hi[i])
+                    found = min(max(s0 + scan[0][i], scan[1][i]), scan[2][i])
+                    assert abs(found - s) < 1e-9, f'State {i} of {n} from {s0} should be {s} instead of {found}'
+
+
+def __test_battery():
+    from energy_usage import EnergyUsage, calc_green_energy_usage
+    from vectorized_energy_usage import EnergyTrace, TiledEnergyTrace, as_energy_trace, calc_green_energy_usage_batch, calc_green_energy_usage_chunked
+
+    rng = np.random.default_rng(11)
+
+    e = EnergyUsage()
+    for i in range(500):
+        start = rng.integers(0, 4000) / 4
+        e.add_work('X', start, start + rng.integers(0, 80) / 4, rng.choice([5, 35 / 4, 20]))
+    _, energy_trace = e.calc()
+
+    green_interval_times = np.arange(7, 1100, 7, dtype=np.float64)
+    green_available_powers = rng.choice([0, 0, 10, 30, 60], len(green_interval_times)).astype(np.float64)
+
+    def new_battery():
+        return Battery(2000, max_charge_power=25, max_discharge_power=15, charge_efficiency=0.95, discharge_efficiency=0.9, state_of_charge=100)
+
+    expected = calc_green_energy_usage(energy_trace, iter(zip(green_interval_times.tolist(), green_available_powers.tolist())).__next__, new_battery())
+    assert expected['total_battery_discharged'] > 0 and expected['battery_state_of_charge'] < 2000, 'Battery should charge and discharge'
+
+    trace = as_energy_trace(energy_trace)
+    tiles = [EnergyTrace(trace.times[a:a + 97], trace.powers[a:a + 97], trace.energies[a:a + 97]) for a in range(0, len(trace), 97)]
+    for r in [
+        calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, battery=new_battery()),
+        calc_green_energy_usage_chunked(TiledEnergyTrace(lambda: iter(tiles), len(trace)).tiles(), green_interval_times, green_available_powers, battery=new_battery())
+    ]:
+        for key, value in expected.items():
+            assert abs(r[key] - value) < 1e-6, f'{key} should be {value} instead of {r[key]}'
+
+    # Without capacity, as without battery
+    without = calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers)
+    r = calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, battery=Battery(0))
+    for key, value in without.items():
+        assert abs(r[key] - value) < 1e-6, f'{key} of an empty battery should be {value}'
+
+    # Green energy is used, lost in the battery or stored
+    r = calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, battery=Battery(10**6, charge_efficiency=0.5))
+    assert r['total_green_energy_not_used'] < 1e-6, 'A big battery should store every surplus'
+    assert abs(r['battery_state_of_charge'] - r['total_battery_charged'] / 2 + r['total_battery_discharged']) < 1e-6, 'Stored energy should be the charges after losses'
+
+
+if __name__ == '__main__':
+
+    __test_clamp_scan()
+    __test_battery()
@@ -0,0 +1,312 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import json, logging, multiprocessing, os, platform, subprocess, sys, time
+
+import numpy as np
+
+from main import POWER_MODEL, load_works, pv_energy_intervals
+from instrumentation import peak_rss_mb
+from energy_usage import EnergyUsage, calc_green_energy_usage
+from node_energy_usage import load_green_intervals
+from pv_series import open_pv_series
+from trace_loader import iter_trace_events
+from vectorized_energy_usage import VectorizedEnergyUsage, calc_green_energy_usage_batch
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('benchmark')
+
+BASE_EVENTS = 2613 # Complete events of OMPC_matmul_trace_data.json, the scale 1x
+
+ENGINES = ['reference', 'vectorized']
+
+# Names of the complete events of the synthetic traces and their weights,
+# close to the mix of OMPC_matmul_trace_data.json
+EVENT_MIX = {
+    'Submit / Begin': 360,
+    'Submit / End': 360,
+    'pushNewEvent': 308,
+    'VarName': 244,
+    'Execute / Begin': 128,
+    'Execute / End': 128,
+    'Retrieve / Begin': 128,
+    'Retrieve / End': 128
+}
+
+PV_START = datetime(2016, 4, 12, 0, 0, 1)
+PV_STEP = 300 # 300s = 5min
+
+
+def microsecond_to_second(microsecond):
+    return microsecond / 1000000
+
+
+def generate_trace(events_file, events, depth=5, duration=1000, gap=1000, mix=None, grouped=False, seed=0):
+    # Chrome trace with events complete events (ph == 'X') of the names of mix
+    # (name -> weight) in depth lanes, so at most depth events overlap. The
+    # events of a lane follow each other, with durations and gaps (in us)
+    # drawn from exponential distributions of means duration and gap. The
+    # lanes are the threads of depth // 2 + 1 ranks (pid), which also get the
+    # metadata events (ph == 'M') of a real trace. Events are sorted by ts, or
+    # grouped by lane as in OMPC_matmul_trace_data.json.
+    rng = np.random.default_rng(seed)
+    if mix is None:
+        mix = EVENT_MIX
+
+    lane = np.arange(events) % depth
+    order = np.argsort(lane, kind='stable')
+    lane = lane[order]
+
+    # In ns, so the events of a lane never overlap
+    durations = np.rint(rng.exponential(1000 * duration, events)).astype(np.int64)
+    steps = durations + np.rint(rng.exponential(1000 * gap, events)).astype(np.int64) + 1
+    lane_starts = np.searchsorted(lane, np.arange(depth))
+    ts = np.cumsum(steps) - steps
+    ts -= np.repeat(ts[lane_starts], np.diff(np.append(lane_starts, events)))
+    ts += np.rint(rng.uniform(0, 1000 * (duration + gap), depth)).astype(np.int64)[lane]
+    ts, durations = ts / 1000, durations / 1000
+
+    names = list(mix)
+    weights = np.array([mix[name] for name in names], dtype=np.float64)
+    name_codes = rng.choice(len(names), events, p=weights / weights.sum())
+
+    ranks = depth // 2 + 1
+    pids = 1000 + lane % ranks
+    tids = pids + lane // ranks
+
+    if not grouped:
+        order = np.argsort(ts, kind='stable')
+        ts, durations, name_codes, pids, tids = ts[order], durations[order], name_codes[order], pids[order], tids[order]
+
+    event = '{{"ph": "X", "name": {}, "pid": {}, "tid": {}, "ts": {}, "dur": {}}}'
+    json_names = [json.dumps(name) for name in names]
+
+    with open(events_file, 'w', buffering=1 << 20) as f:
+        f.write('{"traceEvents": [\n')
+        for pid in range(1000, 1000 + ranks):
+            f.write(f'{{"ph": "M", "name": "process_name", "pid": {pid}, "args": {{"name": "Rank {pid - 1000}"}}}},\n')
+        chunk_size = 1 << 16
+        for a in range(0, events, chunk_size):
+            b = min(a + chunk_size, events)
+            f.write(',\n'.join(map(event.format, [json_names[c] for c in name_codes[a:b].tolist()], pids[a:b].tolist(), tids[a:b].tolist(), ts[a:b].tolist(), durations[a:b].tolist())))
+            f.write(',\n' if b < events else '\n')
+        f.write(']}\n')
+
+    return microsecond_to_second((ts + durations).max()) if events > 0 else 0
+
+
+def generate_pv_series(csv_file, duration, peak=1000, seed=0):
+    # Processed photovolta CSV (see process_photovolta_data.py) of the whole
+    # days that cover duration seconds: a sine of peak W/m2 from 6h to 18h,
+    # scaled by a random cloudiness of each interval
+    rng = np.random.default_rng(seed)
+
+    days = int(duration // 86400) + 1
+    rows = days * 86400 // PV_STEP
+    hours = (np.arange(rows) * PV_STEP % 86400) / 3600
+    irradiance = np.round(np.maximum(0, peak * np.sin(np.pi * (hours - 6) / 12)) * rng.uniform(0.3, 1, rows), 1)
+
+    with open(csv_file, 'w') as f:
+        f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+        for i, value in enumerate(irradiance.tolist()):
+            f.write(f'{PV_START + timedelta(seconds=PV_STEP * i)},{PV_STEP * (i + 1)},{value}\n')
+
+
+def _load_reference(events_file):
+    # Same loading of main.calc_energy_usage
+    e = EnergyUsage()
+    for event in iter_trace_events(events_file):
+        if event['ph'] != 'X':
+            continue
+        start = microsecond_to_second(float(event['ts']))
+        end = start + microsecond_to_second(float(event['dur']))
+        e.add_work('X', start, end, POWER_MODEL.power(event.get('name', ''), event.get('pid', -1), event.get('tid', -1)))
+    return e
+
+
+def _load_vectorized(events_file):
+    e = VectorizedEnergyUsage()
+    e.add_works(*load_works(events_file, POWER_MODEL))
+    return e
+
+
+def _calc_green(engine, energy_trace, pv_file, pv_area):
+    pv_series = open_pv_series(pv_file)
+    if engine == 'reference':
+        return calc_green_energy_usage(energy_trace, pv_energy_intervals(pv_series, pv_area))
+    return calc_green_energy_usage_batch(energy_trace, *load_green_intervals(pv_series, pv_area, 0))
+
+
+def run_phases(engine, events_file, pv_file, pv_area=1):
+    # Times the three phases of main.py (load, calc and green) with the
+    # EnergyUsage reference or the vectorized engine. The peak RSS is the
+    # peak of the process until the end of each phase.
+    phases = []
+
+    def run_phase(phase, f, *args):
+        start = time.perf_counter()
+        r = f(*args)
+        phases.append({'phase': phase, 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()})
+        return r
+
+    e = run_phase('load', _load_reference if engine == 'reference' else _load_vectorized, events_file)
+    events = len(e)
+    total_energy, energy_trace = run_phase('calc', e.calc)
+    r = run_phase('green', _calc_green, engine, energy_trace, pv_file, pv_area)
+
+    for phase in phases:
+        phase['events'] = events
+        phase['events_per_second'] = events / phase['seconds'] if phase['seconds'] > 0 else None
+    phases[1]['total_energy'] = total_energy
+    phases[2]['total_green_energy_used'] = r['total_green_energy_used']
+
+    return phases
+
+
+def version():
+    # Commit of the benchmarked code, with a + if it has uncommitted changes
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=src_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no', '.'], cwd=src_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def run_benchmarks(results_file, scales=(1, 10, 100, 1000), engines=ENGINES, data_dir='../data/benchmark', depth=5, seed=0):
+    # Generates the trace (scale * BASE_EVENTS complete events) and the PV
+    # series of every scale in data_dir, once, and appends the phases of every
+    # engine to results_file (JSON lines). Each run is done in a new process,
+    # so its peak RSS is its own.
+    os.makedirs(data_dir, exist_ok=True)
+
+    run = {
+        'version': version(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'depth': depth,
+        'seed': seed
+    }
+
+    results = []
+    for scale in scales:
+        events_file = os.path.join(data_dir, f'trace_{scale}x_d{depth}_s{seed}.json')
+        pv_file = os.path.join(data_dir, f'pv_{scale}x_d{depth}_s{seed}.csv')
+        if not (os.path.exists(events_file) and os.path.exists(pv_file)):
+            logger.info(f'Generating the trace of scale {scale}x...')
+            duration = generate_trace(events_file, scale * BASE_EVENTS, depth, seed=seed)
+            generate_pv_series(pv_file, duration, seed=seed)
+
+        for engine in engines:
+            logger.info(f'Running {engine} at scale {scale}x...')
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                phases = executor.submit(run_phases, engine, events_file, pv_file).result()
+
+            with open(results_file, 'a') as f:
+                for phase in phases:
+                    result = dict(run, engine=engine, scale=scale, **phase)
+                    f.write(json.dumps(result) + '\n')
+                    results.append(result)
+                    logger.info('{engine} {scale}x {phase}: {seconds:.3f}s, {peak_rss_mb:.1f}MB, {events_per_second:.0f} events/s'.format(**result))
+
+    return results
+
+
+def load_benchmarks(results_file):
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_benchmarks(results, base_version, new_version):
+    # Time and peak RSS of new_version relative to base_version, for every
+    # engine, scale and phase run by both (the last run of each version)
+    def by_key(version):
+        return {(r['engine'], r['scale'], r['phase']): r for r in results if r['version'] == version}
+
+    base = by_key(base_version)
+    new = by_key(new_version)
+
+    return [
+        {
+            'engine': engine,
+            'scale': scale,
+            'phase': phase,
+            'base_seconds': base[key]['seconds'],
+            'new_seconds': new[key]['seconds'],
+            'speedup': base[key]['seconds'] / new[key]['seconds'] if new[key]['seconds'] > 0 else None,
+            'rss_ratio': new[key]['peak_rss_mb'] / base[key]['peak_rss_mb']
+        }
+        for key in sorted(base.keys() & new.keys())
+        for engine, scale, phase in [key]
+    ]
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_generate_trace():
+    import tempfile
+    from trace_loader import load_complete_events_table
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_file = os.path.join(tmp_dir, 'trace.json')
+
+        for grouped in [False, True]:
+            end = generate_trace(events_file, 1000, depth=3, grouped=grouped)
+            events = load_complete_events_table(events_file)
+            assert len(events) == 1000, 'Trace should have every complete event'
+
+            ts = events.column('ts')
+            assert grouped or np.all(np.diff(ts) >= 0), 'Events should be sorted by ts'
+            assert abs(microsecond_to_second((ts + events.column('dur')).max()) - end) < 1e-9, 'End of the trace should be returned'
+
+            # At most depth events are active at any time
+            times = np.concatenate((ts, ts + events.column('dur')))
+            deltas = np.concatenate((np.ones(len(ts)), -np.ones(len(ts))))
+            order = np.lexsort((deltas, times))
+            assert np.cumsum(deltas[order]).max() <= 3, 'Events should overlap at most depth times'
+
+        assert set(events.names) <= set(EVENT_MIX), 'Names should be the ones of the mix'
+
+        pv_file = os.path.join(tmp_dir, 'pv.csv')
+        generate_pv_series(pv_file, 100000)
+        pv_series = open_pv_series(pv_file)
+        assert len(pv_series) == 2 * 86400 // PV_STEP, 'PV series should have whole days'
+        assert pv_series.irradiance[:12 * 6].max() == 0, 'PV series should have no power at night'
+
+
+def __test_run_phases():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_file = os.path.join(tmp_dir, 'trace.json')
+        pv_file = os.path.join(tmp_dir, 'pv.csv')
+        generate_pv_series(pv_file, generate_trace(events_file, 2000, depth=4, duration=10**6))
+
+        reference = run_phases('reference', events_file, pv_file)
+        vectorized = run_phases('vectorized', events_file, pv_file)
+
+        assert [p['phase'] for p in reference] == ['load', 'calc', 'green'], 'Every phase should be timed'
+        assert all(p['events'] == 2000 for p in reference + vectorized), 'Every event should be loaded'
+        assert abs(reference[1]['total_energy'] - vectorized[1]['total_energy']) < 1e-6, 'Engines should have the same energy'
+        assert abs(reference[2]['total_green_energy_used'] - vectorized[2]['total_green_energy_used']) < 1e-6, 'Engines should have the same green energy'
+
+        results = [dict(p, version=v, engine='reference', scale=1) for v, phases in [('a', reference), ('b', vectorized)] for p in phases]
+        comparison = compare_benchmarks(results, 'a', 'b')
+        assert [c['phase'] for c in comparison] == ['calc', 'green', 'load'], 'Every phase should be compared'
+
+
+if __name__ == '__main__':
+
+    __test_generate_trace()
+    __test_run_phases()
+
+    results_file = '../data/benchmark/benchmark_results.jsonl' # With the generated traces, not versioned
+    scales = [1, 10, 100] # 1000 takes about 2.6M events and 300MB of trace
+
+    run_benchmarks(results_file, scales)
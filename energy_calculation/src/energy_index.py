@@ -0,0 +1,113 @@
+import logging, sys
+
+import numpy as np
+
+from vectorized_energy_usage import as_energy_trace
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('energy_index')
+
+
+class EnergyIndex:
+    # Range queries over an energy trace (the list of EnergyUsage.calc or any
+    # trace accepted by as_energy_trace). The interval i of the trace covers
+    # [starts[i], ends[i]) with power powers[i], and energy_prefix[i] is the
+    # energy used before starts[i], so every query is a binary search in ends.
+    # Times before 0 and after the end of the trace have no power.
+    #
+    # The queries accept a number (and return a float) or an array of them.
+
+    def __init__(self, energy_trace):
+        energy_trace = as_energy_trace(energy_trace)
+
+        self.ends = np.cumsum(energy_trace.times)
+        self.starts = self.ends - energy_trace.times
+        self.powers = np.asarray(energy_trace.powers, dtype=np.float64)
+        self.energy_prefix = np.concatenate(([0.0], np.cumsum(energy_trace.energies)))
+
+    @classmethod
+    def from_energy_usage(cls, e):
+        _, energy_trace = e.calc()
+        return cls(energy_trace)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def end(self):
+        return self.ends[-1].item() if len(self.ends) > 0 else 0.0
+
+    def __interval(self, t):
+        # Interval that contains t, len(self) after the end of the trace
+        return np.searchsorted(self.ends, t, side='right')
+
+    def __result(self, t, values):
+        return values.item() if np.ndim(t) == 0 else values
+
+    def power_at(self, t):
+        t = np.asarray(t, dtype=np.float64)
+        i = self.__interval(t)
+
+        inside = (i < len(self)) & (t >= 0)
+        powers = np.zeros(np.shape(t))
+        powers[inside] = self.powers[i[inside]]
+        return self.__result(t, powers)
+
+    def energy_until(self, t):
+        # Energy used in [0, t)
+        t = np.clip(np.asarray(t, dtype=np.float64), 0, self.end())
+        if len(self) == 0:
+            return self.__result(t, np.zeros(np.shape(t)))
+
+        i = np.minimum(self.__interval(t), len(self) - 1)
+        return self.__result(t, self.energy_prefix[i] + (t - self.starts[i]) * self.powers[i])
+
+    def energy_between(self, t1, t2):
+        # Energy used in [t1, t2)
+        return self.energy_until(t2) - self.energy_until(t1)
+
+    def average_power(self, t1, t2):
+        return self.energy_between(t1, t2) / (np.asarray(t2, dtype=np.float64) - t1)
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_energy_index():
+    from energy_usage import EnergyUsage
+
+    # Same works of energy_usage.__test_calc
+    e = EnergyUsage()
+    e.add_work('A', 0, 5, 10)
+    e.add_work('B', 5, 15, 100)
+    e.add_work('C', 21, 26, 7)
+    e.add_work('D', 22, 27, 9)
+    e.add_work('E', 35, 40, 1)
+
+    index = EnergyIndex.from_energy_usage(e)
+
+    for t, power in [(-1, 0), (0, 10), (4.5, 10), (5, 100), (15, 0), (21, 7), (22, 16), (26, 9), (39.9, 1), (40, 0), (100, 0)]:
+        assert index.power_at(t) == power, f'Power at {t} should be {power}'
+
+    for t1, t2, energy in [(0, 40, 1135), (-10, 100, 1135), (0, 5, 50), (2, 7, 230), (15, 21, 0), (23, 26.5, 16 * 3 + 9 * 0.5), (10, 10, 0)]:
+        assert abs(index.energy_between(t1, t2) - energy) < 1e-9, f'Energy between {t1} and {t2} should be {energy}'
+
+    assert abs(index.average_power(0, 5) - 10) < 1e-9, 'Average power should be 10'
+
+    # Batches of queries
+    t = np.array([-1, 4.5, 22, 40])
+    assert index.power_at(t).tolist() == [0, 10, 16, 0], 'Batch of power queries differs'
+
+    t1 = np.array([0, 2, 15])
+    t2 = np.array([40, 7, 21])
+    assert np.allclose(index.energy_between(t1, t2), [1135, 230, 0]), 'Batch of energy queries differs'
+
+    assert EnergyIndex([]).energy_between(0, 10) == 0, 'Empty trace has no energy'
+
+
+if __name__ == '__main__':
+
+    __test_energy_index()
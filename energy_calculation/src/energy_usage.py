@@ -1,6 +1,12 @@
+from array import array
 from bintrees import FastAVLTree
 import logging, sys
 
+import numpy as np
+
+import instrumentation
+from battery import BATTERY_KEYS
+
 # Bintrees doc: https://pypi.org/project/bintrees/
 
 
@@ -13,6 +19,8 @@ logger = logging.getLogger('energy_usage')
 
 
 class Work:
+    __slots__ = ('name', 'power')
+
     def __init__(self, name, power):
         self.name = name
         self.power = power # in Watts, that is J/s
@@ -22,6 +30,8 @@ class Work:
 
 
 class Instant:
+    __slots__ = ('timestamp', 'worksBeginning', 'worksEnding')
+
     def __init__(self, timestamp, worksBeginning, worksEnding):
         self.timestamp = timestamp
         self.worksBeginning = worksBeginning
@@ -31,113 +41,267 @@ class Instant:
         return str(self.timestamp)
 
 
-class EnergyUsage:
-    
+class InstantTree:
+    # Instants of the works sorted in an AVL tree, for works that are added
+    # while the instants are consumed (as in live_energy_usage)
+
     def __init__(self):
         self.instants = FastAVLTree()
-    
-    
+
+    def __len__(self):
+        return len(self.instants)
+
     def __get_instant(self, timestamp):
         instant = self.instants.get(timestamp)
         if instant is None:
             instant = Instant(timestamp, [], [])
             self.instants.insert(timestamp, instant)
         return instant
-    
+
     def add_work(self, name, start, end, power):
         work = Work(name, power)
         self.__get_instant(start).worksBeginning.append(work)
         self.__get_instant(end).worksEnding.append(work)
+        return work
+
+    def clear(self):
+        self.instants.clear()
+
 
+class TreeEnergyUsage(InstantTree):
+    # The first EnergyUsage, with the works in the instants of the AVL tree.
+    # Kept as the reference of EnergyUsage.calc in the tests.
 
     def calc(self):
         lastTime = 0
         activeWorks = {}
-        
+
         energy_trace = []
         total_energy_in_joules = 0
-        
+
         for key, instant in self.instants.items():
             time = instant.timestamp - lastTime
             if activeWorks:
-                
+
                 power = 0
                 for w in activeWorks.keys():
                     power += w.power
-                    
+
                 energy = time * power # 1W * 1s = 1J
                 total_energy_in_joules += energy
-                logger.debug(f'{time}s * {power}W = {energy}J')
-                
+
                 # s, W and J
                 energy_trace.append((time, power, energy))
             else:
-                logger.debug(f'{time}s * 0W = 0J (No active works)')
                 energy_trace.append((time, 0, 0))
-                
+
             lastTime = instant.timestamp
-            
+
             for work in instant.worksBeginning:
                 activeWorks[work] = instant.timestamp
-                
+
             for work in instant.worksEnding:
                 activeWorks.pop(work)
+
+        return (total_energy_in_joules, energy_trace)
+
+
+class EnergyUsage:
+    # Works are kept in parallel typed arrays (start, end and power), so no
+    # Python object is created per work. calc sorts the starts and ends of the
+    # works once: at each instant the works beginning are activated before the
+    # works ending are removed, both in the order they were added, as in
+    # TreeEnergyUsage.
+    
+    def __init__(self):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.powers = array('d')
+
+    def __len__(self):
+        return len(self.starts)
+    
+    def add_work(self, name, start, end, power):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.powers.append(power)
+
+    def add_works(self, starts, ends, powers, name='X'):
+        # Works given as arrays (powers may be a number), all with the same name
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        powers = np.broadcast_to(np.asarray(powers, dtype=np.float64), starts.shape)
+
+        self.starts.frombytes(starts.tobytes())
+        self.ends.frombytes(ends.tobytes())
+        self.powers.frombytes(powers.tobytes())
+
+
+    def calc(self):
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        n = len(self.starts)
+
+        # Boundary k < n is the start of the work k, and k >= n the end of the
+        # work k - n. The stable sort keeps the starts before the ends.
+        with instrumentation.phase('build'):
+            times = np.concatenate((np.frombuffer(self.starts, dtype=np.float64), np.frombuffer(self.ends, dtype=np.float64)))
+            order = np.argsort(times, kind='stable')
+            timestamps, first = np.unique(times[order], return_index=True)
+
+            boundaries = order.tolist()
+            bounds = first.tolist() + [2 * n]
+            powers = self.powers
+
+        if instrumentation.current() is not None and n > 0:
+            # Works active after each instant
+            active = np.cumsum(np.where(order < n, 1, -1))[np.array(bounds[1:]) - 1]
+            instrumentation.count('works', n)
+            instrumentation.count('instants', len(timestamps))
+            instrumentation.maximum('max_concurrent_works', active.max().item())
+
+        with instrumentation.phase('sweep'):
+            lastTime = 0
+            activeWorks = {}
+        
+            energy_trace = []
+            total_energy_in_joules = 0
+        
+            for i, timestamp in enumerate(timestamps.tolist()):
+                time = timestamp - lastTime
+                if activeWorks:
+                
+                    power = 0
+                    for w in activeWorks.keys():
+                        power += powers[w]
+                    
+                    energy = time * power # 1W * 1s = 1J
+                    total_energy_in_joules += energy
+                    if debug:
+                        logger.debug(f'{time}s * {power}W = {energy}J')
+                
+                    # s, W and J
+                    energy_trace.append((time, power, energy))
+                else:
+                    if debug:
+                        logger.debug(f'{time}s * 0W = 0J (No active works)')
+                    energy_trace.append((time, 0, 0))
+                
+                lastTime = timestamp
+            
+                for k in boundaries[bounds[i]:bounds[i + 1]]:
+                    if k < n:
+                        activeWorks[k] = timestamp
+                    else:
+                        activeWorks.pop(k - n)
             
         return (total_energy_in_joules, energy_trace)
        
     def clear(self):
-        self.instants.clear()
+        self.__init__()
 
 
-def calc_green_energy_usage(energy_trace, next_green_interval):
+class GreenEnergyUsage:
+    # calc_green_energy_usage one interval of the energy trace at a time, so
+    # the totals can be updated while the trace is computed. With a battery
+    # (battery.Battery), the green energy left charges it and it discharges
+    # against the brown energy.
 
-    now = 0    
-    green_interval_time = 0
-    green_available_power = 0
+    def __init__(self, next_green_interval, battery=None):
+        self.next_green_interval = next_green_interval
+        self.battery = battery
+        self.debug = logger.isEnabledFor(logging.DEBUG)
 
-    total_energy = 0
-    total_brown_energy_used = 0
-    total_green_energy_used = 0
-    total_green_energy_not_used = 0
-    
-    for time, power, energy in energy_trace:
-        
-        logger.debug('')
-        logger.debug(f'Energy Trace: {time}s, {power}W, {energy}J')
+        self.now = 0
+        self.green_interval_time = 0
+        self.green_available_power = 0
+
+        self.total_energy = 0
+        self.total_brown_energy_used = 0
+        self.total_green_energy_used = 0
+        self.total_green_energy_not_used = 0
+
+        self.total_battery_charged = 0
+        self.total_battery_discharged = 0
+
+        self.pv_rows_read = 0
+        self.green_interval_splits = 0
+
+    def add(self, time, power):
+        debug = self.debug
 
         while time > 0:
 
-            if now >= green_interval_time:
-                green_interval_time, green_available_power = next_green_interval()
+            if self.now >= self.green_interval_time:
+                self.green_interval_time, self.green_available_power = self.next_green_interval()
+                self.pv_rows_read += 1
 
-            if now + time > green_interval_time:
-                logger.debug('Breaking the work duration to fit in the green interval')
-                t = green_interval_time - now
+            if self.now + time > self.green_interval_time:
+                if debug:
+                    logger.debug('Breaking the work duration to fit in the green interval')
+                t = self.green_interval_time - self.now
+                self.green_interval_splits += 1
             else:
                 t = time
                 
             # Calculation
             energy = t * power
-            green_energy = t * green_available_power
+            green_energy = t * self.green_available_power
             green_energy_used = energy if green_energy >= energy else green_energy
+            green_energy_not_used = green_energy - green_energy_used
+
+            if self.battery is not None:
+                if green_energy_not_used > 0:
+                    charged = self.battery.charge(green_energy_not_used, t)
+                    self.total_battery_charged += charged
+                    green_energy_not_used -= charged
+                elif energy > green_energy_used:
+                    discharged = self.battery.discharge(energy - green_energy_used, t)
+                    self.total_battery_discharged += discharged
+                    green_energy_used += discharged
             
-            total_energy += energy
-            total_brown_energy_used += energy - green_energy_used
-            total_green_energy_used += green_energy_used
-            total_green_energy_not_used += green_energy - green_energy_used
+            self.total_energy += energy
+            self.total_brown_energy_used += energy - green_energy_used
+            self.total_green_energy_used += green_energy_used
+            self.total_green_energy_not_used += green_energy_not_used
             
-            logger.debug(f'({now}s t={t}s Energy={energy}J)')
+            if debug:
+                logger.debug(f'({self.now}s t={t}s Energy={energy}J)')
 
-            now += t
+            self.now += t
             time -= t
+
+    def result(self):
+        r = {
+            'total_energy': self.total_energy,
+            'total_brown_energy_used': self.total_brown_energy_used,
+            'total_green_energy_used': self.total_green_energy_used,
+            'total_green_energy_not_used': self.total_green_energy_not_used
+        }
+        if self.battery is not None:
+            r.update(zip(BATTERY_KEYS, [self.total_battery_charged, self.total_battery_discharged, self.battery.state_of_charge]))
+        return r
+
+
+def calc_green_energy_usage(energy_trace, next_green_interval, battery=None):
+    # The arrays version is vectorized_energy_usage.calc_green_energy_usage_batch
+
+    g = GreenEnergyUsage(next_green_interval, battery)
+    debug = g.debug
+    
+    with instrumentation.phase('green'):
+        for time, power, energy in energy_trace:
             
+            if debug:
+                logger.debug('')
+                logger.debug(f'Energy Trace: {time}s, {power}W, {energy}J')
+
+            g.add(time, power)
 
-    return {
-        'total_energy': total_energy,
-        'total_brown_energy_used': total_brown_energy_used,
-        'total_green_energy_used': total_green_energy_used,
-        'total_green_energy_not_used': total_green_energy_not_used
-    }
+    instrumentation.count('pv_rows_read', g.pv_rows_read)
+    instrumentation.count('green_interval_splits', g.green_interval_splits)
+
+    return g.result()
 
 
 # * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
@@ -206,6 +370,46 @@ def __test_calc():
         assert e == energy, f'Energy {e} should be {energy}'   
 
 
+def __test_calc_same_as_tree():
+    import random
+
+    # Integer times in a short span, so many works start or end at the same
+    # instant, touch (one ends where the next starts) or last 0s
+    rng = random.Random(3)
+    for works in [1, 2, 10, 300]:
+        e = EnergyUsage()
+        reference = TreeEnergyUsage()
+        for i in range(works):
+            start = rng.randint(0, 20)
+            end = start + rng.choice([0, 0, 1, 2, 5])
+            power = rng.choice([35 / 8, 45 / 8, 0.1, 10])
+            e.add_work(str(i), start, end, power)
+            reference.add_work(str(i), start, end, power)
+
+        assert e.calc() == reference.calc(), f'Energy usage of {works} works should be the one of the tree'
+
+
+def __test_calc_trace_data():
+    from trace_loader import iter_trace_events
+
+    # Total of the trace with the first EnergyUsage, 35/4W per work
+    expected_total_energy_in_joules = 1305.109766100001
+
+    e = EnergyUsage()
+    reference = TreeEnergyUsage()
+    for event in iter_trace_events('../data/OMPC_matmul_trace_data.json'):
+        if event['ph'] == 'X':
+            start = float(event['ts']) / 1000000
+            end = start + float(event['dur']) / 1000000
+            e.add_work('X', start, end, 35 / 4)
+            reference.add_work('X', start, end, 35 / 4)
+
+    total_energy_in_joules, energy_trace = e.calc()
+    assert (total_energy_in_joules, energy_trace) == reference.calc(), 'Energy usage of the trace should be the one of the tree'
+    assert abs(total_energy_in_joules - expected_total_energy_in_joules) < 1e-9, f'Total energy should be {expected_total_energy_in_joules}'
+    assert len(energy_trace) == 5222, f'The trace should have 5222 intervals, not {len(energy_trace)}'
+
+
 def __test_calc_green_energy_usage():
 
     # Power Usage: *
@@ -247,4 +451,6 @@ def __test_calc_green_energy_usage():
 if __name__ == '__main__':
 
     __test_calc()
+    __test_calc_same_as_tree()
+    __test_calc_trace_data()
     __test_calc_green_energy_usage()
@@ -0,0 +1,319 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv, glob, json, logging, os, sys
+
+import numpy as np
+
+from main import POWER_MODEL, calc_energy_usage_cached
+from pv_area_sweep import calc_pv_area_sweep
+from pv_series import open_pv_series
+from trace_cache import TraceCache
+from vectorized_energy_usage import EnergyTrace, as_energy_trace, coalesce_energy_trace
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('experiment_matrix')
+
+# Green usage of every combination of traces x PV files x offsets x PV areas
+# of a JSON config, as
+#
+#   {
+#       "traces": ["../data/OMPC_matmul_trace_data.json"],
+#       "pv_files": ["../../photovolta/data/splitted_old/*.csv"],
+#       "offsets": {"start": 0, "stop": 86400, "step": 3600},
+#       "pv_areas": [0.5, 1, 2],
+#       "relative_offsets": true,
+#       "coalesce": true
+#   }
+#
+# with the paths (or glob patterns) relative to the config file, as they are
+# written in the results, and the values a number, a list or a range. Offsets
+# are times of the PV series (or, with relative_offsets, seconds after the first
+# interval of each PV file, as in the splits of split_photavolta_data.py) where
+# the trace starts: the PV intervals are rebased at them, as in
+# start_offset_sweep.py.
+#
+# Each trace is parsed once (through the trace cache) and its energy trace
+# saved as a .npy file next to the cache entries; the workers memory-map it and
+# the .pvs series of the PV files, so their pages are shared instead of being
+# read for every combination. A task is a trace, PV file and offset, with every
+# PV area in one calc_pv_area_sweep.
+#
+# The rows of a task are appended to the results CSV when it ends, so an
+# interrupted run is resumed by running it again: only the combinations
+# without a row are evaluated. Offsets whose PV rows end before the trace are
+# skipped, not run, as they can never have a row.
+
+KEY_FIELDS = ['trace', 'pv_file', 'offset', 'pv_area']
+TOTAL_KEYS = ['total_energy', 'total_brown_energy_used', 'total_green_energy_used', 'total_green_energy_not_used']
+FIELDS = KEY_FIELDS + TOTAL_KEYS
+
+_shared_traces = {} # Energy traces mapped by this process, by .npy file
+
+
+def _expand_paths(patterns, base_dir):
+    paths = []
+    for pattern in [patterns] if isinstance(patterns, str) else patterns:
+        found = sorted(glob.glob(os.path.join(base_dir, pattern)))
+        if not found:
+            raise Exception(f'No file matches {pattern}')
+        paths += [os.path.relpath(path, base_dir) for path in found]
+    return paths
+
+
+def _expand_values(values):
+    # A number, a list of numbers or {"start", "stop", "step"} (stop excluded)
+    if isinstance(values, dict):
+        return np.arange(values['start'], values['stop'], values['step']).tolist()
+    if isinstance(values, (int, float)):
+        return [values]
+    return list(values)
+
+
+def load_matrix(config_file):
+    with open(config_file) as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_file))
+
+    return {
+        'base_dir': base_dir,
+        'traces': _expand_paths(config['traces'], base_dir),
+        'pv_files': _expand_paths(config['pv_files'], base_dir),
+        'offsets': [float(offset) for offset in _expand_values(config.get('offsets', 0))],
+        'pv_areas': [float(pv_area) for pv_area in _expand_values(config.get('pv_areas', 1))],
+        'relative_offsets': config.get('relative_offsets', False),
+        'coalesce': config.get('coalesce', True)
+    }
+
+
+def _row_key(trace, pv_file, offset, pv_area):
+    return (trace, pv_file, float(offset), float(pv_area))
+
+
+def load_results(results_file):
+    # Rows of a results CSV. A row cut by an interrupted write is removed from
+    # the file, so the next rows are appended after the last complete one.
+    if not os.path.exists(results_file):
+        return []
+
+    with open(results_file, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end < len(content):
+            logger.warning(f'Removing an incomplete row of {results_file}')
+            f.truncate(end)
+
+    with open(results_file, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def share_energy_trace(events_file, cache, coalesce=True, power_model=POWER_MODEL):
+    # .npy file with the times, powers and energies of the energy trace (a 3 x n
+    # array), written once per trace, power model and coalesce
+    key = cache.key(events_file, power_model, vectorized=True, coalesce=coalesce)
+    shared_file = os.path.join(cache.cache_dir, f'{key}.npy')
+    if os.path.exists(shared_file):
+        return shared_file
+
+    _, energy_trace = calc_energy_usage_cached(events_file, True, cache, power_model)
+    if coalesce:
+        energy_trace = coalesce_energy_trace(energy_trace)
+    energy_trace = as_energy_trace(energy_trace)
+
+    tmp_file = f'{shared_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, np.stack((energy_trace.times, energy_trace.powers, energy_trace.energies)))
+    os.replace(tmp_file, shared_file)
+    return shared_file
+
+
+def _open_energy_trace(shared_file):
+    energy_trace = _shared_traces.get(shared_file)
+    if energy_trace is None:
+        times, powers, energies = np.load(shared_file, mmap_mode='r')
+        energy_trace = _shared_traces[shared_file] = EnergyTrace(times, powers, energies)
+    return energy_trace
+
+
+def _pv_offset(pv_series, offset, relative_offset):
+    if relative_offset and len(pv_series) > 0:
+        offset += pv_series.intervals[0].item()
+    return offset
+
+
+def _covers(pv_series, offset, duration):
+    # Whether the PV intervals after offset reach the end of a trace of
+    # duration seconds started at it, else calc_green_energy_usage_batch runs
+    # out of green intervals
+    return len(pv_series) > 0 and pv_series.intervals[-1].item() - offset >= duration
+
+
+def _rebase_green_intervals(pv_series, offset):
+    # PV intervals of a trace started at offset, as calc_start_offset_sweep
+    # rebases them: the interval that ends at t ends at t - offset
+    first = np.searchsorted(pv_series.intervals, offset, side='right')
+    return pv_series.intervals[first:].astype(np.float64) - offset, pv_series.irradiance[first:]
+
+
+def _run_combination(shared_file, pv_series, offset, pv_areas, relative_offset=False):
+    pv_interval_times, pv_irradiance = _rebase_green_intervals(pv_series, _pv_offset(pv_series, offset, relative_offset))
+    table = calc_pv_area_sweep(_open_energy_trace(shared_file), pv_interval_times, pv_irradiance, pv_areas)
+    return [{key: table[key][i].item() for key in TOTAL_KEYS} for i in range(len(pv_areas))]
+
+
+def run_matrix(matrix, results_file, workers=None, cache=None):
+    # Appends to results_file the rows of the combinations of matrix (see
+    # load_matrix) that it does not have yet. Returns the rows written.
+    if cache is None:
+        cache = TraceCache()
+
+    done = {_row_key(row['trace'], row['pv_file'], row['offset'], row['pv_area']) for row in load_results(results_file)}
+
+    tasks = []
+    for trace in matrix['traces']:
+        for pv_file in matrix['pv_files']:
+            for offset in matrix['offsets']:
+                pv_areas = [pv_area for pv_area in matrix['pv_areas'] if _row_key(trace, pv_file, offset, pv_area) not in done]
+                if pv_areas:
+                    tasks.append((trace, pv_file, offset, pv_areas))
+
+    # Parsed and converted here, once, before the workers map them
+    shared_files = {}
+    durations = {}
+    for trace in sorted({task[0] for task in tasks}):
+        logger.info(f'Sharing the energy trace of {trace}...')
+        shared_files[trace] = share_energy_trace(os.path.join(matrix['base_dir'], trace), cache, matrix['coalesce'])
+        durations[trace] = _open_energy_trace(shared_files[trace]).times.sum().item()
+    pv_series = {pv_file: open_pv_series(os.path.join(matrix['base_dir'], pv_file)) for pv_file in sorted({task[1] for task in tasks})}
+
+    feasible = [
+        task for task in tasks
+        if _covers(pv_series[task[1]], _pv_offset(pv_series[task[1]], task[2], matrix['relative_offsets']), durations[task[0]])
+    ]
+    skipped = sum(len(task[3]) for task in tasks) - sum(len(task[3]) for task in feasible)
+    tasks = feasible
+
+    combinations = len(matrix['traces']) * len(matrix['pv_files']) * len(matrix['offsets']) * len(matrix['pv_areas'])
+    pending = sum(len(task[3]) for task in tasks)
+    logger.info(f'{combinations - pending - skipped} of {combinations} combinations already done, {skipped} past the end of their PV series, {len(tasks)} tasks to run')
+    if not tasks:
+        return []
+
+    write_header = not os.path.exists(results_file) or os.path.getsize(results_file) == 0
+    rows = []
+    failed = 0
+    with open(results_file, 'a', newline='') as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if write_header:
+            writer.writeheader()
+
+        futures = {
+            executor.submit(_run_combination, shared_files[trace], pv_series[pv_file], offset, pv_areas, matrix['relative_offsets']): (trace, pv_file, offset, pv_areas)
+            for trace, pv_file, offset, pv_areas in tasks
+        }
+        for i, future in enumerate(as_completed(futures)):
+            trace, pv_file, offset, pv_areas = futures[future]
+            try:
+                totals = future.result()
+            except Exception as e:
+                # Not written, so it is run again on the next run
+                logger.error(f'{trace} with {pv_file} at offset {offset}: {e}')
+                failed += 1
+                continue
+
+            task_rows = [
+                dict(zip(KEY_FIELDS, (trace, pv_file, offset, pv_area)), **r)
+                for pv_area, r in zip(pv_areas, totals)
+            ]
+            writer.writerows(task_rows)
+            f.flush()
+            rows += task_rows
+
+            if (i + 1) % 100 == 0 or i + 1 == len(tasks):
+                logger.info(f'{i + 1} of {len(tasks)} tasks done')
+
+    if failed > 0:
+        logger.warning(f'{failed} tasks failed')
+    return rows
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_run_matrix():
+    import tempfile
+    from benchmark import generate_pv_series, generate_trace
+    from start_offset_sweep import calc_start_offset_sweep
+    from vectorized_energy_usage import calc_green_energy_usage_batch
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        duration = generate_trace(os.path.join(tmp_dir, 'trace.json'), 300, duration=20, gap=20)
+        for seed in range(2):
+            generate_pv_series(os.path.join(tmp_dir, f'pv_{seed}.csv'), duration, seed=seed)
+
+        config_file = os.path.join(tmp_dir, 'matrix.json')
+        with open(config_file, 'w') as f:
+            json.dump({
+                'traces': ['trace.json'],
+                'pv_files': ['pv_*.csv'],
+                'offsets': [0, 30000, 60299.999, 90000], # 90000 is after the PV series
+                'pv_areas': [0.5, 2]
+            }, f)
+
+        matrix = load_matrix(config_file)
+        assert matrix['pv_files'] == ['pv_0.csv', 'pv_1.csv'], 'Patterns should be expanded'
+        assert _expand_values({'start': 0, 'stop': 120000, 'step': 30000}) == [0, 30000, 60000, 90000], 'Ranges should be expanded'
+
+        cache = TraceCache(os.path.join(tmp_dir, 'cache'))
+        results_file = os.path.join(tmp_dir, 'results.csv')
+        rows = run_matrix(matrix, results_file, workers=2, cache=cache)
+        assert len(rows) == 12, 'Every combination covered by the PV series should be run'
+
+        _, energy_trace = calc_energy_usage_cached(os.path.join(tmp_dir, 'trace.json'), True, cache)
+        for row in rows:
+            pv_series = open_pv_series(os.path.join(tmp_dir, row['pv_file']))
+            intervals = pv_series.intervals.astype(np.float64)
+            pv_available_powers = row['pv_area'] * pv_series.irradiance
+            if row['offset'] == 60299.999:
+                # The trace starts 1 ms before the end of an interval, so it
+                # runs in two of them, of different powers
+                assert duration > 0.001 and pv_series.irradiance[200] != pv_series.irradiance[201], 'The trace should cross the interval ending at 60300'
+
+            rebased = intervals > row['offset']
+            expected = calc_green_energy_usage_batch(energy_trace, intervals[rebased] - row['offset'], pv_available_powers[rebased])
+            for key, value in expected.items():
+                assert abs(row[key] - value) < 1e-6, f'{key} should be {value} instead of {row[key]}'
+
+            if row['offset'] % 300 == 0:
+                sweep = calc_start_offset_sweep(energy_trace, intervals, pv_available_powers, offsets=[row['offset']])
+                for key in TOTAL_KEYS:
+                    assert abs(row[key] - sweep[key][0]) < 1e-6, f'{key} at offset {row["offset"]} should be the one of calc_start_offset_sweep'
+
+        # Interrupted while writing a row: it is removed and run again with
+        # the combinations never written
+        with open(results_file) as f:
+            lines = f.readlines()
+        with open(results_file, 'w') as f:
+            f.writelines(lines[:6] + [lines[6][:10]])
+
+        rows = run_matrix(matrix, results_file, workers=2, cache=cache)
+        assert len(rows) == 7, f'Only the 7 missing combinations should be run, not {len(rows)}'
+
+        results = load_results(results_file)
+        assert len(results) == 12, 'Every combination should have one row'
+        assert len({_row_key(r['trace'], r['pv_file'], r['offset'], r['pv_area']) for r in results}) == 12, 'No combination should be repeated'
+
+        assert run_matrix(matrix, results_file, cache=cache) == [], 'A finished matrix should not run again'
+
+
+if __name__ == '__main__':
+
+    __test_run_matrix()
+
+    config_file = sys.argv[1] if len(sys.argv) > 1 else '../../experiments/02_pv_splits_matrix/matrix.json'
+    results_file = os.path.splitext(config_file)[0] + '_results.csv'
+
+    matrix = load_matrix(config_file)
+    run_matrix(matrix, results_file, workers=None)
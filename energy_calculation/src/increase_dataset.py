@@ -1,3 +1,5 @@
+# repeated_trace.RepeatedTrace builds the same trace lazily, without writing it
+
 import json
 
 if __name__ == '__main__':
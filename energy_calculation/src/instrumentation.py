@@ -0,0 +1,206 @@
+from contextlib import contextmanager, nullcontext
+import csv, json, logging, resource, sys, time
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('instrumentation')
+
+# Opt-in timings and counters of the phases of a run (parse, build, sweep and
+# green). Disabled, which is the default, current() is None: phase returns a
+# shared null context and count and maximum return at once. Counters are
+# updated once per call of the instrumented functions, from values they
+# already have, never once per work or instant.
+
+CSV_FIELDS = ['kind', 'name', 'value', 'calls', 'peak_rss_mb']
+
+_current = None
+_null_phase = nullcontext()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1 << 20) if sys.platform == 'darwin' else peak_rss / (1 << 10)
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {} # name -> {'seconds', 'calls', 'peak_rss_mb'}
+        self.counters = {}
+        self.running = set()
+
+    @contextmanager
+    def phase(self, name):
+        # A phase run inside itself (calc_green_energy_usage_batch by
+        # calc_green_energy_usage_chunked) is timed once
+        if name in self.running:
+            yield
+            return
+
+        self.running.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.running.discard(name)
+            p = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_mb': 0.0})
+            p['seconds'] += time.perf_counter() - start
+            p['calls'] += 1
+            p['peak_rss_mb'] = peak_rss_mb()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def maximum(self, name, value):
+        self.counters[name] = max(self.counters.get(name, value), value)
+
+    def result(self, totals=None):
+        r = {
+            'seconds': time.perf_counter() - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'phases': self.phases,
+            'counters': self.counters
+        }
+        if totals is not None:
+            r['totals'] = totals
+        return r
+
+    def save(self, output_file, totals=None):
+        # JSON, or CSV if output_file ends with .csv
+        r = self.result(totals)
+
+        if not output_file.endswith('.csv'):
+            with open(output_file, 'w') as f:
+                json.dump(r, f, indent=4)
+            return r
+
+        with open(output_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerow({'kind': 'run', 'name': 'seconds', 'value': r['seconds'], 'peak_rss_mb': r['peak_rss_mb']})
+            for name, p in r['phases'].items():
+                writer.writerow({'kind': 'phase', 'name': name, 'value': p['seconds'], 'calls': p['calls'], 'peak_rss_mb': p['peak_rss_mb']})
+            for name, value in r['counters'].items():
+                writer.writerow({'kind': 'counter', 'name': name, 'value': value})
+            for name, value in r.get('totals', {}).items():
+                writer.writerow({'kind': 'total', 'name': name, 'value': value})
+        return r
+
+    def log(self):
+        for name, p in self.phases.items():
+            logger.info(f"Phase {name}: {p['seconds']:.3f}s in {p['calls']} calls, peak RSS {p['peak_rss_mb']:.1f}MB")
+        for name, value in self.counters.items():
+            logger.info(f'Counter {name}: {value}')
+
+
+def enable():
+    global _current
+    _current = Instrumentation()
+    return _current
+
+
+def disable():
+    # Returns the instrumentation of the run, None if it was not enabled
+    global _current
+    instrumentation, _current = _current, None
+    return instrumentation
+
+
+def current():
+    return _current
+
+
+def phase(name):
+    return _null_phase if _current is None else _current.phase(name)
+
+
+def count(name, value=1):
+    if _current is not None:
+        _current.count(name, value)
+
+
+def maximum(name, value):
+    if _current is not None:
+        _current.maximum(name, value)
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_instrumentation():
+    import os, tempfile
+
+    # Disabled, nothing is recorded
+    with phase('sweep'):
+        count('works', 10)
+    assert disable() is None, 'Instrumentation should be disabled by default'
+
+    instrumentation = enable()
+    with phase('green'):
+        with phase('green'):
+            count('pv_rows_read', 3)
+        count('pv_rows_read', 2)
+        maximum('max_concurrent_works', 4)
+        maximum('max_concurrent_works', 2)
+    with phase('sweep'):
+        pass
+    assert disable() is instrumentation, 'The enabled instrumentation should be returned'
+
+    assert instrumentation.phases['green']['calls'] == 1, 'Nested phases should be timed once'
+    assert set(instrumentation.phases) == {'green', 'sweep'}, 'Every phase should be recorded'
+    assert instrumentation.counters == {'pv_rows_read': 5, 'max_concurrent_works': 4}, 'Counters should be added and maximized'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, 'run.json')
+        instrumentation.save(json_file, {'total_energy': 1.5})
+        with open(json_file) as f:
+            r = json.load(f)
+        assert r['totals'] == {'total_energy': 1.5} and r['counters']['pv_rows_read'] == 5, 'JSON should have counters and totals'
+
+        csv_file = os.path.join(tmp_dir, 'run.csv')
+        instrumentation.save(csv_file, {'total_energy': 1.5})
+        with open(csv_file) as f:
+            rows = list(csv.DictReader(f))
+        assert [row['kind'] for row in rows] == ['run', 'phase', 'phase', 'counter', 'counter', 'total'], 'CSV should have a row for every value'
+
+
+def __test_instrumented_energy_usage():
+    # The module used by energy_usage, that is not __main__ when this file is run
+    import instrumentation
+    from energy_usage import EnergyUsage, calc_green_energy_usage
+    from vectorized_energy_usage import calc_energy_trace, calc_green_energy_usage_batch
+
+    starts = [0, 5, 21, 22, 35]
+    ends = [5, 15, 26, 27, 40]
+    powers = [10, 100, 7, 9, 1]
+    green_intervals = [(3, 7), (7, 9), (20, 50), (22, 9), (40, 7)]
+
+    e = EnergyUsage()
+    e.add_works(starts, ends, powers)
+
+    for calc, calc_green in [
+        (e.calc, lambda energy_trace: calc_green_energy_usage(energy_trace, iter(green_intervals).__next__)),
+        (lambda: calc_energy_trace(starts, ends, powers), lambda energy_trace: calc_green_energy_usage_batch(energy_trace, *zip(*green_intervals)))
+    ]:
+        recorded = instrumentation.enable()
+        calc_green(calc()[1])
+        instrumentation.disable()
+
+        counters = recorded.counters
+        assert {'sweep', 'green'} <= set(recorded.phases), 'Sweep and green phases should be recorded'
+        assert counters['works'] == 5 and counters['instants'] == 9, 'Works and instants should be counted'
+        assert counters['max_concurrent_works'] == 2, 'Works C and D should be running at the same time'
+        assert counters['pv_rows_read'] == 5, 'Every green interval should be read'
+        # 3 and 7 split (0, 5] and (5, 15], 20 splits (15, 21]; 22 and 40 are ends of the trace intervals
+        assert counters['green_interval_splits'] == 3, f"Green intervals 3, 7 and 20 should split the trace, not {counters['green_interval_splits']}"
+
+
+if __name__ == '__main__':
+
+    __test_instrumentation()
+    __test_instrumented_energy_usage()
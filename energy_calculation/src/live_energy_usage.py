@@ -0,0 +1,243 @@
+import logging, math, sys
+
+from energy_usage import EnergyUsage, GreenEnergyUsage, InstantTree
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('live_energy_usage')
+
+
+def microsecond_to_second(microsecond):
+    return microsecond / 1000000
+
+
+class LiveEnergyUsage:
+    # EnergyUsage of a workflow that is still running. Works are added as
+    # their events arrive, and the instants before the watermark (no work
+    # added later may start before it) are finalized: their intervals are
+    # added to the running totals, and to the green accounting when there is
+    # a next_green_interval (as in calc_green_energy_usage), and removed from
+    # the InstantTree. Only the instants after the watermark stay in memory.
+    #
+    # The totals are the ones of EnergyUsage.calc and calc_green_energy_usage
+    # over the finalized part of the trace.
+
+    def __init__(self, next_green_interval=None):
+        self.instants = InstantTree()
+        self.green = GreenEnergyUsage(next_green_interval) if next_green_interval is not None else None
+
+        self.watermark = -math.inf
+        self.lastTime = 0
+        self.active_works = 0
+        self.power = 0
+
+        self.total_energy_in_joules = 0
+        self.finalized_instants = 0
+        self.late_works = 0
+
+    def add_work(self, name, start, end, power):
+        if start < self.watermark:
+            raise ValueError(f'Work {name} starts at {start}s, before the watermark {self.watermark}s')
+        self.instants.add_work(name, start, end, power)
+
+    def advance(self, watermark):
+        # Finalizes the instants before watermark. The instant at watermark is
+        # kept, works may still start at it.
+        instants = self.instants.instants
+        while instants and instants.min_key() < watermark:
+            _, instant = instants.pop_min()
+            self.__finalize(instant)
+        self.watermark = max(self.watermark, watermark)
+
+    def __finalize(self, instant):
+        # Same step of EnergyUsage.calc
+        time = instant.timestamp - self.lastTime
+        if self.active_works:
+            energy = time * self.power # 1W * 1s = 1J
+            self.total_energy_in_joules += energy
+            power = self.power
+        else:
+            power = 0
+
+        if self.green is not None:
+            self.green.add(time, power)
+
+        self.lastTime = instant.timestamp
+        self.finalized_instants += 1
+
+        # Running power of the active works. Reset when none is active, so
+        # the rounding of the additions does not build up past an idle time.
+        for work in instant.worksBeginning:
+            self.power += work.power
+        for work in instant.worksEnding:
+            self.power -= work.power
+
+        self.active_works += len(instant.worksBeginning) - len(instant.worksEnding)
+        if self.active_works == 0:
+            self.power = 0
+
+    def consume(self, events, power_model, lag=0):
+        # Adds the complete events (ph == 'X') of a Chrome trace as they
+        # arrive, for instance from trace_loader.follow_trace_events or
+        # iter_json_lines. Works are assumed to arrive at most lag seconds
+        # after the latest start seen; works older than that are counted in
+        # late_works and ignored.
+        latest_start = -math.inf
+        for event in events:
+            if event['ph'] != 'X':
+                continue
+
+            start = microsecond_to_second(float(event['ts']))
+            end = start + microsecond_to_second(float(event['dur']))
+            power = power_model.power(event.get('name', ''), event.get('pid', -1), event.get('tid', -1))
+
+            try:
+                self.add_work('X', start, end, power)
+            except ValueError:
+                self.late_works += 1
+                continue
+
+            if start > latest_start:
+                latest_start = start
+                self.advance(latest_start - lag)
+
+    def finish(self):
+        # Finalizes every instant, as the end of the trace
+        self.advance(math.inf)
+        return self.totals()
+
+    def totals(self):
+        r = {
+            'time': self.lastTime,
+            'power': self.power,
+            'active_works': self.active_works,
+            'pending_instants': len(self.instants),
+            'late_works': self.late_works,
+            'total_energy': self.total_energy_in_joules
+        }
+        if self.green is not None:
+            r.update(self.green.result())
+        return r
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_live_energy_usage():
+    import random
+    from energy_usage import calc_green_energy_usage
+    from power_model import PowerModel
+
+    rng = random.Random(3)
+
+    events = []
+    for i in range(3000):
+        start = rng.randint(0, 4000) / 4
+        events.append({'ph': 'X', 'name': rng.choice(['A', 'B']), 'ts': start * 1000000, 'dur': rng.randint(0, 40) / 4 * 1000000})
+    events.sort(key=lambda e: e['ts'])
+
+    power_model = PowerModel(35/4, names={'B': 2})
+    green_intervals = [(300 * (i + 1), (i * 7) % 50) for i in range(10)]
+
+    def next_green_interval_factory():
+        i = iter(green_intervals)
+        return lambda: next(i)
+
+    reference = EnergyUsage()
+    for event in events:
+        start = event['ts'] / 1000000
+        reference.add_work('X', start, start + event['dur'] / 1000000, power_model.power(event['name']))
+    expected_total, energy_trace = reference.calc()
+    expected = calc_green_energy_usage(energy_trace, next_green_interval_factory())
+
+    e = LiveEnergyUsage(next_green_interval_factory())
+    e.consume(events, power_model)
+    assert e.totals()['total_energy'] <= expected_total, 'Only the finalized instants should be accounted'
+    assert e.totals()['pending_instants'] < 50, 'Finalized instants should be removed'
+
+    r = e.finish()
+    assert r['total_energy'] == expected_total, f'Total energy {r["total_energy"]} should be {expected_total}'
+    for key, value in expected.items():
+        assert r[key] == value, f'{key} should be {value} instead of {r[key]}'
+
+    # Works that arrive after the watermark
+    e = LiveEnergyUsage()
+    e.consume(events[:10] + [events[0]], power_model)
+    assert e.late_works == 1, 'Late work should be counted'
+
+    e = LiveEnergyUsage()
+    e.consume(events[:10] + [events[0]], power_model, lag=1000)
+    assert e.late_works == 0, 'Work within the lag should be accepted'
+
+
+def __test_live_energy_usage_running_power():
+    import random
+    from power_model import PowerModel
+
+    # Powers without an exact binary value, so the running power has rounding
+    # errors that must not last past an idle time
+    rng = random.Random(7)
+    power_model = PowerModel(35/8, names={'B': 45/8, 'C': 0.1})
+
+    events = []
+    for burst in range(50):
+        for i in range(rng.randint(1, 20)):
+            start = 100 * burst + rng.randint(0, 160) / 8
+            events.append({'ph': 'X', 'name': rng.choice(['A', 'B', 'C']), 'ts': start * 1000000, 'dur': rng.randint(1, 240) / 8 * 1000000})
+    events.sort(key=lambda e: e['ts'])
+
+    reference = EnergyUsage()
+    for event in events:
+        start = event['ts'] / 1000000
+        reference.add_work('X', start, start + event['dur'] / 1000000, power_model.power(event['name']))
+    expected_total, energy_trace = reference.calc()
+
+    e = LiveEnergyUsage()
+    for event in events:
+        e.consume([event], power_model)
+        if e.totals()['active_works'] == 0:
+            assert e.power == 0, f'Power should be 0 without active works, not {e.power}'
+
+    r = e.finish()
+    assert r['power'] == 0 and r['active_works'] == 0, 'Power should be 0 at the end of the trace'
+    assert abs(r['total_energy'] - expected_total) < 1e-9 * expected_total, f'Total energy {r["total_energy"]} should be {expected_total}'
+
+
+def __test_follow_trace_events():
+    import json, os, tempfile, threading, time
+    from trace_loader import follow_trace_events
+
+    events = [{'ph': 'X', 'name': 'A', 'ts': i * 1000000, 'dur': 500000} for i in range(20)]
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    def write():
+        # The trace is written while it is read
+        with open(path, 'w') as f:
+            f.write('{"traceEvents": [')
+            for i, event in enumerate(events):
+                f.write((',' if i else '') + json.dumps(event))
+                f.flush()
+                time.sleep(0.005)
+            f.write(']}')
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        found = list(follow_trace_events(path, poll_interval=0.001))
+    finally:
+        writer.join()
+        os.remove(path)
+
+    assert found == events, 'Followed events should be the written events'
+
+
+if __name__ == '__main__':
+
+    __test_live_energy_usage()
+    __test_live_energy_usage_running_power()
+    __test_follow_trace_events()
@@ -1,15 +1,35 @@
-import json
-import logging, sys
+import logging, os, sys
 
 from datetime import datetime
 
+import numpy as np
+
+import instrumentation
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'photovolta', 'src'))
+
 from energy_usage import EnergyUsage
+from battery import Battery
 from energy_usage import calc_green_energy_usage
+from live_energy_usage import LiveEnergyUsage
+from power_model import PowerModel, calc_energy_breakdown
+from node_energy_usage import calc_nodes_green_energy_usage, load_green_intervals
+from pv_area_sweep import calc_pv_area_sweep
+from pv_series import open_pv_series
+from repeated_trace import RepeatedTrace
+from sharded_energy_usage import ShardedEnergyUsage
+from start_offset_sweep import calc_start_offset_sweep, best_start_offsets, save_start_offset_sweep
+from trace_loader import follow_trace_events, iter_trace_events, load_complete_events_table
+from trace_cache import TraceCache
+from vectorized_energy_usage import EnergyTrace, VectorizedEnergyUsage, as_energy_trace, calc_green_energy_usage_chunked, coalesce_energy_trace
 
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
 logger = logging.getLogger('main')
 
+POWER_IN_W = 35/4 # Power of every complete event
+POWER_MODEL = PowerModel(POWER_IN_W) # Same power for every name, rank and thread
+
 
 def to_date_time(date_time_str):
     date_format = '%Y-%m-%d %H:%M:%S'
@@ -27,17 +47,25 @@ def print_energy(description, energy_in_joules):
     
     
 
-def calc_energy_usage(events_file):
+def calc_energy_usage(events_file, vectorized=False, cache=None, power_model=POWER_MODEL):
+    if cache is not None:
+        return calc_energy_usage_cached(events_file, vectorized, cache, power_model)
+
+    if vectorized:
+        return calc_energy_usage_vectorized(events_file, power_model)
+
     e = EnergyUsage()
 
     logger.info('Loading events...')
-    f = open(events_file)
-    data = json.load(f)
-    
+
+    # Events are parsed incrementally and added to the tree while the file is
+    # read, so the whole trace is never held in memory
     count = 0
-    for event in data['traceEvents']:
-        if event['ph'] == 'X':
-            
+    with instrumentation.phase('parse'):
+        for event in iter_trace_events(events_file):
+            if event['ph'] != 'X':
+                continue
+                
             timestamp = microsecond_to_second(float(event['ts']))
             duration = microsecond_to_second(float(event['dur']))
 
@@ -46,10 +74,10 @@ def calc_energy_usage(events_file):
             start = timestamp
             end = timestamp + duration
             
-            e.add_work('X', start, end, 35/4)
+            e.add_work('X', start, end, power_model.power(event.get('name', ''), event.get('pid', -1), event.get('tid', -1)))
             
+    instrumentation.count('events', count)
     logger.info(f'{count} events loaded')
-    f.close()
 
     logger.info('Calculating energy usage intervals...')
     total_energy_in_joules, energy_trace = e.calc()
@@ -58,55 +86,243 @@ def calc_energy_usage(events_file):
     return total_energy_in_joules, energy_trace
    
    
-def calc_pv_energy_usage_2(energy_trace, pv_energy_file_name, pv_area, offset = 0):
-    
-    def read_pv_energy_line(pv_energy_file):
-        line = next(pv_energy_file, None)
-        if line is None:
-            raise Exception('End of pv energy file')
-            
-        row = line.strip().split(',')
-        return to_date_time(row[0]), int(row[1]), float(row[2])
-        
+
+def load_works(events_file, power_model=POWER_MODEL):
+    logger.info('Loading events...')
+    events = load_complete_events_table(events_file)
+
+    starts = microsecond_to_second(events.column('ts'))
+    ends = starts + microsecond_to_second(events.column('dur'))
+    powers = power_model.powers(events)
+
+    logger.info(f'{len(events)} events loaded')
+    return starts, ends, powers
+
+
+def print_energy_breakdown(events_file, power_model=POWER_MODEL, key='pid'):
+    events = load_complete_events_table(events_file)
+    breakdown = calc_energy_breakdown(events, power_model.powers(events), key)
+    for group, energy_in_joules in breakdown.items():
+        print_energy(f'Energy of {key} {group}', energy_in_joules)
+    return breakdown
+
+
+def calc_works_energy_usage(starts, ends, powers, vectorized=True):
+    e = VectorizedEnergyUsage() if vectorized else EnergyUsage()
+    e.add_works(starts, ends, powers)
+
+    logger.info('Calculating energy usage intervals...')
+    total_energy_in_joules, energy_trace = e.calc()
+    e.clear()
+
+    return total_energy_in_joules, energy_trace
+
+
+def calc_energy_usage_vectorized(events_file, power_model=POWER_MODEL):
+    starts, ends, powers = load_works(events_file, power_model)
+    return calc_works_energy_usage(starts, ends, powers)
+
+
+def calc_energy_usage_cached(events_file, vectorized, cache, power_model=POWER_MODEL):
+    # Skips the parsing of the trace (and the sweep, if the energy trace was
+    # stored too) when the same trace was already used with the same power
+    # model and engine
+    key = cache.key(events_file, power_model, vectorized=vectorized)
+    entry = cache.load(key)
+
+    if entry is not None and 'energies' in entry:
+        energy_trace = EnergyTrace(entry['times'], entry['trace_powers'], entry['energies'])
+        return entry['total_energy'].item(), energy_trace
+
+    if entry is not None:
+        starts, ends, powers = entry['starts'], entry['ends'], entry['powers']
+    else:
+        starts, ends, powers = load_works(events_file, power_model)
+
+    total_energy_in_joules, energy_trace = calc_works_energy_usage(starts, ends, powers, vectorized)
+
+    if entry is None or cache.store_energy_trace:
+        arrays = {'starts': starts, 'ends': ends, 'powers': powers}
+        if cache.store_energy_trace:
+            trace = as_energy_trace(energy_trace)
+            arrays.update(
+                times=trace.times,
+                trace_powers=trace.powers,
+                energies=trace.energies,
+                total_energy=np.float64(total_energy_in_joules)
+            )
+        cache.store(key, **arrays)
+
+    return total_energy_in_joules, energy_trace
+
+
+def pv_energy_intervals(pv_series, pv_area, row=0):
+    # next_green_interval of calc_green_energy_usage over the rows of the series
+    pv_intervals = iter(zip(
+        pv_series.intervals[row:].tolist(),
+        pv_series.irradiance[row:].tolist()
+    ))
+
     def next_pv_energy_interval():
-        d, pv_interval_time, solar_irradiance = read_pv_energy_line(pv_energy_file)
+        pv_interval = next(pv_intervals, None)
+        if pv_interval is None:
+            raise Exception('End of pv energy file')
+
+        pv_interval_time, solar_irradiance = pv_interval
         pv_available_power = pv_area * solar_irradiance
         return pv_interval_time, pv_available_power
-        
-        
-    pv_energy_file = open(pv_energy_file_name)
 
-    # ignore header
-    next(pv_energy_file)
+    return next_pv_energy_interval
 
+
+def calc_live_pv_energy_usage(events_file, pv_energy_file_name, pv_area, offset=0, lag=0):
+    # Follows a trace that is still being written, finalizing the instants
+    # lag seconds before the latest work
+    pv_series = open_pv_series(pv_energy_file_name)
+    row = pv_series.index_of(offset) + 1 if offset > 0 else 0
+
+    e = LiveEnergyUsage(pv_energy_intervals(pv_series, pv_area, row))
+    e.consume(follow_trace_events(events_file), POWER_MODEL, lag)
+
+    r = e.finish()
+    if r['late_works'] > 0:
+        logger.warning(f"{r['late_works']} works arrived after the watermark and were ignored")
+    print_results(r)
+    return r
+
+
+def calc_pv_energy_usage_2(energy_trace, pv_energy_file_name, pv_area, offset = 0, batch = False, battery = None):
+
+    # The CSV is converted once to a memory-mapped series, so the offset is
+    # reached by a seek instead of reading and parsing every row before it
+    pv_series = open_pv_series(pv_energy_file_name)
+
+    row = 0
     if offset > 0:
-        pv_interval_time = 0
-        while pv_interval_time < offset:
-            d, pv_interval_time, solar_irradiance = read_pv_energy_line(pv_energy_file)
+        # The first row with interval_in_seconds >= offset is skipped too
+        row = pv_series.index_of(offset) + 1
 
-    r = calc_green_energy_usage(energy_trace, next_pv_energy_interval)
+    if batch:
+        pv_interval_times, pv_available_powers = load_green_intervals(pv_series, pv_area, offset)
+        tiles = energy_trace.tiles() if hasattr(energy_trace, 'tiles') else [energy_trace]
+        r = calc_green_energy_usage_chunked(tiles, pv_interval_times, pv_available_powers, battery)
+    else:
+        r = calc_green_energy_usage(energy_trace, pv_energy_intervals(pv_series, pv_area, row), battery)
     
+    print_results(r)
+
+    return r
+
+
+def print_results(r):
     print_energy('Total Energy', r['total_energy'])
     print_energy('Total Brown Energy Used', r['total_brown_energy_used'])
     print_energy('Total Green Energy Used', r['total_green_energy_used'])
     print_energy('Total Green Energy Not Used', r['total_green_energy_not_used'])
+    if 'battery_state_of_charge' in r:
+        print_energy('Total Battery Charged', r['total_battery_charged'])
+        print_energy('Total Battery Discharged', r['total_battery_discharged'])
+        print_energy('Battery State of Charge', r['battery_state_of_charge'])
+
+
+def calc_nodes_pv_energy_usage(events_file, processors, offset=0):
+    # One trace and one PV source per node (rank of the trace)
+    r = calc_nodes_green_energy_usage(events_file, processors, POWER_MODEL, offset)
 
-    pv_energy_file.close()
+    for node in r['nodes']:
+        logger.info(f"Node {node['rank']} (pid {node['pid']}, {node['pv_energy_file']})")
+        print_results(node)
+
+    logger.info('All nodes')
+    print_results(r['total'])
+
+    return r
     
 
 if __name__ == '__main__':
 
-    #events_file = '../data/OMPC_matmul_trace_data.json'
-    events_file = '../data/OMPC_matmul_trace_data_510x.json'
+    events_file = '../data/OMPC_matmul_trace_data.json'
+    #events_file = '../data/OMPC_matmul_trace_data_510x.json'
+    repeat = 255 * 2 # 5h, the trace of increase_dataset.py without writing it
 
     pv_energy_file = './../../photovolta/data/photovolta_2016_part_1.csv'
     pv_area = 1
     offset = 29400 #start time
+    vectorized = True # False to use the EnergyUsage (AVL tree) reference
+    sweep_offsets = False # Green usage for every start time of the PV file
+    sweep_areas = False # Green usage for every PV area of pv_areas
+    pv_areas = np.arange(0.25, 50.25, 0.25)
+    cache = TraceCache() # None to always parse the trace
+    coalesce = True # Merge the intervals with the same power before the green usage
+    rank_breakdown = False # Energy of each rank (pid) of the trace
+    shard_size = None # Seconds of trace per shard, to sweep traces bigger than the memory
+    live = False # Follow events_file while it is written
+    per_node = False # Green energy usage of each rank with its own PV source (processors)
+    battery = None # Battery(capacity in J, ...) storing the green energy not used, as Battery(3600 * 1000, max_charge_power=500)
+    output_dir = '../data/results' # Tables of the sweeps and instrumentation, not versioned
+    instrument = None # JSON (or .csv) file for the timings and counters of the phases, as os.path.join(output_dir, 'instrumentation.json')
+
+    processors = [
+        {
+            'processor_id': i,
+            'pv_energy_file': f'./../../photovolta/data/ompc/compressed/photovolta_compressed_interval_{i + 1}.csv',
+            'pv_area': 1
+        }
+        for i in range(5)
+    ]
+
+    if sweep_offsets or sweep_areas or instrument is not None:
+        os.makedirs(output_dir, exist_ok=True)
 
-    total_energy_in_joules, energy_trace = calc_energy_usage(events_file)
+    if instrument is not None:
+        instrumentation.enable()
+
+    if repeat > 1:
+        total_energy_in_joules, energy_trace = RepeatedTrace(events_file, repeat, POWER_MODEL).calc(coalesce=coalesce)
+    elif shard_size is not None:
+        sharded = ShardedEnergyUsage(shard_size)
+        sharded.add_trace(events_file, POWER_MODEL)
+        total_energy_in_joules, energy_trace = sharded.calc(workers=None)
+    else:
+        total_energy_in_joules, energy_trace = calc_energy_usage(events_file, vectorized, cache, POWER_MODEL)
+        if coalesce:
+            energy_trace = coalesce_energy_trace(energy_trace)
     
     watts_hour = total_energy_in_joules / 3600
     logger.info('Total Energy: {:.2f}Wh {:.2f}J'.format(watts_hour, total_energy_in_joules))
+
+    if rank_breakdown:
+        print_energy_breakdown(events_file, POWER_MODEL)
  
     logger.info('Calculating green energy usage...')
-    calc_pv_energy_usage_2(energy_trace, pv_energy_file, pv_area, offset)
+    r = calc_pv_energy_usage_2(energy_trace, pv_energy_file, pv_area, offset, batch=vectorized, battery=battery)
+
+    if sweep_offsets:
+        logger.info('Calculating green energy usage for every start offset...')
+        pv_series = open_pv_series(pv_energy_file)
+        table = calc_start_offset_sweep(energy_trace, pv_series.intervals, pv_area * pv_series.irradiance.astype(np.float64), workers=None)
+        save_start_offset_sweep(table, os.path.join(output_dir, 'start_offset_sweep.csv'))
+
+        for row in best_start_offsets(table):
+            logger.info('Start at {:.0f}s: Brown {:.2f}J Green {:.2f}J'.format(row['offset'], row['total_brown_energy_used'], row['total_green_energy_used']))
+
+    if sweep_areas:
+        logger.info('Calculating green energy usage for every PV area...')
+        pv_interval_times, pv_irradiance = load_green_intervals(open_pv_series(pv_energy_file), 1, offset)
+        table = calc_pv_area_sweep(energy_trace, pv_interval_times, pv_irradiance, pv_areas)
+        save_start_offset_sweep(table, os.path.join(output_dir, 'pv_area_sweep.csv'))
+
+    if live:
+        logger.info('Following the trace...')
+        # The events of this trace are grouped by process, so they arrive up
+        # to the whole trace (~17s) late
+        calc_live_pv_energy_usage(events_file, pv_energy_file, pv_area, offset, lag=20)
+
+    if per_node:
+        logger.info('Calculating green energy usage of each node...')
+        calc_nodes_pv_energy_usage(events_file, processors)
+
+    if instrument is not None:
+        recorded = instrumentation.disable()
+        recorded.log()
+        recorded.save(instrument, r)
@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging, os, sys, tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'photovolta', 'src'))
+
+from pv_series import open_pv_series
+from trace_loader import load_complete_events_table
+from vectorized_energy_usage import calc_energy_trace, calc_green_energy_usage_batch
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('node_energy_usage')
+
+TOTAL_KEYS = ['total_energy', 'total_brown_energy_used', 'total_green_energy_used', 'total_green_energy_not_used']
+
+
+def microsecond_to_second(microsecond):
+    return microsecond / 1000000
+
+
+def load_green_intervals(pv_series, pv_area, offset=0):
+    # Green intervals of the PV series from offset, as read by
+    # main.calc_pv_energy_usage_2: the first row with interval >= offset is
+    # skipped too
+    row = 0
+    if offset > 0:
+        row = pv_series.index_of(offset) + 1
+
+    return pv_series.intervals[row:].astype(np.float64), pv_area * pv_series.irradiance[row:].astype(np.float64)
+
+
+def split_works_by_rank(events, power_model):
+    # Works of each rank, where the rank of a pid is its position in the
+    # sorted pids of the trace. Returns the pids and the works (starts, ends
+    # and powers in a 3 x n array) sorted by rank, with the bounds of each rank.
+    ranks_pids, rank = np.unique(events.column('pid'), return_inverse=True)
+    order = np.argsort(rank.ravel(), kind='stable')
+
+    starts = microsecond_to_second(events.column('ts'))
+    ends = starts + microsecond_to_second(events.column('dur'))
+    works = np.stack((starts, ends, power_model.powers(events)))[:, order]
+
+    bounds = np.searchsorted(rank.ravel()[order], np.arange(len(ranks_pids) + 1), side='left')
+    return ranks_pids.tolist(), works, bounds
+
+
+def _calc_node_green_energy_usage(works_file, a, b, pv_series, pv_area, offset):
+    # Works are read from the memory-mapped file written by the parent, as
+    # the PV series
+    works = np.load(works_file, mmap_mode='r')
+    total_energy_in_joules, energy_trace = calc_energy_trace(works[0, a:b], works[1, a:b], works[2, a:b])
+
+    green_interval_times, green_available_powers = load_green_intervals(pv_series, pv_area, offset)
+    return calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers)
+
+
+def calc_nodes_green_energy_usage(events_file, processors, power_model, offset=0, workers=None):
+    # Green energy usage of each node of the trace, where the node of the rank
+    # i uses the PV source of the processor with processor_id i (a dict with
+    # processor_id, pv_energy_file and pv_area, as in
+    # generate_ompc_moheft_green_variables.py). The nodes are evaluated in a
+    # process pool. Returns the results of each node and their sum.
+    events = load_complete_events_table(events_file)
+    ranks_pids, works, bounds = split_works_by_rank(events, power_model)
+
+    processors = {processor['processor_id']: processor for processor in processors}
+    missing = [rank for rank in range(len(ranks_pids)) if rank not in processors]
+    if missing:
+        raise ValueError(f'No PV source for the ranks {missing}')
+
+    # Converted once here, so workers only map the series
+    pv_series = [open_pv_series(processors[rank]['pv_energy_file']) for rank in range(len(ranks_pids))]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        works_file = os.path.join(tmp_dir, 'works.npy')
+        np.save(works_file, works)
+
+        args = [
+            [works_file] * len(ranks_pids),
+            bounds[:-1].tolist(),
+            bounds[1:].tolist(),
+            pv_series,
+            [processors[rank]['pv_area'] for rank in range(len(ranks_pids))],
+            [offset] * len(ranks_pids)
+        ]
+        if workers == 1 or len(ranks_pids) <= 1:
+            results = list(map(_calc_node_green_energy_usage, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_calc_node_green_energy_usage, *args))
+
+    nodes = []
+    for rank, (pid, r) in enumerate(zip(ranks_pids, results)):
+        node = {'rank': rank, 'pid': pid, 'pv_energy_file': processors[rank]['pv_energy_file']}
+        node.update(r)
+        nodes.append(node)
+
+    total = {key: sum(node[key] for node in nodes) for key in TOTAL_KEYS}
+    return {'nodes': nodes, 'total': total}
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_calc_nodes_green_energy_usage():
+    import json
+    from power_model import PowerModel
+
+    data = {
+        'traceEvents': [
+            {'ph': 'X', 'name': 'A', 'pid': 20, 'tid': 1, 'ts': 0, 'dur': 5000000},
+            {'ph': 'X', 'name': 'B', 'pid': 10, 'tid': 1, 'ts': 1000000, 'dur': 2000000},
+            {'ph': 'M', 'name': 'process_name', 'pid': 10},
+            {'ph': 'X', 'name': 'C', 'pid': 20, 'tid': 2, 'ts': 2000000, 'dur': 4000000},
+            {'ph': 'X', 'name': 'D', 'pid': 10, 'tid': 1, 'ts': 6000000, 'dur': 1000000}
+        ]
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_file = os.path.join(tmp_dir, 'trace.json')
+        with open(events_file, 'w') as f:
+            json.dump(data, f)
+
+        processors = []
+        for processor_id, irradiance in enumerate([[5, 5, 5, 0, 0], [10, 0, 3, 3, 3]]):
+            pv_energy_file = os.path.join(tmp_dir, f'pv_{processor_id}.csv')
+            with open(pv_energy_file, 'w') as f:
+                f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+                for i, value in enumerate(irradiance):
+                    f.write(f'2016-04-12 00:{i:02d}:01,{2 * (i + 1)},{value}\n')
+            processors.append({'processor_id': processor_id, 'pv_energy_file': pv_energy_file, 'pv_area': processor_id + 1})
+
+        power_model = PowerModel(2, names={'C': 4})
+
+        # Expected results of each node, rank 0 is the pid 10
+        expected = []
+        for pid, processor in zip([10, 20], processors):
+            starts, ends, powers = zip(*[
+                (e['ts'] / 1000000, (e['ts'] + e['dur']) / 1000000, power_model.power(e['name'], e['pid'], e['tid']))
+                for e in data['traceEvents'] if e['ph'] == 'X' and e['pid'] == pid
+            ])
+            _, energy_trace = calc_energy_trace(starts, ends, powers)
+            green_interval_times, green_available_powers = load_green_intervals(open_pv_series(processor['pv_energy_file']), processor['pv_area'])
+            expected.append(calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers))
+
+        for workers in [1, 2]:
+            r = calc_nodes_green_energy_usage(events_file, processors, power_model, workers=workers)
+
+            assert [node['pid'] for node in r['nodes']] == [10, 20], 'Nodes should be sorted by rank'
+            for node, node_expected in zip(r['nodes'], expected):
+                for key in TOTAL_KEYS:
+                    assert abs(node[key] - node_expected[key]) < 1e-9, f'Node {node["rank"]} {key} should be {node_expected[key]}'
+
+            assert abs(r['total']['total_energy'] - (2 * 3 + 2 * 5 + 4 * 4)) < 1e-9, 'Total energy should be the sum of the nodes'
+
+        try:
+            calc_nodes_green_energy_usage(events_file, processors[:1], power_model)
+            assert False, 'Ranks without PV source should not be accepted'
+        except ValueError:
+            pass
+
+
+def __test_load_green_intervals():
+    import random
+    from energy_usage import calc_green_energy_usage
+    from main import pv_energy_intervals
+
+    rng = random.Random(5)
+    irradiance = [rng.choice([0.0, 0.1, 25.3, 123.7, 7.9, 1000.0]) for _ in range(200)]
+
+    starts = [rng.randint(0, 8000) / 8 for _ in range(400)]
+    ends = [start + rng.randint(0, 400) / 8 for start in starts]
+    powers = [rng.choice([35 / 8, 45 / 8, 0.1]) for _ in starts]
+    _, energy_trace = calc_energy_trace(starts, ends, powers)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pv_energy_file = os.path.join(tmp_dir, 'pv.csv')
+        with open(pv_energy_file, 'w') as f:
+            f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+            for i, value in enumerate(irradiance):
+                f.write(f'2016-04-12 00:00:01,{10 * (i + 1)},{value}\n')
+
+        for offset, pv_area in [(0, 1), (40, 2.5), (55, 0.3)]:
+            # Green intervals of the CSV, read as the first version of
+            # main.calc_pv_energy_usage_2 did
+            with open(pv_energy_file) as f:
+                rows = [line.strip().split(',') for line in f.readlines()[1:]]
+            csv_intervals = iter([(int(row[1]), pv_area * float(row[2])) for row in rows if offset == 0 or int(row[1]) > offset])
+            expected = calc_green_energy_usage(energy_trace, csv_intervals.__next__)
+
+            pv_series = open_pv_series(pv_energy_file)
+            row = pv_series.index_of(offset) + 1 if offset > 0 else 0
+            r = calc_green_energy_usage(energy_trace, pv_energy_intervals(pv_series, pv_area, row))
+            assert r == expected, f'Green usage at offset {offset} should be the one of the CSV values'
+
+            r = calc_green_energy_usage_batch(energy_trace, *load_green_intervals(pv_series, pv_area, offset))
+            for key, value in expected.items():
+                assert abs(r[key] - value) < 1e-9, f'{key} at offset {offset} should be {value} instead of {r[key]}'
+
+
+if __name__ == '__main__':
+
+    __test_calc_nodes_green_energy_usage()
+    __test_load_green_intervals()
@@ -0,0 +1,124 @@
+import logging, sys
+
+import numpy as np
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('power_model')
+
+
+class PowerModel:
+    # Power (W) of the complete events of a trace. The power of an event is,
+    # by priority:
+    #   1. the power of its thread, threads[(pid, tid)]
+    #   2. the power of its name in the profile of its rank (pid)
+    #   3. the default power of the profile of its rank
+    # Ranks without a profile in ranks use the default profile, made of
+    # default_power and names. A profile is a dict with 'default' (W) and,
+    # optionally, 'names' (name -> W).
+
+    def __init__(self, default_power, names=None, profiles=None, ranks=None, threads=None):
+        self.default_profile = {'default': default_power, 'names': dict(names or {})}
+        self.profiles = {key: {'default': p['default'], 'names': dict(p.get('names', {}))} for key, p in (profiles or {}).items()}
+        self.ranks = dict(ranks or {})
+        self.threads = dict(threads or {})
+
+    def __repr__(self):
+        # Used as cache key, so it must not depend on the order of the dicts
+        def profile_repr(p):
+            return (p['default'], sorted(p['names'].items()))
+
+        return 'PowerModel({!r}, {!r}, {!r}, {!r})'.format(
+            profile_repr(self.default_profile),
+            sorted((key, profile_repr(p)) for key, p in self.profiles.items()),
+            sorted(self.ranks.items()),
+            sorted(self.threads.items())
+        )
+
+    def profile(self, pid):
+        profile_name = self.ranks.get(pid)
+        return self.default_profile if profile_name is None else self.profiles[profile_name]
+
+    def power(self, name, pid=-1, tid=-1):
+        power = self.threads.get((pid, tid))
+        if power is not None:
+            return power
+        profile = self.profile(pid)
+        return profile['names'].get(name, profile['default'])
+
+    def powers(self, events):
+        # Powers of trace_loader.CompleteEvents. The model is evaluated once
+        # for each distinct (name, pid, tid) and the powers of the events are
+        # taken from that lookup table.
+        if len(events) == 0:
+            return np.empty(0, dtype=np.float64)
+
+        keys = np.stack((events.column('name'), events.column('pid'), events.column('tid')), axis=1)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+        table = np.array([self.power(events.names[name], pid, tid) for name, pid, tid in unique_keys.tolist()], dtype=np.float64)
+        return table[inverse.ravel()]
+
+
+def calc_energy_breakdown(events, powers, key='pid'):
+    # Energy (J) of the events grouped by a column of trace_loader.CompleteEvents
+    # (pid, tid or name). Works add their power while they run, so the energy
+    # of a group is the sum of duration * power of its events.
+    energies = events.column('dur') / 1000000 * powers
+
+    groups, inverse = np.unique(events.column(key), return_inverse=True)
+    group_energies = np.bincount(inverse.ravel(), weights=energies, minlength=len(groups))
+
+    if key == 'name':
+        groups = [events.names[code] for code in groups.tolist()]
+    else:
+        groups = groups.tolist()
+    return dict(zip(groups, group_energies.tolist()))
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_power_model():
+    from trace_loader import CompleteEvents
+
+    events = CompleteEvents()
+    for name, pid, tid, dur in [
+        ('Exit / Begin', 1, 1, 1000000),
+        ('Execute / Target Execution', 1, 2, 2000000),
+        ('Execute / Target Execution', 2, 3, 2000000),
+        ('Alloc / Begin', 2, 4, 1000000),
+        ('Alloc / Begin', 2, 3, 1000000)
+    ]:
+        events.append({'ph': 'X', 'name': name, 'pid': pid, 'tid': tid, 'ts': 0, 'dur': dur})
+
+    model = PowerModel(
+        35/4,
+        names={'Exit / Begin': 0},
+        profiles={'performance': {'default': 1, 'names': {'Execute / Target Execution': 45/8}}},
+        ranks={2: 'performance'},
+        threads={(2, 4): 3}
+    )
+
+    powers = model.powers(events)
+    expected = [0, 35/4, 45/8, 3, 1]
+    assert powers.tolist() == expected, f'Powers {powers.tolist()} should be {expected}'
+    assert powers.tolist() == [model.power(events.names[n], p, t) for n, p, t in zip(events.name, events.pid, events.tid)], 'Bulk powers should be the same of power'
+
+    ranks = calc_energy_breakdown(events, powers)
+    assert ranks == {1: 17.5, 2: 11.25 + 3 + 1}, f'Wrong energy per rank {ranks}'
+
+    names = calc_energy_breakdown(events, powers, 'name')
+    assert names['Alloc / Begin'] == 4, f'Wrong energy per name {names}'
+
+    same = PowerModel(35/4, names={'Exit / Begin': 0}, profiles={'performance': {'names': {'Execute / Target Execution': 45/8}, 'default': 1}}, ranks={2: 'performance'}, threads={(2, 4): 3})
+    assert repr(same) == repr(model), 'Equal models should have the same repr'
+    assert repr(PowerModel(35/4)) != repr(model), 'Different models should have different repr'
+
+
+if __name__ == '__main__':
+
+    __test_power_model()
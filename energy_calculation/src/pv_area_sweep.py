@@ -0,0 +1,97 @@
+import logging, sys
+
+import numpy as np
+
+from vectorized_energy_usage import as_energy_trace, calc_green_energy_usage_batch, rebase_green_intervals
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('pv_area_sweep')
+
+CHUNK_SIZE = 1 << 22 # Segments x areas evaluated at once (32MB of float64)
+
+
+def calc_pv_area_sweep(energy_trace, pv_interval_times, pv_irradiance, pv_areas, chunk_size=CHUNK_SIZE):
+    # Green usage of the trace for every PV area. The trace is split once in
+    # the segments of calc_green_energy_usage_batch (for 1 m2) and the green
+    # energy used by each segment and area, min(energy, area * green energy),
+    # is evaluated in blocks of segments x areas of at most chunk_size values.
+    # Traces made of tiles are evaluated one tile at a time, as in
+    # calc_green_energy_usage_chunked.
+    pv_areas = np.asarray(pv_areas, dtype=np.float64)
+
+    tiles = energy_trace.tiles() if hasattr(energy_trace, 'tiles') else [energy_trace]
+    block_rows = max(1, chunk_size // max(len(pv_areas), 1))
+
+    total_energy = 0.0
+    green_energy = 0.0 # for 1 m2
+    green_energy_used = np.zeros(len(pv_areas))
+
+    for tile, tile_pv_interval_times, tile_pv_irradiance in rebase_green_intervals(tiles, pv_interval_times, pv_irradiance):
+        r = calc_green_energy_usage_batch(tile, tile_pv_interval_times, tile_pv_irradiance, return_segments=True)
+        segments = r['segments']
+
+        energy = segments['time'] * segments['power']
+        segment_green_energy = segments['time'] * segments['green_power']
+
+        total_energy += r['total_energy']
+        green_energy += segment_green_energy.sum().item()
+
+        for a in range(0, len(energy), block_rows):
+            green_energy_used += np.minimum(
+                energy[a:a + block_rows, None],
+                segment_green_energy[a:a + block_rows, None] * pv_areas
+            ).sum(axis=0)
+
+    return {
+        'pv_area': pv_areas,
+        'total_energy': np.full(len(pv_areas), total_energy),
+        'total_brown_energy_used': total_energy - green_energy_used,
+        'total_green_energy_used': green_energy_used,
+        'total_green_energy_not_used': pv_areas * green_energy - green_energy_used
+    }
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_calc_pv_area_sweep():
+    from vectorized_energy_usage import EnergyTrace, TiledEnergyTrace
+
+    energy_trace = as_energy_trace([
+        (0, 0, 0),
+        (5, 10, 50),
+        (10, 100, 1000),
+        (6, 0, 0),
+        (1, 7, 7),
+        (4, 16, 64),
+        (1, 9, 9),
+        (8, 0, 0),
+        (5, 1, 5)
+    ])
+
+    green_interval_times = [3, 7, 20, 22, 40]
+    irradiance = [7, 9, 50, 9, 7]
+    areas = [0, 0.5, 1, 2.5, 10]
+
+    tiles = [
+        EnergyTrace(energy_trace.times[a:b], energy_trace.powers[a:b], energy_trace.energies[a:b])
+        for a, b in [(0, 2), (2, 6), (6, 9)]
+    ]
+    tiled_trace = TiledEnergyTrace(lambda: iter(tiles), len(energy_trace))
+
+    for trace, chunk_size in [(energy_trace, CHUNK_SIZE), (energy_trace, 7), (tiled_trace, 3)]:
+        table = calc_pv_area_sweep(trace, green_interval_times, irradiance, areas, chunk_size)
+
+        for i, area in enumerate(areas):
+            expected = calc_green_energy_usage_batch(energy_trace, green_interval_times, np.multiply(area, irradiance))
+            for key, value in expected.items():
+                assert abs(table[key][i] - value) < 1e-9, f'{key} of area {area} should be {value} instead of {table[key][i]}'
+
+
+if __name__ == '__main__':
+
+    __test_calc_pv_area_sweep()
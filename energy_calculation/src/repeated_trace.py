@@ -0,0 +1,202 @@
+import logging, sys
+
+import numpy as np
+
+from trace_loader import CompleteEvents, iter_trace_events
+from vectorized_energy_usage import StreamingEnergyUsage, TiledEnergyTrace, calc_energy_trace, coalesce_energy_trace
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('repeated_trace')
+
+
+def microsecond_to_second(microsecond):
+    return microsecond / 1000000
+
+
+class RepeatedTrace:
+    # Virtual version of the trace written by increase_dataset.py. The
+    # iteration i of the trace has its timestamps shifted by (i+1) * max_ts,
+    # except the first one, where max_ts is the biggest ts of the file. power
+    # is the power of every event or a power_model.PowerModel.
+
+    def __init__(self, events_file, times, power):
+        self.times = times
+        self.power = power
+
+        events = CompleteEvents()
+        self.max_ts = 0
+        self.min_ts = 0
+
+        for event in iter_trace_events(events_file):
+            if 'ts' in event:
+                self.max_ts = max(self.max_ts, event['ts'])
+            if event['ph'] == 'X':
+                events.append(event)
+
+        self.ts = events.ts
+        self.dur = events.dur
+        if hasattr(power, 'powers'):
+            self.powers = power.powers(events)
+        else:
+            self.powers = np.full(len(events), power, dtype=np.float64)
+
+        if len(self.ts) > 0:
+            self.min_ts = min(self.ts)
+
+    def shift(self, i):
+        # In microseconds
+        return 0 if i == 0 else (i + 1) * self.max_ts
+
+    def iter_complete_events(self):
+        # Same (ts, dur) of trace_loader.iter_complete_events on the file
+        # written by increase_dataset.py
+        for i in range(self.times):
+            shift = self.shift(i)
+            for ts, dur in zip(self.ts, self.dur):
+                yield ts + shift, dur
+
+    def tile(self, i):
+        # Works of the iteration i: starts, ends (in seconds) and powers
+        ts = np.frombuffer(self.ts, dtype=np.float64)
+        dur = np.frombuffer(self.dur, dtype=np.float64)
+
+        starts = microsecond_to_second(ts + self.shift(i))
+        ends = starts + microsecond_to_second(dur)
+        return starts, ends, self.powers
+
+    def iter_tiles(self):
+        for i in range(self.times):
+            yield self.tile(i)
+
+    def window_start(self, i):
+        # No work of the iteration i starts before it
+        return microsecond_to_second(self.min_ts + self.shift(i))
+
+    def iter_energy_trace_tiles(self, times=None):
+        # Energy trace of each iteration, from its first instant to the first
+        # instant of the next one. Works still running at the end of an
+        # iteration are carried to the next tile. With times, only the first
+        # iterations are used and the last tile has the works still running.
+        times = self.times if times is None else times
+
+        e = StreamingEnergyUsage()
+        for i in range(times):
+            e.add_works(*self.tile(i))
+            if i + 1 < self.times:
+                yield e.flush(self.window_start(i + 1))
+        yield e.finish()
+
+    def iter_coalesced_energy_trace_tiles(self):
+        for tile in self.iter_energy_trace_tiles():
+            yield coalesce_energy_trace(tile)
+
+    def calc(self, extrapolate=True, coalesce=False):
+        # With extrapolate, the iterations after the first ones, which are
+        # placed max_ts apart, are computed once and repeated. Only the
+        # energy of the first tiles is kept in memory either way. With
+        # coalesce, the tiles are compacted by coalesce_energy_trace.
+        if extrapolate and self.times > 4 and len(self.ts) > 0:
+            first, second, steady, next_steady, tail = self.iter_energy_trace_tiles(4)
+
+            same = len(steady) == len(next_steady) and all(
+                np.allclose(a, b, rtol=1e-9, atol=1e-9) for a, b in [
+                    (steady.times, next_steady.times),
+                    (steady.powers, next_steady.powers)
+                ]
+            )
+            if same:
+                repeats = self.times - 2
+                if coalesce:
+                    first, second, steady, tail = map(coalesce_energy_trace, [first, second, steady, tail])
+
+                def tiles():
+                    yield first
+                    yield second
+                    for i in range(repeats):
+                        yield steady
+                    yield tail
+
+                total_energy_in_joules = first.total_energy() + second.total_energy() + repeats * steady.total_energy() + tail.total_energy()
+                length = len(first) + len(second) + repeats * len(steady) + len(tail)
+                return total_energy_in_joules, TiledEnergyTrace(tiles, length)
+
+            logger.info('Iterations are not periodic, calculating every iteration')
+
+        iter_tiles = self.iter_coalesced_energy_trace_tiles if coalesce else self.iter_energy_trace_tiles
+
+        total_energy_in_joules = 0
+        length = 0
+        for tile in iter_tiles():
+            total_energy_in_joules += tile.total_energy()
+            length += len(tile)
+
+        return total_energy_in_joules, TiledEnergyTrace(iter_tiles, length)
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_repeated_trace():
+    import json, os, tempfile
+
+    data = {
+        'traceEvents': [
+            {'ph': 'X', 'ts': 1000000, 'dur': 2000000},
+            {'ph': 'X', 'ts': 1500000, 'dur': 500000},
+            {'ph': 'X', 'ts': 4000000, 'dur': 1000000},
+        ]
+    }
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+
+    try:
+        trace = RepeatedTrace(path, 5, 35/4)
+
+        shifts = [0, 8000000, 12000000, 16000000, 20000000]
+        expected_events = [(e['ts'] + shift, e['dur']) for shift in shifts for e in data['traceEvents']]
+        assert list(trace.iter_complete_events()) == expected_events, 'Repeated events should follow increase_dataset.py'
+
+        starts, ends, powers = zip(*trace.iter_tiles())
+        expected_total, expected_trace = calc_energy_trace(np.concatenate(starts), np.concatenate(ends), np.concatenate(powers))
+
+        for extrapolate in [False, True]:
+            total, energy_trace = trace.calc(extrapolate)
+            __check_energy_trace(expected_total, expected_trace, total, energy_trace)
+
+        # The iterations overlap
+        data['traceEvents'].append({'ph': 'X', 'ts': 0, 'dur': 6000000})
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+        trace = RepeatedTrace(path, 7, 35/4)
+        starts, ends, powers = zip(*trace.iter_tiles())
+        expected_total, expected_trace = calc_energy_trace(np.concatenate(starts), np.concatenate(ends), np.concatenate(powers))
+
+        for extrapolate in [False, True]:
+            total, energy_trace = trace.calc(extrapolate)
+            __check_energy_trace(expected_total, expected_trace, total, energy_trace)
+
+            total, energy_trace = trace.calc(extrapolate, coalesce=True)
+            __check_energy_trace(expected_total, coalesce_energy_trace(expected_trace), total, energy_trace)
+    finally:
+        os.remove(path)
+
+
+def __check_energy_trace(expected_total, expected_trace, total, energy_trace):
+    assert abs(total - expected_total) < 1e-9, f'Total energy {total} should be {expected_total}'
+    assert len(energy_trace) == len(expected_trace), 'Energy traces should have the same size'
+
+    for expected, found in zip(expected_trace, energy_trace):
+        for a, b in zip(expected, found):
+            assert abs(a - b) < 1e-9, f'Interval {found} should be {expected}'
+
+
+if __name__ == '__main__':
+
+    __test_repeated_trace()
@@ -0,0 +1,314 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging, os, re, sys, time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'photovolta', 'src'))
+
+from node_energy_usage import TOTAL_KEYS, load_green_intervals
+from pv_series import open_pv_series
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('schedule_simulator')
+
+TASK_COST_VARIABLE = re.compile(r'OMPCLUSTER_(HEFT_COMP|MOHEFT_CONS)_G_(\d+)_T_(\d+)_P_(\d+)=(.*)')
+
+
+def load_task_costs(variables_file, graph=1):
+    # Execution time (s) and power (W) of every task (rows) on every processor
+    # (columns), from the OMPCLUSTER_HEFT_COMP_* and OMPCLUSTER_MOHEFT_CONS_*
+    # variables printed by E01_2_calc_task_exec_time.py
+    costs = {'HEFT_COMP': {}, 'MOHEFT_CONS': {}}
+    with open(variables_file) as f:
+        for line in f:
+            match = TASK_COST_VARIABLE.match(line.strip())
+            if match and int(match.group(2)) == graph:
+                kind, _, task, processor, value = match.groups()
+                costs[kind][(int(task), int(processor))] = float(value)
+
+    tasks = max(task for task, _ in costs['HEFT_COMP']) + 1
+    processors = max(processor for _, processor in costs['HEFT_COMP']) + 1
+    exec_times = np.zeros((tasks, processors))
+    energies = np.zeros((tasks, processors))
+    for (task, processor), value in costs['HEFT_COMP'].items():
+        exec_times[task, processor] = value
+    for (task, processor), value in costs['MOHEFT_CONS'].items():
+        energies[task, processor] = value
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        powers = np.where(exec_times > 0, energies / exec_times, 0)
+    return exec_times, powers
+
+
+def load_processors_green_intervals(processors, offset=0):
+    # Green intervals of each processor (dicts with processor_id,
+    # pv_energy_file and pv_area, as in generate_ompc_moheft_green_variables.py)
+    # in the order of processor_id
+    return [
+        load_green_intervals(open_pv_series(processor['pv_energy_file']), processor['pv_area'], offset)
+        for processor in sorted(processors, key=lambda processor: processor['processor_id'])
+    ]
+
+
+def earliest_starts(assignments, exec_times, priorities=None, release=0):
+    # Start times of the tasks of each schedule when every processor runs its
+    # tasks one after the other, by priority (the task index by default),
+    # from release. assignments and priorities are S x T arrays.
+    assignments = np.asarray(assignments)
+    schedules, tasks = assignments.shape
+    if priorities is None:
+        priorities = np.broadcast_to(np.arange(tasks), assignments.shape)
+
+    durations = np.asarray(exec_times, dtype=np.float64)[np.arange(tasks), assignments]
+
+    # Tasks of each schedule sorted by processor and priority, and the time
+    # before each one since the first task of its processor
+    order = np.lexsort((priorities, assignments))
+    sorted_durations = np.take_along_axis(durations, order, axis=1)
+    sorted_assignments = np.take_along_axis(assignments, order, axis=1)
+    before = np.cumsum(sorted_durations, axis=1) - sorted_durations
+
+    first = np.ones(assignments.shape, dtype=bool)
+    first[:, 1:] = sorted_assignments[:, 1:] != sorted_assignments[:, :-1]
+    first_task = np.maximum.accumulate(np.where(first, np.arange(tasks), 0), axis=1)
+
+    starts = np.empty(assignments.shape)
+    np.put_along_axis(starts, order, release + before - np.take_along_axis(before, first_task, axis=1), axis=1)
+    return starts
+
+
+class ScheduleSimulator:
+    # Energy of candidate schedules of a workflow, without running it. The
+    # task t on the processor p runs for exec_times[t, p] seconds at
+    # powers[t, p] W, and the processor p has its own green intervals
+    # (green_intervals[p], as load_green_intervals). As in
+    # calc_nodes_green_energy_usage, the tasks of each processor are the
+    # works of an EnergyUsage from time 0, and its usage is the one of
+    # calc_green_energy_usage over its own trace.
+    #
+    # A batch of S schedules is an S x T array of processors (assignments)
+    # and an S x T array of start times (starts). For each processor, the
+    # boundaries of the tasks of every schedule and the green intervals before
+    # the end of the batch are sorted in one row per schedule, so the power
+    # and green power of every segment of every schedule are found at once.
+
+    def __init__(self, exec_times, powers, green_intervals):
+        self.exec_times = np.asarray(exec_times, dtype=np.float64)
+        self.powers = np.broadcast_to(np.asarray(powers, dtype=np.float64), self.exec_times.shape)
+        if len(green_intervals) != self.exec_times.shape[1]:
+            raise ValueError(f'{self.exec_times.shape[1]} processors but green intervals of {len(green_intervals)}')
+
+        self.green_interval_times = []
+        self.green_available_powers = []
+        self.green_energy_prefix = []
+        self.green_steps = []
+        for times, powers in green_intervals:
+            times = np.asarray(times, dtype=np.float64)
+            powers = np.asarray(powers, dtype=np.float64)
+            self.green_interval_times.append(times)
+            self.green_available_powers.append(powers)
+            # Regular intervals have the interval of a time by arithmetic
+            steps = np.diff(times)
+            self.green_steps.append(steps[0].item() if len(steps) > 0 and np.all(steps == steps[0]) and steps[0] > 0 else 0)
+            # The green interval i provides its power from the end of the
+            # interval i-1 (0 for the first one) until times[i]
+            self.green_energy_prefix.append(np.concatenate(([0.0], np.cumsum(np.diff(times, prepend=0.0) * powers))))
+
+    def __green_interval(self, processor, t):
+        # First green interval that ends after t
+        times = self.green_interval_times[processor]
+        step = self.green_steps[processor]
+        if step > 0:
+            i = np.floor((t - times[0]) / step).astype(np.int64) + 1
+        else:
+            i = np.searchsorted(times, t, side='right')
+        return np.clip(i, 0, len(times) - 1)
+
+    def __green_energy_until(self, processor, t):
+        times = self.green_interval_times[processor]
+        i = np.searchsorted(times, t, side='left')
+        interval_starts = np.concatenate(([0.0], times[:-1]))
+        return self.green_energy_prefix[processor][i] + (t - interval_starts[i]) * self.green_available_powers[processor][i]
+
+    def __score_processor(self, processor, assignments, starts):
+        schedules = len(assignments)
+        on_processor = assignments == processor
+        if not on_processor.any():
+            return {key: np.zeros(schedules) for key in TOTAL_KEYS}
+
+        exec_times = self.exec_times[:, processor]
+        powers = self.powers[:, processor]
+        task_ends = starts + exec_times
+
+        green_times = self.green_interval_times[processor]
+        green_powers = self.green_available_powers[processor]
+        end = task_ends[on_processor].max()
+        if len(green_times) == 0 or green_times[-1] < end:
+            raise ValueError(f'End of the green intervals of processor {processor}')
+        inner_green_times = np.broadcast_to(green_times[green_times < end], (schedules, np.count_nonzero(green_times < end)))
+
+        # One row of boundaries per schedule: the starts and ends of its tasks
+        # (the tasks of other processors at the end of the batch, without
+        # power) and the green intervals
+        times = np.concatenate((np.where(on_processor, starts, end), np.where(on_processor, task_ends, end), inner_green_times), axis=1)
+        task_powers = np.where(on_processor, powers, 0)
+        power_deltas = np.concatenate((task_powers, -task_powers, np.zeros(inner_green_times.shape)), axis=1)
+        active_deltas = np.concatenate((on_processor, -on_processor.astype(np.int8), np.zeros(inner_green_times.shape, dtype=np.int8)), axis=1, dtype=np.int8)
+
+        # The order of the boundaries of an instant only changes segments
+        # without duration
+        order = np.argsort(times, axis=1)
+        times = np.take_along_axis(times, order, axis=1)
+
+        # Power after each boundary
+        power = np.cumsum(np.take_along_axis(power_deltas, order, axis=1), axis=1)
+        active = np.cumsum(np.take_along_axis(active_deltas, order, axis=1), axis=1, dtype=np.int32)
+        # Without active works the power is exactly 0, as in EnergyUsage.calc
+        power[active == 0] = 0
+
+        segment_times = np.diff(times, axis=1)
+        segment_green_powers = green_powers[self.__green_interval(processor, times[:, :-1])]
+
+        segment_powers = power[:, :-1]
+        green_energy_used = (segment_times * np.minimum(segment_powers, segment_green_powers)).sum(axis=1)
+
+        # Green energy from 0 until the last task of each schedule
+        ends = np.where(on_processor, task_ends, 0).max(axis=1)
+        green_energy = np.where(ends > 0, self.__green_energy_until(processor, ends), 0)
+
+        return {
+            'total_energy': (task_powers * exec_times).sum(axis=1),
+            'total_brown_energy_used': (segment_times * np.maximum(segment_powers - segment_green_powers, 0)).sum(axis=1),
+            'total_green_energy_used': green_energy_used,
+            'total_green_energy_not_used': green_energy - green_energy_used
+        }
+
+    def score(self, assignments, starts):
+        # Totals of calc_green_energy_usage of every schedule (arrays of S
+        # values), summed over the processors, and the makespan
+        assignments = np.atleast_2d(np.asarray(assignments))
+        starts = np.atleast_2d(np.asarray(starts, dtype=np.float64))
+        if np.any(starts < 0):
+            raise ValueError('Tasks must start at or after time 0')
+
+        r = {key: np.zeros(len(assignments)) for key in TOTAL_KEYS}
+        for processor in range(self.exec_times.shape[1]):
+            for key, values in self.__score_processor(processor, assignments, starts).items():
+                r[key] += values
+
+        tasks = np.arange(assignments.shape[1])
+        r['makespan'] = (starts + self.exec_times[tasks, assignments]).max(axis=1)
+        return r
+
+    def score_parallel(self, assignments, starts, workers=None, chunk_size=256):
+        # score of chunks of schedules, in a process pool unless workers is 1
+        assignments = np.atleast_2d(np.asarray(assignments))
+        starts = np.atleast_2d(np.asarray(starts, dtype=np.float64))
+
+        bounds = list(range(0, len(assignments), chunk_size))
+        args = [[assignments[a:a + chunk_size] for a in bounds], [starts[a:a + chunk_size] for a in bounds]]
+        if workers == 1 or len(bounds) <= 1:
+            results = list(map(self.score, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.score, *args))
+        return {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_earliest_starts():
+    exec_times = np.array([[1, 10], [2, 20], [3, 30], [4, 40]])
+    assignments = np.array([[0, 0, 1, 0], [1, 1, 1, 1]])
+
+    starts = earliest_starts(assignments, exec_times, release=5)
+    assert starts.tolist() == [[5, 6, 5, 8], [5, 15, 35, 65]], f'Tasks should follow each other on each processor, not {starts.tolist()}'
+
+    starts = earliest_starts(assignments, exec_times, priorities=np.array([[3, 2, 1, 0]] * 2))
+    assert starts.tolist() == [[6, 4, 0, 0], [90, 70, 40, 0]], f'Tasks should follow the priorities, not {starts.tolist()}'
+
+
+def __test_schedule_simulator():
+    from energy_usage import EnergyUsage, calc_green_energy_usage
+
+    rng = np.random.default_rng(7)
+
+    tasks, processors = 30, 3
+    exec_times = rng.integers(1, 20, (tasks, processors)) / 4
+    powers = rng.choice([35 / 8, 45 / 8, 10], (tasks, processors))
+    # Intervals of 1s (as the compressed PV files), of 3s and irregular ones
+    green_intervals = [
+        (np.arange(1, 400, dtype=np.float64), rng.integers(0, 30, 399).astype(np.float64)),
+        (np.arange(3, 400, 3, dtype=np.float64), rng.integers(0, 30, 133).astype(np.float64)),
+        (np.cumsum(rng.integers(1, 4, 399) / 2), rng.integers(0, 2, 399) * 9.0)
+    ]
+
+    assignments = rng.integers(0, processors, (50, tasks))
+    starts = np.where(rng.random((50, tasks)) < 0.5, earliest_starts(assignments, exec_times), rng.integers(0, 80, (50, tasks)) / 2)
+    # A schedule without tasks on a processor
+    assignments[0] = 0
+
+    simulator = ScheduleSimulator(exec_times, powers, green_intervals)
+    r = simulator.score(assignments, starts)
+    parallel = simulator.score_parallel(assignments, starts, workers=2, chunk_size=16)
+
+    for i in range(len(assignments)):
+        expected = {key: 0 for key in TOTAL_KEYS}
+        for processor, (green_interval_times, green_available_powers) in enumerate(green_intervals):
+            e = EnergyUsage()
+            for task in np.flatnonzero(assignments[i] == processor).tolist():
+                e.add_work('X', starts[i, task], starts[i, task] + exec_times[task, processor], powers[task, processor])
+            _, energy_trace = e.calc()
+            processor_expected = calc_green_energy_usage(energy_trace, iter(zip(green_interval_times.tolist(), green_available_powers.tolist())).__next__)
+            for key in TOTAL_KEYS:
+                expected[key] += processor_expected[key]
+
+        for key, value in expected.items():
+            assert abs(r[key][i] - value) < 1e-6, f'{key} of schedule {i} should be {value} instead of {r[key][i]}'
+            assert parallel[key][i] == r[key][i], f'{key} of schedule {i} differs in parallel'
+
+    try:
+        simulator.score(assignments, starts + 1000)
+        assert False, 'Schedules after the green intervals should fail'
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+
+    __test_earliest_starts()
+    __test_schedule_simulator()
+
+    # python3 E01_2_calc_task_exec_time.py > task_costs.txt
+    variables_file = '../../experiments/01_get_tasks_execution_time/task_costs.txt'
+    processors = [
+        {
+            'processor_id': i,
+            'pv_energy_file': f'./../../photovolta/data/ompc/compressed/photovolta_compressed_interval_{i + 1}.csv',
+            'pv_area': 1
+        }
+        for i in range(2)
+    ]
+    offset = 98 # interval of the compressed files (8h10)
+    candidates = 100000
+
+    exec_times, powers = load_task_costs(variables_file)
+    simulator = ScheduleSimulator(exec_times, powers, load_processors_green_intervals(processors, offset))
+
+    # Random assignments, with the tasks of each processor run one after the other
+    rng = np.random.default_rng(0)
+    assignments = rng.integers(0, exec_times.shape[1], (candidates, exec_times.shape[0]))
+    starts = earliest_starts(assignments, exec_times)
+
+    start = time.perf_counter()
+    r = simulator.score_parallel(assignments, starts)
+    seconds = time.perf_counter() - start
+    logger.info(f'{candidates} schedules in {seconds:.2f}s ({candidates / seconds:.0f} schedules/s)')
+
+    for i in np.lexsort((r['makespan'], r['total_brown_energy_used']))[:5].tolist():
+        logger.info('Schedule {}: Brown {:.2f}J Green {:.2f}J Makespan {:.2f}s'.format(i, r['total_brown_energy_used'][i], r['total_green_energy_used'][i], r['makespan'][i]))
@@ -0,0 +1,210 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging, os, sys, tempfile
+
+import numpy as np
+
+from trace_loader import CompleteEvents, iter_trace_events
+from vectorized_energy_usage import EnergyTrace, StreamingEnergyUsage, TiledEnergyTrace
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('sharded_energy_usage')
+
+SHARD_SIZE = 3600 # 1h of trace per shard
+BATCH_SIZE = 1 << 20 # Events read before writing them to the shards
+
+# Start (positive deltas) or end (negative deltas) of a work
+BOUNDARY = np.dtype([('time', '<f8'), ('power_delta', '<f8'), ('active_delta', '<i8')])
+
+
+def microsecond_to_second(microsecond):
+    return microsecond / 1000000
+
+
+def _calc_shard(boundaries_file, trace_file, last_instant, power, active):
+    # Energy trace of the instants of one shard, from the sweep state before
+    # it. The trace is saved to trace_file, so only its size goes back.
+    boundaries = np.fromfile(boundaries_file, dtype=BOUNDARY)
+
+    e = StreamingEnergyUsage(last_instant, power, active)
+    e.add_boundaries(boundaries['time'], boundaries['power_delta'], boundaries['active_delta'])
+    energy_trace = e.finish()
+
+    np.save(trace_file, np.stack((energy_trace.times, energy_trace.powers, energy_trace.energies)))
+    return energy_trace.total_energy(), len(energy_trace)
+
+
+class ShardedEnergyUsage:
+    # Out of core version of VectorizedEnergyUsage. The boundaries of the
+    # works are written to one file per shard (the boundaries in
+    # [k*shard_size, (k+1)*shard_size)), so a work that spans several shards
+    # is carried by the sum of the deltas of the shards before its end. Only
+    # those sums are kept in memory and each shard is swept independently
+    # (possibly in parallel) from the state before it. The energy traces of
+    # the shards are saved next to them and read back in order.
+
+    def __init__(self, shard_size=SHARD_SIZE, shard_dir=None):
+        self.shard_size = shard_size
+
+        self.tmp_dir = None
+        if shard_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='energy_shards_')
+            shard_dir = self.tmp_dir.name
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+
+        # shard -> [power delta, active delta, last instant, boundaries]
+        self.shards = {}
+
+    def __shard_file(self, shard, kind):
+        return os.path.join(self.shard_dir, f'{kind}_{shard}.{"bin" if kind == "boundaries" else "npy"}')
+
+    def add_work(self, name, start, end, power):
+        self.add_works([start], [end], [power])
+
+    def add_works(self, starts, ends, powers):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        powers = np.broadcast_to(np.asarray(powers, dtype=np.float64), starts.shape)
+
+        boundaries = np.empty(2 * len(starts), dtype=BOUNDARY)
+        boundaries['time'] = np.concatenate((starts, ends))
+        boundaries['power_delta'] = np.concatenate((powers, -powers))
+        boundaries['active_delta'] = np.repeat(np.array([1, -1], dtype=np.int64), len(starts))
+
+        shard = np.floor(boundaries['time'] / self.shard_size).astype(np.int64)
+        order = np.argsort(shard, kind='stable')
+        shard = shard[order]
+        boundaries = boundaries[order]
+
+        shards, first = np.unique(shard, return_index=True)
+        for k, a, b in zip(shards.tolist(), first.tolist(), np.append(first[1:], len(shard)).tolist()):
+            shard_boundaries = boundaries[a:b]
+            with open(self.__shard_file(k, 'boundaries'), 'ab') as f:
+                shard_boundaries.tofile(f)
+
+            stats = self.shards.setdefault(k, [0.0, 0, 0.0, 0])
+            stats[0] += shard_boundaries['power_delta'].sum().item()
+            stats[1] += shard_boundaries['active_delta'].sum().item()
+            stats[2] = max(stats[2], shard_boundaries['time'].max().item())
+            stats[3] += len(shard_boundaries)
+
+    def add_trace(self, events_file, power_model, batch_size=BATCH_SIZE):
+        # Complete events of a Chrome trace, read and written in batches
+        def add_events(events):
+            starts = microsecond_to_second(events.column('ts'))
+            ends = starts + microsecond_to_second(events.column('dur'))
+            self.add_works(starts, ends, power_model.powers(events))
+
+        count = 0
+        events = CompleteEvents()
+        for event in iter_trace_events(events_file):
+            if event['ph'] == 'X':
+                events.append(event)
+                if len(events) >= batch_size:
+                    add_events(events)
+                    count += len(events)
+                    events = CompleteEvents()
+        add_events(events)
+        count += len(events)
+
+        logger.info(f'{count} events written to {len(self.shards)} shards')
+
+    def shard_states(self):
+        # (shard, last instant, power, active works) before each shard
+        states = []
+        last_instant = 0.0
+        power = 0.0
+        active = 0
+        for k in sorted(self.shards):
+            states.append((k, last_instant, power, active))
+            power_delta, active_delta, shard_last_instant, _ = self.shards[k]
+            power += power_delta
+            active += active_delta
+            last_instant = max(last_instant, shard_last_instant)
+        return states
+
+    def calc(self, workers=1):
+        states = self.shard_states()
+
+        args = [
+            [self.__shard_file(k, 'boundaries') for k, _, _, _ in states],
+            [self.__shard_file(k, 'trace') for k, _, _, _ in states],
+            [last_instant for _, last_instant, _, _ in states],
+            [power for _, _, power, _ in states],
+            [active for _, _, _, active in states]
+        ]
+        if workers == 1 or len(states) <= 1:
+            results = list(map(_calc_shard, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_calc_shard, *args))
+
+        total_energy_in_joules = sum(total for total, _ in results)
+        length = sum(size for _, size in results)
+        trace_files = args[1]
+
+        def tiles():
+            for trace_file in trace_files:
+                data = np.load(trace_file, mmap_mode='r')
+                yield EnergyTrace(data[0], data[1], data[2])
+
+        energy_trace = TiledEnergyTrace(tiles, length)
+        # The temporary shard directory is removed when it is collected, so
+        # the trace keeps it while its tiles may be read
+        energy_trace.tmp_dir = self.tmp_dir
+        return total_energy_in_joules, energy_trace
+
+    def clear(self):
+        for file_name in os.listdir(self.shard_dir):
+            if file_name.startswith('boundaries_') or file_name.startswith('trace_'):
+                os.remove(os.path.join(self.shard_dir, file_name))
+        self.shards = {}
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_sharded_energy_usage():
+    import gc, random
+    from vectorized_energy_usage import as_energy_trace, calc_energy_trace
+
+    rng = random.Random(7)
+
+    starts = np.array([rng.randint(0, 4000) / 4 for _ in range(3000)])
+    ends = starts + np.array([rng.choice([0, 1, 30, 400]) / 4 + rng.randint(0, 20) / 4 for _ in range(3000)])
+    powers = np.array([rng.choice([35/4, 45/8, 2]) for _ in range(3000)])
+
+    expected_total, expected_trace = calc_energy_trace(starts, ends, powers)
+
+    for shard_size, workers in [(10, 1), (37.5, 2), (5000, 1)]:
+        e = ShardedEnergyUsage(shard_size)
+        for a in range(0, len(starts), 700):
+            e.add_works(starts[a:a + 700], ends[a:a + 700], powers[a:a + 700])
+
+        total, energy_trace = e.calc(workers)
+        trace = as_energy_trace(energy_trace)
+
+        assert abs(total - expected_total) < 1e-6, f'Total energy {total} should be {expected_total}'
+        assert len(trace) == len(expected_trace), f'Sharded trace with shard size {shard_size} has a different size'
+        assert np.array_equal(trace.times, expected_trace.times), 'Sharded trace should have the same instants'
+        assert np.allclose(trace.powers, expected_trace.powers, rtol=0, atol=1e-9), 'Sharded trace should have the same powers'
+
+        e.clear()
+        assert not os.listdir(e.shard_dir), 'Shards should be removed'
+
+    # The trace outlives the ShardedEnergyUsage and its temporary directory
+    e = ShardedEnergyUsage(10)
+    e.add_works(starts, ends, powers)
+    total, energy_trace = e.calc()
+    del e
+    gc.collect()
+    assert np.array_equal(as_energy_trace(energy_trace).times, expected_trace.times), 'Shards should be kept while the trace is used'
+
+
+if __name__ == '__main__':
+
+    __test_sharded_energy_usage()
@@ -0,0 +1,187 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging, sys
+
+import numpy as np
+
+from vectorized_energy_usage import as_energy_trace, calc_green_energy_usage_batch
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('start_offset_sweep')
+
+
+# For a workflow started at the beginning of a PV interval, the trace window j
+# (the seconds [j*step, (j+1)*step) after the start) always runs in the PV
+# interval first_interval + j. The green energy used in the window is
+#
+#   f_j(g) = sum of dt * min(power, g) over the segments of the window
+#
+# which only depends on the green power g, so the trace is reduced once to the
+# sorted power levels of each window and every start offset is evaluated by a
+# binary search of its green powers in those levels.
+
+
+def _calc_windows(energy_trace, step, windows):
+    # Splits the trace at every multiple of step, using a green series without
+    # power to get the segments
+    window_ends = step * np.arange(1, windows + 1)
+    r = calc_green_energy_usage_batch(energy_trace, window_ends, np.zeros(windows), return_segments=True)
+    segments = r['segments']
+
+    window = np.searchsorted(window_ends, segments['start'], side='right')
+    order = np.lexsort((segments['power'], window))
+
+    window = window[order]
+    levels = segments['power'][order]
+    durations = segments['time'][order]
+
+    bounds = np.searchsorted(window, np.arange(windows + 1), side='left')
+
+    windows_data = []
+    for j in range(windows):
+        a, b = bounds[j], bounds[j + 1]
+        window_levels = levels[a:b]
+        window_durations = durations[a:b]
+        # Prefix sums with a leading 0: energy and time below each level
+        cum_energy = np.concatenate(([0.0], np.cumsum(window_levels * window_durations)))
+        cum_time = np.concatenate(([0.0], np.cumsum(window_durations)))
+        windows_data.append((window_levels, cum_energy, cum_time))
+
+    return r['total_energy'], windows_data
+
+
+def _calc_green_energy_used(windows_data, pv_available_powers, first_interval):
+    green_energy_used = np.zeros(len(first_interval))
+
+    for j, (levels, cum_energy, cum_time) in enumerate(windows_data):
+        green_power = pv_available_powers[first_interval + j]
+        below = np.searchsorted(levels, green_power, side='left')
+        green_energy_used += cum_energy[below] + green_power * (cum_time[-1] - cum_time[below])
+
+    return green_energy_used
+
+
+def calc_start_offset_sweep(energy_trace, pv_interval_times, pv_available_powers, offsets=None, workers=1, chunk_size=8192):
+    # Green usage of the trace for every start offset (in seconds, aligned to
+    # the PV intervals). The PV series is rebased at each offset: the interval
+    # that ends at time t ends at t - offset for the workflow. With offset = 0
+    # the totals are the ones of calc_green_energy_usage_batch.
+    energy_trace = as_energy_trace(energy_trace)
+    pv_interval_times = np.asarray(pv_interval_times, dtype=np.float64)
+    pv_available_powers = np.asarray(pv_available_powers, dtype=np.float64)
+
+    if len(pv_interval_times) < 2:
+        raise ValueError(f'The PV series needs at least 2 intervals to have a step, it has {len(pv_interval_times)}')
+    step = pv_interval_times[1] - pv_interval_times[0]
+    if np.any(np.diff(pv_interval_times) != step):
+        raise ValueError('PV intervals must have the same size')
+    origin = pv_interval_times[0] - step
+
+    duration = energy_trace.times[energy_trace.times > 0].sum()
+    windows = max(int(np.ceil(duration / step)), 1)
+    last_interval = len(pv_interval_times) - windows
+
+    if offsets is None:
+        first_interval = np.arange(last_interval + 1)
+    else:
+        offsets = np.asarray(offsets, dtype=np.float64)
+        first_interval = ((offsets - origin) / step).astype(np.int64)
+        if np.any(origin + first_interval * step != offsets):
+            raise ValueError('Offsets must be aligned to the PV intervals')
+        if np.any((first_interval < 0) | (first_interval > last_interval)):
+            raise ValueError('The workflow must end before the end of the PV series')
+    offsets = origin + first_interval * step
+
+    total_energy, windows_data = _calc_windows(energy_trace, step, windows)
+
+    # Green energy available during the run, from the PV prefix sums. The
+    # last window may be shorter than step.
+    last_window_time = duration - (windows - 1) * step
+    pv_energy_prefix = np.concatenate(([0.0], np.cumsum(pv_available_powers * step)))
+    green_energy = pv_energy_prefix[first_interval + windows - 1] - pv_energy_prefix[first_interval]
+    green_energy += pv_available_powers[first_interval + windows - 1] * last_window_time
+
+    chunks = [first_interval[i:i + chunk_size] for i in range(0, len(first_interval), chunk_size)]
+    if workers == 1 or len(chunks) <= 1:
+        results = [_calc_green_energy_used(windows_data, pv_available_powers, chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                _calc_green_energy_used,
+                [windows_data] * len(chunks),
+                [pv_available_powers] * len(chunks),
+                chunks
+            ))
+    green_energy_used = np.concatenate(results) if results else np.empty(0)
+    # The sums per window may round slightly above the total
+    green_energy_used = np.minimum(green_energy_used, total_energy)
+
+    return {
+        'offset': offsets,
+        'total_energy': np.full(len(offsets), total_energy),
+        'total_brown_energy_used': total_energy - green_energy_used,
+        'total_green_energy_used': green_energy_used,
+        'total_green_energy_not_used': green_energy - green_energy_used
+    }
+
+
+def best_start_offsets(table, count=10):
+    # Offsets with less brown energy first
+    order = np.argsort(table['total_brown_energy_used'], kind='stable')[:count]
+    return [{key: values[i].item() for key, values in table.items()} for i in order]
+
+
+def save_start_offset_sweep(table, output_file):
+    keys = list(table.keys())
+    np.savetxt(output_file, np.column_stack([table[key] for key in keys]), delimiter=',', header=','.join(keys), comments='', fmt='%.6f')
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_calc_start_offset_sweep():
+    rng = np.random.default_rng(7)
+
+    energy_trace = [
+        (0, 0, 0),
+        (5, 10, 50),
+        (10, 100, 1000),
+        (6, 0, 0),
+        (1, 7, 7),
+        (4, 16, 64),
+        (1, 9, 9),
+        (8, 0, 0),
+        (5, 1, 5)
+    ]
+
+    step = 3
+    pv_interval_times = step * np.arange(1, 101)
+    pv_available_powers = rng.integers(0, 120, len(pv_interval_times)).astype(np.float64)
+
+    for workers in [1, 2]:
+        table = calc_start_offset_sweep(energy_trace, pv_interval_times, pv_available_powers, workers=workers, chunk_size=16)
+
+        for i, offset in enumerate(table['offset']):
+            rebased = pv_interval_times > offset
+            expected = calc_green_energy_usage_batch(energy_trace, pv_interval_times[rebased] - offset, pv_available_powers[rebased])
+
+            for key, value in expected.items():
+                assert abs(table[key][i] - value) < 1e-9, f'{key} at offset {offset} should be {value} instead of {table[key][i]}'
+
+    best = best_start_offsets(table, 1)[0]
+    assert best['total_brown_energy_used'] == table['total_brown_energy_used'].min(), 'Best offset should have the least brown energy'
+    logger.info(f'Best start offset: {best}')
+
+    try:
+        calc_start_offset_sweep(energy_trace, pv_interval_times[:1], pv_available_powers[:1])
+        assert False, 'A PV series of 1 interval should be rejected'
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+
+    __test_calc_start_offset_sweep()
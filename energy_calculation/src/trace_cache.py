@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging, os, sys
+
+import numpy as np
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('trace_cache')
+
+CACHE_VERSION = 1 # Change when the content of the entries changes
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache')
+MAX_CACHE_SIZE = 4 * 1024**3 # 4GB
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class TraceCache:
+    # Compressed .npz entries with the arrays extracted from a trace file (and
+    # optionally its energy trace). An entry is keyed by the hash of the trace
+    # content, the power model and the options that change its arrays (as the
+    # engine of the energy trace), so a modified trace, another model or
+    # another option never reads a stale entry. The least recently used entries are removed
+    # when the cache grows over max_size.
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE, store_energy_trace=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.store_energy_trace = store_energy_trace
+        self.index_file = os.path.join(cache_dir, 'hashes.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __load_hashes(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def file_hash(self, events_file):
+        # Hashing a big trace takes a while, so the hash is reused while the
+        # size and the modification time of the file do not change
+        path = os.path.abspath(events_file)
+        stat = os.stat(path)
+        hashes = self.__load_hashes()
+
+        known = hashes.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        self.__write_atomic(self.index_file, lambda f: f.write(json.dumps(hashes).encode()))
+        return digest
+
+    def key(self, events_file, power_model, **options):
+        model_hash = hashlib.sha256(repr((power_model, sorted(options.items()))).encode()).hexdigest()[:16]
+        return f'{self.file_hash(events_file)[:32]}_{model_hash}_v{CACHE_VERSION}'
+
+    def __entry_file(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def __write_atomic(self, file_name, write):
+        tmp_file = f'{file_name}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            write(f)
+        os.replace(tmp_file, file_name)
+
+    def load(self, key):
+        entry_file = self.__entry_file(key)
+        try:
+            with np.load(entry_file) as data:
+                entry = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+        # Most recently used
+        os.utime(entry_file)
+        logger.info(f'Trace cache hit {key}')
+        return entry
+
+    def store(self, key, **arrays):
+        self.__write_atomic(self.__entry_file(key), lambda f: np.savez_compressed(f, **arrays))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((stat.st_mtime_ns, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info(f'Removing trace cache entry {file_name}')
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_size -= size
+
+    def clear(self):
+        for file_name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, file_name))
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_trace_cache():
+    import tempfile, time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_file = os.path.join(tmp_dir, 'trace.json')
+        with open(events_file, 'w') as f:
+            f.write('{"traceEvents": []}')
+
+        cache = TraceCache(os.path.join(tmp_dir, 'cache'), max_size=1)
+
+        key = cache.key(events_file, 35/4)
+        assert key != cache.key(events_file, 45/8), 'Power models should have different keys'
+        assert cache.key(events_file, 35/4, vectorized=True) != cache.key(events_file, 35/4, vectorized=False), 'Engines should have different keys'
+        assert cache.key(events_file, 35/4, vectorized=True, coalesce=True) == cache.key(events_file, 35/4, coalesce=True, vectorized=True), 'Options should not depend on their order'
+        assert cache.load(key) is None, 'Empty cache should not have entries'
+
+        cache.max_size = 1024**2
+        cache.store(key, starts=np.arange(3.0))
+        assert np.array_equal(cache.load(key)['starts'], np.arange(3.0)), 'Stored arrays should be loaded'
+
+        # A modified trace has another key
+        time.sleep(0.01)
+        with open(events_file, 'w') as f:
+            f.write('{"traceEvents": [ ]}')
+        assert cache.key(events_file, 35/4) != key, 'Modified trace should have another key'
+
+        # Only the most recent entry fits
+        other_key = cache.key(events_file, 35/4)
+        cache.max_size = os.path.getsize(os.path.join(cache.cache_dir, f'{key}.npz'))
+        cache.store(other_key, starts=np.arange(3.0))
+        assert cache.load(key) is None, 'Least recently used entry should be removed'
+        assert cache.load(other_key) is not None, 'Most recent entry should be kept'
+
+
+if __name__ == '__main__':
+
+    __test_trace_cache()
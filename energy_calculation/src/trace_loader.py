@@ -0,0 +1,307 @@
+from array import array
+import json
+import logging, re, sys, time
+
+import numpy as np
+
+import instrumentation
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('trace_loader')
+
+CHUNK_SIZE = 1 << 20 # 1MB of text per read
+WHITESPACE = ' \t\n\r'
+
+
+# Text that the decoder stops at when a value is cut at the end of the buffer:
+# part of a number, of a literal or of a \uXXXX escape
+_PARTIAL_TOKEN = re.compile('|'.join(
+    [r'[\d.eE+-]*', r'u[0-9a-fA-F]{0,3}'] +
+    [re.escape(literal[:i]) for literal in ['true', 'false', 'null', 'NaN', 'Infinity', '-Infinity'] for i in range(1, len(literal) + 1)]
+))
+
+
+def _is_incomplete(buffer, error):
+    # Whether the decoder error is the end of the buffer cutting a value,
+    # instead of invalid JSON
+    return error.msg.startswith('Unterminated string') or _PARTIAL_TOKEN.fullmatch(buffer, error.pos) is not None
+
+
+class TraceFormatError(Exception):
+    pass
+
+
+class _Reader:
+    # Keeps a window of the file in memory. The consumed prefix is dropped
+    # only when more text is needed, so slicing stays linear in the file size.
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            buffer = self.buffer
+            pos = self.pos
+            size = len(buffer)
+            while pos < size and buffer[pos] in WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < size or not self.read_more():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise TraceFormatError('Unexpected end of trace file')
+        return self.buffer[self.pos]
+
+    def find(self, token):
+        while True:
+            index = self.buffer.find(token, self.pos)
+            if index >= 0:
+                self.pos = index + len(token)
+                return
+            # Keep the tail in case the token is split between two chunks
+            self.pos = max(self.pos, len(self.buffer) - len(token))
+            if not self.read_more():
+                raise TraceFormatError(f'{token} not found in trace file')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise TraceFormatError(f'Expected "{char}" at trace position {self.pos}')
+        self.pos += 1
+
+    def read_at_least(self, size):
+        # Reads until size characters are pending, or the end of the file
+        if not self.read_more():
+            return False
+        while len(self.buffer) - self.pos < size and self.read_more():
+            pass
+        return True
+
+    def decode(self, decoder):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                self.pos = end
+                return value
+            except json.JSONDecodeError as e:
+                if not _is_incomplete(self.buffer, e):
+                    raise TraceFormatError(f'Invalid JSON at trace position {e.pos}: {e.msg}') from e
+                # The value continues in the next chunks. The pending text is
+                # at least doubled before decoding it again, so a long value is
+                # decoded a logarithmic number of times, not once per chunk.
+                if not self.read_at_least(2 * (len(self.buffer) - self.pos)):
+                    raise TraceFormatError('Unexpected end of trace file') from e
+
+
+class _FollowReader(_Reader):
+    # Reader of a file that is still being written: at the end of the file it
+    # waits for more text, until stop() returns True
+
+    def __init__(self, f, chunk_size, poll_interval, stop):
+        super().__init__(f, chunk_size)
+        self.poll_interval = poll_interval
+        self.stop = stop
+
+    def read_more(self):
+        while True:
+            if super().read_more():
+                return True
+            if self.stop is not None and self.stop():
+                return False
+            self.eof = False
+            time.sleep(self.poll_interval)
+
+    def read_at_least(self, size):
+        # Only waits for some text: the rest of the value may be all that is
+        # written for a while. What is already written is read too.
+        if not self.read_more():
+            return False
+        while len(self.buffer) - self.pos < size and super().read_more():
+            pass
+        self.eof = False
+        return True
+
+
+def _iter_events(reader):
+    decoder = json.JSONDecoder()
+
+    reader.find('"traceEvents"')
+    reader.expect(':')
+    reader.expect('[')
+
+    if reader.peek() == ']':
+        return
+
+    while True:
+        yield reader.decode(decoder)
+
+        separator = reader.peek()
+        reader.pos += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise TraceFormatError(f'Expected "," or "]" at trace position {reader.pos - 1}')
+
+
+def iter_trace_events(events_file, chunk_size=CHUNK_SIZE):
+    # Yields the objects of the traceEvents array one at a time, without
+    # loading the whole Chrome trace in memory.
+    with open(events_file) as f:
+        yield from _iter_events(_Reader(f, chunk_size))
+
+
+def follow_trace_events(events_file, poll_interval=0.5, stop=None, chunk_size=CHUNK_SIZE):
+    # Same as iter_trace_events for a trace that is still being written (as
+    # tail -f), until the end of the traceEvents array or stop() is True
+    with open(events_file) as f:
+        yield from _iter_events(_FollowReader(f, chunk_size, poll_interval, stop))
+
+
+def iter_json_lines(f):
+    # Events of a pipe or socket (socket.makefile), one JSON object per line
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_complete_events(events_file, chunk_size=CHUNK_SIZE):
+    # Yields (ts, dur) in microseconds of the complete events (ph == 'X')
+    for event in iter_trace_events(events_file, chunk_size):
+        if event['ph'] == 'X':
+            yield float(event['ts']), float(event['dur'])
+
+
+def load_complete_events(events_file, chunk_size=CHUNK_SIZE):
+    # Same as iter_complete_events, but ts and dur are collected in typed
+    # arrays (8 bytes per value) instead of Python objects
+    ts = array('d')
+    dur = array('d')
+    for event_ts, event_dur in iter_complete_events(events_file, chunk_size):
+        ts.append(event_ts)
+        dur.append(event_dur)
+    return ts, dur
+
+
+class CompleteEvents:
+    # Columns of the complete events: ts and dur in microseconds, the code of
+    # the name (its position in names, each name is interned once), pid and
+    # tid (-1 when missing)
+
+    def __init__(self):
+        self.ts = array('d')
+        self.dur = array('d')
+        self.name = array('q')
+        self.pid = array('q')
+        self.tid = array('q')
+        self.names = []
+        self.name_codes = {}
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, event):
+        name = event.get('name', '')
+        code = self.name_codes.get(name)
+        if code is None:
+            code = self.name_codes[name] = len(self.names)
+            self.names.append(name)
+
+        self.ts.append(float(event['ts']))
+        self.dur.append(float(event['dur']))
+        self.name.append(code)
+        self.pid.append(event.get('pid', -1))
+        self.tid.append(event.get('tid', -1))
+
+    def column(self, key):
+        values = getattr(self, key)
+        return np.frombuffer(values, dtype=np.float64 if values.typecode == 'd' else np.int64)
+
+
+def load_complete_events_table(events_file, chunk_size=CHUNK_SIZE):
+    events = CompleteEvents()
+    with instrumentation.phase('parse'):
+        for event in iter_trace_events(events_file, chunk_size):
+            if event['ph'] == 'X':
+                events.append(event)
+    instrumentation.count('events', len(events))
+    return events
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_iter_complete_events():
+    import os, tempfile
+
+    data = {
+        'traceEvents': [
+            {'ph': 'X', 'name': 'A', 'ts': 10.5, 'dur': 2, 'args': {'s': '[],{}'}},
+            {'ph': 'M', 'name': 'process_name'},
+            {'ph': 'X', 'name': 'B', 'ts': 20, 'dur': 0.25},
+            {'ph': 'i', 'name': 'Caf\u00e9', 'ts': -1.5e+30, 's': True, 'id': None, 'args': {'text': 'x' * 5000}}
+        ]
+    }
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+
+    try:
+        # A tiny chunk size forces every value to be split between reads
+        for chunk_size in [1, 7, CHUNK_SIZE]:
+            events = list(iter_trace_events(path, chunk_size))
+            assert events == data['traceEvents'], f'Events read with chunk size {chunk_size} differ'
+
+            complete_events = list(iter_complete_events(path, chunk_size))
+            assert complete_events == [(10.5, 2.0), (20.0, 0.25)], f'Wrong complete events {complete_events}'
+    finally:
+        os.remove(path)
+
+    # Invalid JSON is an error, also when following the trace, and a trace cut
+    # in the middle of a value is an unexpected end
+    for text in ['{"traceEvents": [{"ph": "X", bad}]}', '{"traceEvents": [{"ph": "X"}, {"ph": "X" "ts": 1}]}', '{"traceEvents": [{"ph": "X", "ts": 1']:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+
+        try:
+            # Following a trace that is only invalid never stops waiting for more text
+            stop = (lambda: False) if text.endswith(']}') else (lambda: True)
+            for events in [iter_trace_events(path, 4), follow_trace_events(path, 0.01, stop, 4)]:
+                try:
+                    list(events)
+                    assert False, f'{text} should not be read'
+                except TraceFormatError:
+                    pass
+        finally:
+            os.remove(path)
+
+    logger.info('iter_complete_events OK')
+
+
+if __name__ == '__main__':
+
+    __test_iter_complete_events()
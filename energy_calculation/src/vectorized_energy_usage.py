@@ -0,0 +1,532 @@
+from array import array
+import logging, sys
+
+import numpy as np
+
+import instrumentation
+from battery import BATTERY_KEYS, calc_battery_usage
+
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
+logger = logging.getLogger('vectorized_energy_usage')
+
+
+class EnergyTrace:
+    # Array backed version of the list returned by EnergyUsage.calc. Each
+    # position i is the tuple (time, power, energy) in s, W and J.
+
+    def __init__(self, times, powers, energies):
+        self.times = times
+        self.powers = powers
+        self.energies = energies
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return zip(self.times.tolist(), self.powers.tolist(), self.energies.tolist())
+
+    def __getitem__(self, i):
+        return self.times[i].item(), self.powers[i].item(), self.energies[i].item()
+
+    def total_energy(self):
+        return self.energies.sum().item()
+
+    def tiles(self):
+        return [self]
+
+
+class TiledEnergyTrace:
+    # Energy trace generated one tile (EnergyTrace) at a time by
+    # tiles_factory, as the trace of RepeatedTrace or ShardedEnergyUsage.
+    # Iterating it gives the (time, power, energy) tuples of the whole trace,
+    # as the list returned by EnergyUsage.calc.
+
+    def __init__(self, tiles_factory, length):
+        self.tiles_factory = tiles_factory
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def tiles(self):
+        return self.tiles_factory()
+
+    def __iter__(self):
+        for tile in self.tiles():
+            yield from tile
+
+
+class StreamingEnergyUsage:
+    # Sweep line over the work boundaries, computed in pieces. flush(until)
+    # returns the energy trace of the instants before until and keeps the
+    # later boundaries (works still running) for the next flush, so works must
+    # be added in time order: no work added after flush(until) may start
+    # before until.
+
+    def __init__(self, last_instant=0.0, power=0.0, active=0):
+        self.pending_times = []
+        self.pending_power_deltas = []
+        self.pending_active_deltas = []
+
+        # State after the last instant flushed (or before the first instant
+        # added, to continue the sweep of another instance)
+        self.last_instant = last_instant
+        self.power = power if active > 0 else 0.0
+        self.active = active
+
+    def add_works(self, starts, ends, powers):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        powers = np.broadcast_to(np.asarray(powers, dtype=np.float64), starts.shape)
+
+        n = len(starts)
+        self.add_boundaries(
+            np.concatenate((starts, ends)),
+            np.concatenate((powers, -powers)),
+            np.repeat(np.array([1, -1], dtype=np.int64), n)
+        )
+
+    def add_boundaries(self, times, power_deltas, active_deltas):
+        # Starts (positive deltas) and ends (negative deltas) of works
+        self.pending_times.append(np.asarray(times, dtype=np.float64))
+        self.pending_power_deltas.append(np.asarray(power_deltas, dtype=np.float64))
+        self.pending_active_deltas.append(np.asarray(active_deltas, dtype=np.int64))
+
+    def flush(self, until=None):
+        times = np.concatenate(self.pending_times) if self.pending_times else np.empty(0)
+        power_deltas = np.concatenate(self.pending_power_deltas) if self.pending_power_deltas else np.empty(0)
+        active_deltas = np.concatenate(self.pending_active_deltas) if self.pending_active_deltas else np.empty(0, dtype=np.int64)
+
+        if until is None:
+            self.pending_times, self.pending_power_deltas, self.pending_active_deltas = [], [], []
+        else:
+            later = times >= until
+            self.pending_times = [times[later]]
+            self.pending_power_deltas = [power_deltas[later]]
+            self.pending_active_deltas = [active_deltas[later]]
+
+            now = ~later
+            times, power_deltas, active_deltas = times[now], power_deltas[now], active_deltas[now]
+
+        if len(times) == 0:
+            empty = np.empty(0, dtype=np.float64)
+            return EnergyTrace(empty, empty.copy(), empty.copy())
+
+        # The timestamps are sorted once and the power at each instant is the
+        # cumulative sum of the power deltas
+        timestamps, instant = np.unique(times, return_inverse=True)
+        instants_count = len(timestamps)
+
+        power_delta = np.bincount(instant, weights=power_deltas, minlength=instants_count)
+        active_delta = np.bincount(instant, weights=active_deltas, minlength=instants_count).astype(np.int64)
+
+        # Power and number of active works after each instant
+        power = self.power + np.cumsum(power_delta)
+        active = self.active + np.cumsum(active_delta)
+
+        # Without active works the power is exactly 0, as in EnergyUsage.calc,
+        # instead of the rounding error accumulated by the cumulative sum
+        power[active == 0] = 0
+
+        times = np.diff(timestamps, prepend=self.last_instant)
+        interval_powers = np.empty(instants_count, dtype=np.float64)
+        interval_powers[0] = self.power
+        interval_powers[1:] = power[:-1]
+        energies = times * interval_powers # 1W * 1s = 1J
+
+        self.last_instant = timestamps[-1].item()
+        self.power = power[-1].item()
+        self.active = active[-1].item()
+
+        instrumentation.count('instants', instants_count)
+        instrumentation.maximum('max_concurrent_works', active.max().item())
+
+        return EnergyTrace(times, interval_powers, energies)
+
+    def finish(self):
+        return self.flush()
+
+
+def calc_energy_trace(starts, ends, powers):
+    with instrumentation.phase('sweep'):
+        e = StreamingEnergyUsage()
+        e.add_works(starts, ends, powers)
+        energy_trace = e.finish()
+    instrumentation.count('works', len(starts))
+    return energy_trace.total_energy(), energy_trace
+
+
+class VectorizedEnergyUsage:
+    # Same interface of EnergyUsage, but works are kept in typed arrays and
+    # the energy trace is computed by calc_energy_trace
+
+    def __init__(self):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.powers = array('d')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add_work(self, name, start, end, power):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.powers.append(power)
+
+    def add_works(self, starts, ends, powers):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        powers = np.broadcast_to(np.asarray(powers, dtype=np.float64), starts.shape)
+
+        self.starts.frombytes(starts.tobytes())
+        self.ends.frombytes(ends.tobytes())
+        self.powers.frombytes(powers.tobytes())
+
+    def calc(self):
+        return calc_energy_trace(
+            np.frombuffer(self.starts, dtype=np.float64),
+            np.frombuffer(self.ends, dtype=np.float64),
+            np.frombuffer(self.powers, dtype=np.float64)
+        )
+
+    def clear(self):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.powers = array('d')
+
+
+def as_energy_trace(energy_trace):
+    # Accepts the list of tuples returned by EnergyUsage.calc and the traces
+    # made of tiles (as TiledEnergyTrace) too
+    if isinstance(energy_trace, EnergyTrace):
+        return energy_trace
+    if hasattr(energy_trace, 'tiles'):
+        tiles = list(energy_trace.tiles())
+        return EnergyTrace(
+            np.concatenate([tile.times for tile in tiles]),
+            np.concatenate([tile.powers for tile in tiles]),
+            np.concatenate([tile.energies for tile in tiles])
+        )
+    data = np.array(energy_trace, dtype=np.float64).reshape(-1, 3)
+    return EnergyTrace(data[:, 0].copy(), data[:, 1].copy(), data[:, 2].copy())
+
+
+def coalesce_energy_trace(energy_trace):
+    # Compact version of the trace: intervals without duration are dropped
+    # and consecutive intervals with the same power are merged. The totals of
+    # the green energy usage do not change, as the green usage of an interval
+    # only depends on its power.
+    energy_trace = as_energy_trace(energy_trace)
+
+    positive = energy_trace.times > 0
+    times = energy_trace.times[positive]
+    powers = energy_trace.powers[positive]
+    energies = energy_trace.energies[positive]
+
+    if len(times) == 0:
+        return EnergyTrace(times, powers, energies)
+
+    starts = np.flatnonzero(np.concatenate(([True], powers[1:] != powers[:-1])))
+    return EnergyTrace(np.add.reduceat(times, starts), powers[starts], np.add.reduceat(energies, starts))
+
+
+def calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, return_segments=False, battery=None):
+    # Same result of energy_usage.calc_green_energy_usage, where the green
+    # intervals are the arrays of what next_green_interval would return: the
+    # interval i ends at green_interval_times[i] and provides
+    # green_available_powers[i] Watts since the end of the interval i-1.
+    # With a battery, the segments are accounted by battery.calc_battery_usage.
+    with instrumentation.phase('green'):
+        return _calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, return_segments, battery)
+
+
+def _calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, return_segments, battery):
+    # The ends of the trace intervals and of the green intervals are merged
+    # into one sorted list of breakpoints, so every segment between two
+    # breakpoints has a constant power and a constant green power.
+    energy_trace = as_energy_trace(energy_trace)
+
+    # Intervals without duration are skipped by calc_green_energy_usage
+    positive = energy_trace.times > 0
+    times = energy_trace.times[positive]
+    powers = energy_trace.powers[positive]
+
+    green_interval_times = np.asarray(green_interval_times, dtype=np.float64)
+    green_available_powers = np.asarray(green_available_powers, dtype=np.float64)
+
+    if len(times) == 0:
+        r = {
+            'total_energy': 0,
+            'total_brown_energy_used': 0,
+            'total_green_energy_used': 0,
+            'total_green_energy_not_used': 0
+        }
+        if battery is not None:
+            r.update(zip(BATTERY_KEYS, [0, 0, battery.state_of_charge]))
+        if return_segments:
+            empty = np.empty(0, dtype=np.float64)
+            r['segments'] = {key: empty for key in ['start', 'time', 'power', 'green_power']}
+        return r
+
+    trace_ends = np.cumsum(times)
+    end = trace_ends[-1]
+
+    # Only the green intervals read until the end of the trace are used
+    covering = green_interval_times >= end
+    if not covering.any():
+        raise Exception('End of green intervals')
+    used_intervals = np.argmax(covering) + 1
+    green_interval_times = green_interval_times[:used_intervals]
+    green_available_powers = green_available_powers[:used_intervals]
+
+    if np.any(np.diff(green_interval_times) < 0):
+        raise ValueError('Green interval times must be sorted')
+
+    inner_green_times = green_interval_times[(green_interval_times > 0) & (green_interval_times < end)]
+    breakpoints = np.union1d(trace_ends, inner_green_times)
+
+    instrumentation.count('pv_rows_read', used_intervals.item())
+    instrumentation.count('green_interval_splits', len(breakpoints) - len(trace_ends))
+
+    segment_times = np.diff(breakpoints, prepend=0.0)
+    segment_starts = breakpoints - segment_times
+
+    # Trace interval that contains each segment and green interval in use at
+    # its start (the first one that ends after it)
+    segment_powers = powers[np.searchsorted(trace_ends, breakpoints, side='left')]
+    segment_green_powers = green_available_powers[np.searchsorted(green_interval_times, segment_starts, side='right')]
+
+    if battery is not None:
+        r = calc_battery_usage(segment_times, segment_powers, segment_green_powers, battery)
+    else:
+        energy = segment_times * segment_powers
+        green_energy = segment_times * segment_green_powers
+        green_energy_used = np.minimum(energy, green_energy)
+
+        total_energy = energy.sum().item()
+        total_green_energy_used = green_energy_used.sum().item()
+
+        r = {
+            'total_energy': total_energy,
+            'total_brown_energy_used': total_energy - total_green_energy_used,
+            'total_green_energy_used': total_green_energy_used,
+            'total_green_energy_not_used': green_energy.sum().item() - total_green_energy_used
+        }
+
+    if return_segments:
+        r['segments'] = {
+            'start': segment_starts,
+            'time': segment_times,
+            'power': segment_powers,
+            'green_power': segment_green_powers
+        }
+
+    return r
+
+
+def rebase_green_intervals(energy_trace_chunks, green_interval_times, green_available_powers):
+    # (chunk, green interval times, green available powers) of every chunk of
+    # one energy trace that has some duration, with the green intervals that
+    # cover the chunk rebased at the time it starts
+    green_interval_times = np.asarray(green_interval_times, dtype=np.float64)
+    green_available_powers = np.asarray(green_available_powers, dtype=np.float64)
+
+    now = 0.0
+    for chunk in energy_trace_chunks:
+        chunk = as_energy_trace(chunk)
+        duration = chunk.times[chunk.times > 0].sum()
+        if duration == 0:
+            continue
+
+        first = np.searchsorted(green_interval_times, now, side='right')
+        last = np.searchsorted(green_interval_times, now + duration, side='left') + 1
+        yield chunk, green_interval_times[first:last] - now, green_available_powers[first:last]
+
+        now += duration
+
+
+def calc_green_energy_usage_chunked(energy_trace_chunks, green_interval_times, green_available_powers, battery=None):
+    # calc_green_energy_usage_batch over consecutive pieces of one energy
+    # trace, so the whole trace never has to be in memory. Each chunk is
+    # evaluated against the green intervals rebased at the time it starts,
+    # with the battery left by the chunk before it.
+    totals = {
+        'total_energy': 0,
+        'total_brown_energy_used': 0,
+        'total_green_energy_used': 0,
+        'total_green_energy_not_used': 0
+    }
+    if battery is not None:
+        totals.update(total_battery_charged=0, total_battery_discharged=0)
+
+    for chunk, chunk_green_interval_times, chunk_green_available_powers in rebase_green_intervals(energy_trace_chunks, green_interval_times, green_available_powers):
+        r = calc_green_energy_usage_batch(chunk, chunk_green_interval_times, chunk_green_available_powers, battery=battery)
+        for key in totals:
+            totals[key] += r[key]
+
+    if battery is not None:
+        totals['battery_state_of_charge'] = battery.state_of_charge
+    return totals
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_calc():
+
+    # Same works of energy_usage.__test_calc
+
+    e = VectorizedEnergyUsage()
+
+    e.add_work('A', 0, 5, 10)
+    e.add_work('B', 5, 15, 100)
+    e.add_works([21, 22, 35], [26, 27, 40], [7, 9, 1]) # C, D and E
+
+    total_energy_in_joules, energy_trace = e.calc()
+    logger.info(f'Energy usage intervals: {list(energy_trace)}')
+    logger.info(f'Total energy: {total_energy_in_joules}')
+
+    intervals_expected = [
+        (0, 0, 0),
+        (5, 10, 50), # A
+        (10, 100, 1000), # B
+        (6, 0, 0),
+        (1, 7, 7), # C
+        (4, 16, 64), # C + D
+        (1, 9, 9), # D
+        (8, 0, 0),
+        (5, 1, 5) # E
+    ]
+
+    assert total_energy_in_joules == 1135, 'Total energy should be 1135'
+    assert list(energy_trace) == intervals_expected, 'Energy trace differs from the expected intervals'
+
+
+def __test_calc_same_as_energy_usage():
+    import random
+    from energy_usage import EnergyUsage
+
+    rng = random.Random(42)
+
+    reference = EnergyUsage()
+    vectorized = VectorizedEnergyUsage()
+
+    for i in range(2000):
+        # Coarse timestamps produce shared instants and zero length works
+        start = rng.randint(0, 500) / 4
+        end = start + rng.randint(0, 20) / 4
+        power = 35/4 if rng.random() < 0.5 else rng.randint(1, 50)
+
+        reference.add_work('X', start, end, power)
+        vectorized.add_work('X', start, end, power)
+
+    expected_total, expected_trace = reference.calc()
+    total, energy_trace = vectorized.calc()
+
+    assert len(energy_trace) == len(expected_trace), 'Energy traces should have the same size'
+    assert abs(total - expected_total) < 1e-6, f'Total energy {total} should be {expected_total}'
+
+    for expected, found in zip(expected_trace, energy_trace):
+        for a, b in zip(expected, found):
+            assert abs(a - b) < 1e-9, f'Interval {found} should be {expected}'
+
+
+def __test_calc_green_energy_usage_batch():
+    from energy_usage import calc_green_energy_usage
+
+    energy_trace = [
+        (0, 0, 0),
+        (5, 10, 50),
+        (10, 100, 1000),
+        (6, 0, 0),
+        (1, 7, 7),
+        (4, 16, 64),
+        (1, 9, 9),
+        (8, 0, 0),
+        (5, 1, 5)
+    ]
+
+    green_power_intervals = [(3, 7), (7, 9), (20, 50), (22, 9), (40, 7), (0, 0)]
+
+    i = iter(green_power_intervals)
+    expected = calc_green_energy_usage(energy_trace, lambda: next(i))
+
+    green_interval_times, green_available_powers = zip(*green_power_intervals)
+    r = calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers, return_segments=True)
+    logger.info(r)
+
+    for key, value in expected.items():
+        assert abs(r[key] - value) < 1e-9, f'{key} should be {value} instead of {r[key]}'
+
+    assert r['segments']['time'].sum() == 40, 'Segments should cover the whole trace'
+
+
+def __test_calc_green_energy_usage_chunked():
+    energy_trace = as_energy_trace([
+        (0, 0, 0),
+        (5, 10, 50),
+        (10, 100, 1000),
+        (6, 0, 0),
+        (1, 7, 7),
+        (4, 16, 64),
+        (1, 9, 9),
+        (8, 0, 0),
+        (5, 1, 5)
+    ])
+
+    green_interval_times = [3, 7, 20, 22, 40]
+    green_available_powers = [7, 9, 50, 9, 7]
+
+    expected = calc_green_energy_usage_batch(energy_trace, green_interval_times, green_available_powers)
+
+    chunks = [
+        EnergyTrace(energy_trace.times[a:b], energy_trace.powers[a:b], energy_trace.energies[a:b])
+        for a, b in [(0, 2), (2, 3), (3, 7), (7, 9)]
+    ]
+    r = calc_green_energy_usage_chunked(chunks, green_interval_times, green_available_powers)
+
+    for key, value in expected.items():
+        assert abs(r[key] - value) < 1e-9, f'{key} should be {value} instead of {r[key]}'
+
+
+def __test_coalesce_energy_trace():
+    from energy_usage import calc_green_energy_usage
+
+    energy_trace = [
+        (0, 0, 0),
+        (5, 10, 50),
+        (0, 10, 0),
+        (3, 10, 30),
+        (2, 7, 14),
+        (4, 7, 28),
+        (6, 0, 0),
+        (1, 0, 0),
+        (5, 1, 5)
+    ]
+
+    coalesced = coalesce_energy_trace(energy_trace)
+    assert list(coalesced) == [(8, 10, 80), (6, 7, 42), (7, 0, 0), (5, 1, 5)], 'Equal powers should be merged'
+    assert coalesced.total_energy() == 127, 'Coalesced trace should have the same total energy'
+
+    green_power_intervals = [(3, 7), (7, 9), (20, 50), (22, 9), (40, 7)]
+
+    i = iter(green_power_intervals)
+    expected = calc_green_energy_usage(energy_trace, lambda: next(i))
+    i = iter(green_power_intervals)
+    r = calc_green_energy_usage(coalesced, lambda: next(i))
+
+    for key, value in expected.items():
+        assert r[key] == value, f'{key} should be {value} instead of {r[key]}'
+
+
+if __name__ == '__main__':
+
+    __test_calc()
+    __test_calc_same_as_energy_usage()
+    __test_calc_green_energy_usage_batch()
+    __test_calc_green_energy_usage_chunked()
+    __test_coalesce_energy_trace()
@@ -1,51 +1,77 @@
+import csv
 import os
-import json
-import functools
+import sys
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'energy_calculation', 'src'))
+
+from trace_loader import iter_trace_events
+
+TASK_EVENT_NAME = 'Execute / Target Execution'
+PERCENTILES = [50, 90, 99]
+STATS_FILE = './task_stats.csv' # Next to task_costs.txt, the output of this script
 
 def microsecond_to_second(microsecond):
     return microsecond / 1000000
 
 def calc_tasks_exe_time_for_file(trace_file):
-    with open(trace_file) as f:
-        data = json.load(f)
+    # The trace is parsed incrementally, only the durations are kept
+    tasks_duration = array('d')
 
-        tasks_duration = []
+    for event in iter_trace_events(trace_file):
+        if event['ph'] == 'X' and event['name'] == TASK_EVENT_NAME:
+            duration = microsecond_to_second(float(event['dur']))
+            tasks_duration.append(duration)
 
-        for event in data['traceEvents']:
-            if event['ph'] == 'X' and event['name'] == 'Execute / Target Execution':
-                duration = microsecond_to_second(float(event['dur']))
-                tasks_duration.append(duration)
+    return tasks_duration
 
-        return tasks_duration
-    
 
-def calc_tasks_mean_exec_time(traces_dir):
-
-    durations = []
+def list_trace_files(traces_dir):
+    return [traces_dir + '/' + trace_path for trace_path in sorted(os.listdir(traces_dir))]
 
-    for trace_path in os.listdir(traces_dir):
-        full_path = traces_dir + '/' + trace_path
-        #print(f'Reading ${full_path}')
 
-        tasks_duration = calc_tasks_exe_time_for_file(full_path)
-        durations.append(tasks_duration)
+def to_durations_matrix(durations):
+    # Durations of every run (rows) and task (columns)
+    durations = list(durations)
 
     size = len(durations[0])
     for d in durations:
             assert size == len(d), 'All tasks_duration sets must have the same size'
-        
 
-    mean_durations = []
-    for i in range(len(durations[0])):
+    return np.array(durations, dtype=np.float64).reshape(len(durations), size)
 
-        sum = 0
-        for tasks_duration in durations:
-            sum += tasks_duration[i]
 
-        mean = sum / len(durations)
-        mean_durations.append(mean)
+def calc_tasks_exec_time_stats(durations):
+    # Sum of the runs in order, as the mean was calculated before
+    stats = {
+        'mean': durations.sum(axis=0) / len(durations),
+        'std': durations.std(axis=0, ddof=1) if len(durations) > 1 else np.zeros(durations.shape[1]),
+        'min': durations.min(axis=0),
+        'max': durations.max(axis=0)
+    }
+    for p, values in zip(PERCENTILES, np.percentile(durations, PERCENTILES, axis=0)):
+        stats[f'p{p}'] = values
+    return stats
 
-    return mean_durations
+
+def calc_tasks_mean_exec_time(traces_dir):
+    durations = to_durations_matrix(map(calc_tasks_exe_time_for_file, list_trace_files(traces_dir)))
+    return calc_tasks_exec_time_stats(durations)['mean'].tolist()
+
+def save_tasks_exec_time_stats(processors_stats, stats_file):
+    # One row per processor and task with every statistic of its runs
+    with open(stats_file, 'w', newline='') as f:
+        writer = None
+        for processor, stats in processors_stats:
+            if writer is None:
+                writer = csv.writer(f)
+                writer.writerow(['processor_id', 'processor', 'task'] + list(stats.keys()))
+            for task, values in enumerate(zip(*[v.tolist() for v in stats.values()])):
+                writer.writerow([processor['id'], processor['name'], task] + list(values))
 
 def get_task_computation_cost_env_variable(graph, task, rank, comp_cost):
     return f'OMPCLUSTER_HEFT_COMP_G_{graph}_T_{task}_P_{rank}={comp_cost}'
@@ -70,32 +96,39 @@ if __name__ == '__main__':
         }
     ]
 
-    
-    for processor in processors:
-        tasks_mean_exec_time  = calc_tasks_mean_exec_time(processor['traces_dir'])
-
-        calc_energy = lambda duration: duration * processor['power_in_W']
-        tasks_energy = list(
-            map(calc_energy, tasks_mean_exec_time)
-        )
-
-        # print(processor['name'])
-        # print(
-        #     functools.reduce(lambda a, b: a+b, tasks_mean_exec_time)
-        # )
-        # print(
-        #     functools.reduce(lambda a, b: a+b, tasks_energy)
-        # )
-
-        for i in range(len(tasks_mean_exec_time)):
-            graph = 1
-            task = i
-            rank = processor['id']
-
-            exec_time = tasks_mean_exec_time[i]
-            comp_cost_env_var = get_task_computation_cost_env_variable(graph, task, rank, exec_time)
-            print(comp_cost_env_var)
-
-            energy = tasks_energy[i]
-            energy_env_var = get_task_energy_env_variable(graph, task, rank, energy)
-            print(energy_env_var)
+    # The trace files of every processor are read in the same pool
+    with ProcessPoolExecutor() as executor:
+        processors_durations = [
+            executor.map(calc_tasks_exe_time_for_file, list_trace_files(processor['traces_dir']))
+            for processor in processors
+        ]
+
+        processors_stats = []
+        for processor, durations in zip(processors, processors_durations):
+            stats = calc_tasks_exec_time_stats(to_durations_matrix(durations))
+            processors_stats.append((processor, stats))
+            tasks_mean_exec_time = stats['mean']
+            tasks_energy = tasks_mean_exec_time * processor['power_in_W']
+
+            print(
+                '{}: {} tasks, total mean {:.4f}s, max std {:.4f}s'.format(
+                    processor['name'], len(tasks_mean_exec_time), tasks_mean_exec_time.sum(), stats['std'].max()
+                ),
+                file=sys.stderr
+            )
+
+            for i in range(len(tasks_mean_exec_time)):
+                graph = 1
+                task = i
+                rank = processor['id']
+
+                exec_time = tasks_mean_exec_time[i].item()
+                comp_cost_env_var = get_task_computation_cost_env_variable(graph, task, rank, exec_time)
+                print(comp_cost_env_var)
+
+                energy = tasks_energy[i].item()
+                energy_env_var = get_task_energy_env_variable(graph, task, rank, energy)
+                print(energy_env_var)
+
+    save_tasks_exec_time_stats(processors_stats, STATS_FILE)
+    print(f'Statistics of every task written to {STATS_FILE}', file=sys.stderr)
@@ -1,40 +1,195 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+from pv_series import open_pv_series
+
 def to_date_time(date_time_str):
     date_format = '%Y-%m-%d %H:%M:%S'
     return datetime.strptime(date_time_str, date_format)
 
+OUTPUT_FORMATS = ['variables', 'ranges', 'table']
+
+TABLE_HEADER = 'processor_id,first_interval,last_interval,pv_available_power'
+
+VARIABLE_PREFIX = 'OMPCLUSTER_MOHEFT_GREEN_P_'
+
 def create_env_variable(processor_id, time, pv_available_power):
     # OMPCLUSTER_MOHEFT_GREEN_P_x_I_y_S
     return f'OMPCLUSTER_MOHEFT_GREEN_P_{processor_id}_I_{time}_S={pv_available_power}'
 
 
-def create_env_variables_for_processor(processor):
+def create_ranged_env_variable(processor_id, first_time, last_time, pv_available_power):
+    # OMPCLUSTER_MOHEFT_GREEN_P_x_I_y_z_S, the power of the intervals y to z
+    # (both included)
+    return f'OMPCLUSTER_MOHEFT_GREEN_P_{processor_id}_I_{first_time}_{last_time}_S={pv_available_power}'
+
+
+def processor_power(processor):
+    pv_series = open_pv_series(processor['pv_energy_file'])
+    # The products of the Python floats of the CSV
+    return pv_series.intervals, processor['pv_area'] * pv_series.irradiance
+
+
+def power_runs(intervals, powers):
+    # Runs of consecutive intervals with the same power:
+    # (first interval, last interval, power) of each run
+    if len(powers) == 0:
+        return intervals[:0], intervals[:0], powers
+    firsts = np.flatnonzero(np.diff(powers, prepend=np.nan) != 0)
+    lasts = np.append(firsts[1:], len(powers)) - 1
+    return intervals[firsts], intervals[lasts], powers[firsts]
+
+
+def create_env_variables_for_processor(processor, ranged=False):
+    processor_id = processor['processor_id']
+    intervals, powers = processor_power(processor)
+
+    if ranged:
+        firsts, lasts, powers = power_runs(intervals, powers)
+        return [
+            create_ranged_env_variable(processor_id, first_time, last_time, pv_available_power)
+            for first_time, last_time, pv_available_power in zip(firsts.tolist(), lasts.tolist(), powers.tolist())
+        ]
+
+    return [
+        create_env_variable(processor_id, time, pv_available_power)
+        for time, pv_available_power in zip(intervals.tolist(), powers.tolist())
+    ]
+
+
+def _processor_lines(processor, output_format):
+    # Lines of a processor as a single string
     processor_id = processor['processor_id']
-    pv_energy_file = open(processor['pv_energy_file'])
-    pv_area = processor['pv_area']
+    intervals, powers = processor_power(processor)
+    if len(powers) == 0:
+        return ''
 
-    env_variables = []
+    if output_format == 'variables':
+        line = create_env_variable(processor_id, '{}', '{}')
+        columns = [intervals, powers]
+    else:
+        line = create_ranged_env_variable(processor_id, '{}', '{}', '{}') if output_format == 'ranges' else f'{processor_id},{{}},{{}},{{}}'
+        columns = power_runs(intervals, powers)
 
-    next(pv_energy_file, None) # Skip Header
-    line = next(pv_energy_file, None)
-    while line is not None:
-        
-        row = line.strip().split(',')
-        dt, time, solar_irradiance = row[0], int(row[1]), float(row[2])
-        pv_available_power = pv_area * solar_irradiance
+    return '\n'.join(map(line.format, *[column.tolist() for column in columns])) + '\n'
 
-        env_variables.append(
-            create_env_variable(processor_id, time, pv_available_power)
-        )
 
-        line = next(pv_energy_file, None)
-    return env_variables
+def write_moheft_green_variables(processors, output_file, output_format='variables', workers=None):
+    # Writes the green power of every processor, one line per interval
+    # (variables), one line per run of intervals with the same power (ranges)
+    # or as a CSV table of the runs (table). The processors are converted by
+    # parallel workers and written in order through a buffered file.
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception(f'Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}')
+
+    args = [processors, [output_format] * len(processors)]
+    with open(output_file, 'w', buffering=1 << 20) as f:
+        if output_format == 'table':
+            f.write(f'{TABLE_HEADER}\n')
+
+        if workers == 1 or len(processors) <= 1:
+            for lines in map(_processor_lines, *args):
+                f.write(lines)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for lines in executor.map(_processor_lines, *args):
+                    f.write(lines)
+
+
+def load_moheft_green_variables(file_name):
+    # Reads a file of any output format as the runs of each processor:
+    # processor_id -> (first intervals, last intervals, powers). Plain
+    # variables are runs of a single interval.
+    with open(file_name) as f:
+        lines = f.read().split()
+    if lines and lines[0] == TABLE_HEADER:
+        rows = [line.split(',') for line in lines[1:]]
+    else:
+        rows = []
+        for line in lines:
+            variable, power = line.split('=')
+            fields = variable[len(VARIABLE_PREFIX):-len('_S')].split('_') # x, I, y[, z]
+            rows.append([fields[0], fields[2], fields[-1], power])
+
+    if not rows:
+        return {}
+    rows = np.array(rows)
+    processor_ids = rows[:, 0].astype(np.int64)
+
+    runs = {}
+    for processor_id in dict.fromkeys(processor_ids.tolist()):
+        processor_rows = rows[processor_ids == processor_id]
+        runs[processor_id] = (processor_rows[:, 1].astype(np.int64), processor_rows[:, 2].astype(np.int64), processor_rows[:, 3].astype(np.float64))
+    return runs
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_write_moheft_green_variables():
+    import os, tempfile
+
+    irradiance = [0, 0, 0, 21, 25.5, 25.5, 0.1, 0, 0, 300, 300]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        processors = []
+        for processor_id in range(3):
+            csv_file = os.path.join(tmp_dir, f'pv_{processor_id}.csv')
+            with open(csv_file, 'w') as f:
+                f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+                for i, value in enumerate(irradiance[processor_id:]):
+                    f.write(f'2016-04-12 00:{i:02d}:01,{i + 1},{value}\n')
+            processors.append({'processor_id': processor_id, 'pv_energy_file': csv_file, 'pv_area': [1, 2.5, 0.3][processor_id]})
+
+        # Same lines of create_env_variables_for_processor
+        expected = []
+        for processor in processors:
+            expected.extend(create_env_variables_for_processor(processor))
+
+        for workers in [1, 2]:
+            output_file = os.path.join(tmp_dir, 'variables.txt')
+            write_moheft_green_variables(processors, output_file, 'variables', workers)
+            with open(output_file) as f:
+                assert f.read().splitlines() == expected, 'Variables should be the ones of create_env_variables_for_processor'
+
+        output_file = os.path.join(tmp_dir, 'ranges.txt')
+        write_moheft_green_variables(processors, output_file, 'ranges')
+        with open(output_file) as f:
+            lines = f.read().splitlines()
+        assert lines[:5] == [
+            'OMPCLUSTER_MOHEFT_GREEN_P_0_I_1_3_S=0.0',
+            'OMPCLUSTER_MOHEFT_GREEN_P_0_I_4_4_S=21.0',
+            'OMPCLUSTER_MOHEFT_GREEN_P_0_I_5_6_S=25.5',
+            'OMPCLUSTER_MOHEFT_GREEN_P_0_I_7_7_S=0.1',
+            'OMPCLUSTER_MOHEFT_GREEN_P_0_I_8_9_S=0.0'
+        ], 'Runs of equal power should be merged'
+        assert lines == sum([create_env_variables_for_processor(processor, ranged=True) for processor in processors], []), 'Ranges should be the ones of create_env_variables_for_processor'
+
+        # Every format has the power of every interval
+        variables = load_moheft_green_variables(os.path.join(tmp_dir, 'variables.txt'))
+        for output_format in ['ranges', 'table']:
+            output_file = os.path.join(tmp_dir, f'{output_format}.txt')
+            write_moheft_green_variables(processors, output_file, output_format, 2)
+            runs = load_moheft_green_variables(output_file)
+
+            assert list(runs) == list(variables), f'{output_format} should have every processor'
+            for processor_id, (firsts, lasts, powers) in runs.items():
+                intervals, _, expected_powers = variables[processor_id]
+                run = np.searchsorted(firsts, intervals, side='right') - 1
+                assert np.all(lasts[run] >= intervals), f'{output_format} should cover every interval of processor {processor_id}'
+                assert np.array_equal(powers[run], expected_powers), f'{output_format} should have the power of every interval of processor {processor_id}'
 
 
 if __name__ == '__main__':
+    __test_write_moheft_green_variables()
 
     output_file = './../data/ompc/moheft_energy_variables.txt'
+    #output_file = './../data/ompc/moheft_energy_variables_ranges.txt'
 
     processors = [
         {
@@ -64,14 +219,7 @@ if __name__ == '__main__':
         }
     ]
 
-    env_variables = []
-
-    for processor in processors:
-        env_variables.extend(
-            create_env_variables_for_processor(processor)
-        )
-        
-    f = open(output_file, 'w')
-    for env_variable in env_variables:
-        f.write(f'{env_variable}\n')
-    f.close()
\ No newline at end of file
+    # variables, ranges or table, see write_moheft_green_variables
+    output_format = 'variables'
+
+    write_moheft_green_variables(processors, output_file, output_format)
@@ -1,83 +1,262 @@
 import csv
 
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import numpy as np
+
+INTERVAL_SIZE = 300 # 300s = 5min
+ERROR_TOLERANCE_IN_SECONDS = 2
+
+EPOCH = datetime(1970, 1, 1)
+HOUR = 3600
+
 
 def to_date_time(date_time_str):
     date_format = '%Y-%m-%d %H:%M:%S'
     return datetime.strptime(date_time_str, date_format)
 
 
-def process_photovolta_data(source_file, new_file):
+# The timestamps of the raw data are in local time, as datetime.timestamp and
+# datetime.fromtimestamp use them. The UTC offset only changes at whole hours,
+# so it is calculated once per hour instead of once per row.
+
+def local_to_timestamp(naive_seconds):
+    hours, index = np.unique(naive_seconds // HOUR, return_inverse=True)
+    offsets = np.array([h * HOUR - (EPOCH + timedelta(hours=h)).timestamp() for h in hours.tolist()], dtype=np.int64)
+    return naive_seconds - offsets[index]
+
+def timestamp_to_local(timestamps):
+    hours, index = np.unique(timestamps // HOUR, return_inverse=True)
+    offsets = np.array([(datetime.fromtimestamp(h * HOUR) - EPOCH).total_seconds() - h * HOUR for h in hours.tolist()], dtype=np.int64)
+    return timestamps + offsets[index]
+
+def to_date_time_strings(naive_seconds):
+    date_times = np.datetime_as_string(naive_seconds.astype('datetime64[s]'), unit='s')
+    return np.char.replace(date_times, 'T', ' ')
+
+
+def snap_intervals(time_stamp_diff, fix_gaps=True):
+    # Number of intervals of each row from the previous one, with the
+    # anomalous rows: the ones whose diff is not a multiple of INTERVAL_SIZE
+    # (within ERROR_TOLERANCE_IN_SECONDS). They are snapped to the nearest
+    # interval with fix_gaps (0 intervals when dropped), else 0 as before.
+
+    # Adjust intervals with a small error
+    m = time_stamp_diff % INTERVAL_SIZE
+    adjusted_diff = time_stamp_diff.copy()
+    adjusted_diff[m <= ERROR_TOLERANCE_IN_SECONDS] -= m[m <= ERROR_TOLERANCE_IN_SECONDS]
+    adjusted_diff[m >= INTERVAL_SIZE - ERROR_TOLERANCE_IN_SECONDS] += INTERVAL_SIZE - m[m >= INTERVAL_SIZE - ERROR_TOLERANCE_IN_SECONDS]
+
+    intervals = adjusted_diff // INTERVAL_SIZE
+    aligned = (adjusted_diff % INTERVAL_SIZE == 0) & (intervals > 0)
+    aligned[0] = True
+    intervals[0] = 1
+
+    anomalous = np.flatnonzero(~aligned)
+    if fix_gaps:
+        intervals[anomalous] = np.maximum(np.rint(time_stamp_diff[anomalous] / INTERVAL_SIZE).astype(np.int64), 0)
+    else:
+        intervals[anomalous] = 0
+    return intervals, anomalous
 
-    INTERVAL_SIZE = 300 # 300s = 5min
-    ERROR_TOLERANCE_IN_SECONDS = 2
+
+def process_photovolta_data(source_file, new_file, fix_gaps=True, anomalies_file=None):
+    # Resamples the raw irradiance data to the INTERVAL_SIZE grid: gaps that
+    # are multiples of INTERVAL_SIZE (within ERROR_TOLERANCE_IN_SECONDS) are
+    # filled with zero irradiance (no solar irradiation). With fix_gaps, the
+    # rows of other gaps are snapped to the nearest interval and repeated (or
+    # out of order) rows are dropped; otherwise they keep the previous offset,
+    # as before.
+    # Returns the anomalies found.
 
     with open(source_file, 'r', encoding='UTF-8') as photovolta_file:
-        with open(new_file, 'w', encoding='UTF8') as photovolta_new_file:
-            writer = csv.writer(photovolta_new_file)
-    
-            previous_time_stamp = None
-            offset = 0
-            
-            for line_number, line in enumerate(photovolta_file):
-                if(line_number == 0): 
-                    writer.writerow(['timestamp', 'interval_in_seconds', 'solar_irradiance_in_W_m2'])
-                    continue # skip header
-                
-                row = line.strip().split(',')
-                date_time = to_date_time(row[0])
-                solar_irradiance = row[1]
-                
-                time_stamp = date_time.timestamp()
-                if previous_time_stamp is None:
-                    previous_time_stamp = time_stamp
-                    time_stamp_diff = 0
-                    diff = 0
-                else:
-                    time_stamp_diff = time_stamp - previous_time_stamp
-                    diff = time_stamp_diff - INTERVAL_SIZE
-                
-                # Adjust intervals with a small error
-                m = time_stamp_diff % INTERVAL_SIZE
-                if m <= ERROR_TOLERANCE_IN_SECONDS:
-                    time_stamp_diff -= m
-                elif m >= (INTERVAL_SIZE - ERROR_TOLERANCE_IN_SECONDS):
-                    time_stamp_diff += (INTERVAL_SIZE-m)
-                
-                
-                if diff == 0:
-                    # The time stamp diff is equal to INTERVAL_SIZE
-                    offset+=INTERVAL_SIZE
-                    
-                elif diff >= -ERROR_TOLERANCE_IN_SECONDS and diff <= ERROR_TOLERANCE_IN_SECONDS:
-                    # Some intervals have size equal between INTERVAL_SIZE-2 and INTERVAL_SIZE+2
-                    offset+=INTERVAL_SIZE
-                
-                elif(time_stamp_diff > INTERVAL_SIZE and time_stamp_diff % INTERVAL_SIZE == 0):
-                    # Include omitted intervalds due no solar irradiation
-                
-                    omitted_intervals = int(time_stamp_diff / INTERVAL_SIZE) - 1
-                    
-                    for i in range(omitted_intervals):
-                        omitted_time_stamp = previous_time_stamp + (i+1)*INTERVAL_SIZE
-                        omitted_date_time = datetime.fromtimestamp(omitted_time_stamp)
-                        omitted_solar_irradiance = 0
-                        offset+=INTERVAL_SIZE
-                        #print(f'{omitted_date_time} {INTERVAL_SIZE} {omitted_solar_irradiance} ({i}) {offset}')
-                        
-                        writer.writerow([omitted_date_time, offset, omitted_solar_irradiance])
-                        
-                    offset+=INTERVAL_SIZE
-                else:
-                    print(date_time)
-                    print(f'Error: Diff={diff} cannot be handled')
-               
-                #print(f'{date_time} {time_stamp_diff} {solar_irradiance} {offset}')
-                writer.writerow([date_time, offset, solar_irradiance])
-                
-                previous_time_stamp = time_stamp
+        next(photovolta_file, None) # skip header
+        rows = [line.strip().split(',') for line in photovolta_file if line.strip()]
+
+    date_time_strings = np.array([row[0] for row in rows])
+    solar_irradiance = np.array([row[1] for row in rows])
+
+    naive_seconds = date_time_strings.astype('datetime64[s]').astype(np.int64)
+    time_stamps = local_to_timestamp(naive_seconds)
+
+    if fix_gaps:
+        # Diffs against the last kept row, so the rows dropped (repeated, out of
+        # order or less than half an interval after it) do not move the ones
+        # after them. A row only depends on the rows before it, so the kept
+        # rows are found again until they do not change.
+        kept = np.ones(len(time_stamps), dtype=bool)
+        while True:
+            last_kept = np.maximum.accumulate(np.where(kept, time_stamps, time_stamps[0]))
+            previous_time_stamps = np.concatenate((time_stamps[:1], last_kept[:-1]))
+            time_stamp_diff = time_stamps - previous_time_stamps
+            intervals, anomalous = snap_intervals(time_stamp_diff, fix_gaps)
+            if np.array_equal(intervals > 0, kept):
+                break
+            kept = intervals > 0
+    else:
+        previous_time_stamps = np.concatenate((time_stamps[:1], time_stamps[:-1]))
+        time_stamp_diff = time_stamps - previous_time_stamps
+        intervals, anomalous = snap_intervals(time_stamp_diff, fix_gaps)
+        kept = np.ones(len(intervals), dtype=bool)
+
+    omitted_intervals = np.maximum(intervals - 1, 0)
+
+    offsets = np.cumsum(intervals) * INTERVAL_SIZE
+
+    anomalies = []
+    for i in anomalous.tolist():
+        if not fix_gaps:
+            action = 'unhandled'
+        elif kept[i]:
+            action = 'snapped'
+        else:
+            action = 'dropped'
+        anomalies.append({
+            'line_number': i + 2,
+            'timestamp': str(date_time_strings[i]),
+            'diff_in_seconds': int(time_stamp_diff[i]),
+            'omitted_intervals': int(omitted_intervals[i]),
+            'action': action
+        })
+
+    # Each kept row is written after the omitted intervals before it
+    row_of = np.repeat(np.arange(len(rows)), np.where(kept, omitted_intervals + 1, 0))
+    group_start = np.concatenate(([0], np.cumsum(np.where(kept, omitted_intervals + 1, 0))[:-1]))
+    k = np.arange(len(row_of)) - group_start[row_of]
+    omitted = k < omitted_intervals[row_of]
+
+    new_offsets = offsets[row_of]
+    new_date_times = date_time_strings[row_of]
+    new_solar_irradiance = solar_irradiance[row_of]
+
+    omitted_rows = np.flatnonzero(omitted)
+    if len(omitted_rows) > 0:
+        omitted_row_of = row_of[omitted_rows]
+        omitted_k = k[omitted_rows] + 1
+        omitted_time_stamps = previous_time_stamps[omitted_row_of] + omitted_k * INTERVAL_SIZE
+
+        new_offsets[omitted_rows] = offsets[omitted_row_of] - (intervals[omitted_row_of] - omitted_k) * INTERVAL_SIZE
+        new_date_times = new_date_times.astype(object)
+        new_date_times[omitted_rows] = to_date_time_strings(timestamp_to_local(omitted_time_stamps))
+        new_solar_irradiance = new_solar_irradiance.astype(object)
+        new_solar_irradiance[omitted_rows] = '0'
+
+    lines = map(','.join, zip(new_date_times.tolist(), new_offsets.astype(str).tolist(), new_solar_irradiance.tolist()))
+    with open(new_file, 'w', encoding='UTF8', newline='') as photovolta_new_file:
+        photovolta_new_file.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\r\n')
+        photovolta_new_file.write('\r\n'.join(lines))
+        photovolta_new_file.write('\r\n')
+
+    if anomalies_file is not None:
+        with open(anomalies_file, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['line_number', 'timestamp', 'diff_in_seconds', 'omitted_intervals', 'action'])
+            writer.writeheader()
+            writer.writerows(anomalies)
+
+    for anomaly in anomalies:
+        print(f"{anomaly['timestamp']} Diff={anomaly['diff_in_seconds'] - INTERVAL_SIZE}s {anomaly['action']}")
+
+    return anomalies
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_process_photovolta_data():
+    import os, tempfile
+
+    raw_rows = [
+        ('2016-04-12 00:00:01', '0'),
+        ('2016-04-12 00:05:02', '21'),   # 1s late
+        ('2016-04-12 00:20:01', '25.5'), # 2 omitted intervals
+        ('2016-04-12 00:20:01', '25.5'), # repeated
+        ('2016-04-12 00:26:40', '30'),   # unexpected gap
+        ('2016-04-12 00:31:40', '0')
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_file = os.path.join(tmp_dir, 'raw.csv')
+        with open(source_file, 'w') as f:
+            f.write('timestamp,solar_irradiance_in_W_m2\n')
+            for row in raw_rows:
+                f.write(','.join(row) + '\n')
+
+        new_file = os.path.join(tmp_dir, 'new.csv')
+        anomalies_file = os.path.join(tmp_dir, 'anomalies.csv')
+        anomalies = process_photovolta_data(source_file, new_file, anomalies_file=anomalies_file)
+
+        with open(new_file) as f:
+            rows = [line.strip().split(',') for line in f][1:]
+
+        expected = [
+            ['2016-04-12 00:00:01', '300', '0'],
+            ['2016-04-12 00:05:02', '600', '21'],
+            ['2016-04-12 00:10:02', '900', '0'],
+            ['2016-04-12 00:15:02', '1200', '0'],
+            ['2016-04-12 00:20:01', '1500', '25.5'],
+            ['2016-04-12 00:26:40', '1800', '30'],
+            ['2016-04-12 00:31:40', '2100', '0']
+        ]
+        assert rows == expected, f'Rows {rows} should be {expected}'
+
+        assert [a['action'] for a in anomalies] == ['dropped', 'snapped'], 'Repeated row should be dropped and gap snapped'
+        assert [a['line_number'] for a in anomalies] == [5, 6], 'Anomalies should have the line of the raw file'
+
+        with open(anomalies_file) as f:
+            assert len(f.readlines()) == len(anomalies) + 1, 'Anomalies should be written to the report'
+
+        # As before, the rows of unexpected gaps keep the previous offset
+        process_photovolta_data(source_file, new_file, fix_gaps=False)
+        with open(new_file) as f:
+            offsets = [line.strip().split(',')[1] for line in f][1:]
+        assert offsets == ['300', '600', '900', '1200', '1500', '1500', '1500', '1800'], f'Offsets {offsets} are not the same as before'
+
+
+def __test_process_photovolta_data_out_of_order():
+    import os, tempfile
+
+    raw_rows = [
+        ('2016-04-12 00:00:01', '0'),
+        ('2016-04-12 00:05:01', '10'),
+        ('2016-04-12 00:10:01', '5'),
+        ('2016-04-12 00:05:30', '7'), # out of order
+        ('2016-04-12 00:11:01', '8'), # too close to 00:10:01
+        ('2016-04-12 00:15:01', '9'),
+        ('2016-04-12 00:25:01', '0')  # 1 omitted interval
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_file = os.path.join(tmp_dir, 'raw.csv')
+        with open(source_file, 'w') as f:
+            f.write('timestamp,solar_irradiance_in_W_m2\n')
+            for row in raw_rows:
+                f.write(','.join(row) + '\n')
+
+        new_file = os.path.join(tmp_dir, 'new.csv')
+        anomalies = process_photovolta_data(source_file, new_file)
+
+        with open(new_file) as f:
+            rows = [line.strip().split(',') for line in f][1:]
+
+        # The rows after the dropped ones are diffed against 00:10:01
+        expected = [
+            ['2016-04-12 00:00:01', '300', '0'],
+            ['2016-04-12 00:05:01', '600', '10'],
+            ['2016-04-12 00:10:01', '900', '5'],
+            ['2016-04-12 00:15:01', '1200', '9'],
+            ['2016-04-12 00:20:01', '1500', '0'],
+            ['2016-04-12 00:25:01', '1800', '0']
+        ]
+        assert rows == expected, f'Rows {rows} should be {expected}'
+        assert [(a['line_number'], a['action']) for a in anomalies] == [(5, 'dropped'), (6, 'dropped')], 'Out of order and close rows should be dropped'
+
 
 if __name__ == '__main__':
+    __test_process_photovolta_data()
+    __test_process_photovolta_data_out_of_order()
+
     process_photovolta_data('../data/photovolta_2016_raw_data_part_1.csv', '../data/photovolta_2016_part_1.csv')
     process_photovolta_data('../data/photovolta_2016_raw_data_part_2.csv', '../data/photovolta_2016_part_2.csv')
-
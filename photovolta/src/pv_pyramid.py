@@ -0,0 +1,218 @@
+import os
+
+import numpy as np
+
+from pv_series import open_pv_series
+
+# Precomputed sums of a PV series (see pv_series.py), saved next to the series
+# file. The green energy of the interval i of the series, for a panel of
+# 1 m2, is duration_i * irradiance_i (1W * 1s = 1J), and
+#
+#   prefix[i] = energy of the intervals before i
+#
+# so the energy of any [t1, t2) is a difference of prefix sums. The levels
+# have the count, mean and m2 (sum of squared differences to the mean) of the
+# irradiance, and the energy, of blocks of rows of the series (from its
+# first row): each level is merged from the blocks of the level below it.
+
+PYRAMID_EXTENSION = '.pvp.npz'
+PYRAMID_VERSION = 2 # 2: float64 irradiance of the CSV
+
+LEVELS = {
+    '5min': 1,
+    'hourly': 12,
+    'daily': 288,
+    'weekly': 2016
+}
+
+
+def pyramid_file_name(series_file):
+    return os.path.splitext(series_file)[0] + PYRAMID_EXTENSION
+
+
+def merge_blocks(count, mean, m2, energy, k):
+    # Blocks of k consecutive blocks, merged with the pairwise update of Chan
+    # et al. The last block may be smaller.
+    blocks = -(-len(count) // k)
+    pad = blocks * k - len(count)
+
+    count, mean, m2, energy = [np.concatenate((a, np.zeros(pad))).reshape(blocks, k) for a in [count, mean, m2, energy]]
+
+    merged_count = count.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged_mean = np.where(merged_count > 0, (count * mean).sum(axis=1) / merged_count, 0)
+    merged_m2 = m2.sum(axis=1) + (count * (mean - merged_mean[:, None])**2).sum(axis=1)
+
+    return merged_count, merged_mean, merged_m2, energy.sum(axis=1)
+
+
+class PVPyramid:
+
+    def __init__(self, starts, ends, irradiance, levels):
+        self.starts = starts
+        self.ends = ends
+        self.irradiance = irradiance
+        self.levels = levels # rows of a block -> (count, mean, m2, energy)
+
+        self.prefix = np.concatenate(([0.0], np.cumsum((ends - starts) * irradiance)))
+
+        # Regular series have the interval of a time by arithmetic
+        durations = ends - starts
+        self.step = durations[0].item() if len(durations) > 0 and np.all(durations == durations[0]) else 0
+
+    @classmethod
+    def build(cls, pv_series):
+        irradiance = np.array(pv_series.irradiance)
+        ends = pv_series.intervals.astype(np.float64)
+
+        # The interval i covers [ends[i-1], ends[i]), the first one has the
+        # size of the step of the series
+        if pv_series.step > 0:
+            first_duration = pv_series.step
+        elif len(ends) > 1:
+            first_duration = ends[1] - ends[0]
+        else:
+            first_duration = ends[0] if len(ends) > 0 else 0
+        starts = np.concatenate((ends[:1] - first_duration, ends[:-1]))
+
+        count = np.ones(len(irradiance))
+        levels = {1: (count, irradiance, np.zeros(len(irradiance)), (ends - starts) * irradiance)}
+
+        rows = 1
+        for level_rows in sorted(LEVELS.values())[1:]:
+            levels[level_rows] = merge_blocks(*levels[rows], level_rows // rows)
+            rows = level_rows
+
+        return cls(starts, ends, irradiance, levels)
+
+    def save(self, pyramid_file, source_mtime):
+        arrays = {'starts': self.starts, 'ends': self.ends, 'irradiance': self.irradiance}
+        for rows, level in self.levels.items():
+            for name, values in zip(['count', 'mean', 'm2', 'energy'], level):
+                arrays[f'level_{rows}_{name}'] = values
+
+        tmp_file = f'{pyramid_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, version=PYRAMID_VERSION, source_mtime=source_mtime, **arrays)
+        os.replace(tmp_file, pyramid_file)
+
+    @classmethod
+    def load(cls, pyramid_file, source_mtime):
+        # None if the pyramid was not built from the current series
+        try:
+            with np.load(pyramid_file) as data:
+                if data['version'].item() != PYRAMID_VERSION or data['source_mtime'].item() != source_mtime:
+                    return None
+                levels = {
+                    rows: tuple(data[f'level_{rows}_{name}'] for name in ['count', 'mean', 'm2', 'energy'])
+                    for rows in LEVELS.values()
+                }
+                return cls(data['starts'], data['ends'], data['irradiance'], levels)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __interval(self, t):
+        if self.step > 0:
+            i = np.floor((t - self.starts[0]) / self.step).astype(np.int64)
+        else:
+            i = np.searchsorted(self.ends, t, side='right')
+        return np.clip(i, 0, len(self) - 1)
+
+    def energy_until(self, t, pv_area=1):
+        # Green energy (J) from the start of the series until t
+        t = np.clip(np.asarray(t, dtype=np.float64), self.starts[0], self.ends[-1])
+        i = self.__interval(t)
+        energy = pv_area * (self.prefix[i] + (t - self.starts[i]) * self.irradiance[i])
+        return energy.item() if np.ndim(energy) == 0 else energy
+
+    def energy_between(self, t1, t2, pv_area=1):
+        # Green energy (J) in [t1, t2), in the time of the series
+        # (interval_in_seconds). Times out of the series have no energy.
+        return self.energy_until(t2, pv_area) - self.energy_until(t1, pv_area)
+
+    def stats(self, rows):
+        # (count, mean, m2, energy) of the blocks of rows rows of the series,
+        # merged from the biggest level whose blocks fit in them
+        level_rows = max(r for r in self.levels if rows % r == 0)
+        if level_rows == rows:
+            return self.levels[rows]
+        return merge_blocks(*self.levels[level_rows], rows // level_rows)
+
+    def level(self, name):
+        return self.stats(LEVELS[name])
+
+
+def open_pv_pyramid(pv_file):
+    # Accepts the files of open_pv_series. The pyramid is built on the first
+    # use and again when the series changes.
+    pv_series = open_pv_series(pv_file)
+    pyramid_file = pyramid_file_name(pv_series.series_file)
+
+    pyramid = PVPyramid.load(pyramid_file, pv_series.source_mtime)
+    if pyramid is None:
+        pyramid = PVPyramid.build(pv_series)
+        pyramid.save(pyramid_file, pv_series.source_mtime)
+    return pyramid
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_pv_pyramid():
+    import statistics, tempfile
+    from datetime import datetime, timedelta
+
+    irradiance = [float((i * 37) % 1000) / 4 for i in range(3000)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, 'pv.csv')
+        with open(csv_file, 'w') as f:
+            f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+            for i, value in enumerate(irradiance):
+                f.write(f'{datetime(2016, 4, 12) + timedelta(seconds=300 * i)},{300 * (i + 1)},{value}\n')
+
+        pyramid = open_pv_pyramid(csv_file)
+        assert os.path.exists(pyramid_file_name(csv_file)), 'Pyramid should be saved next to the series'
+
+        # Energy of the whole intervals and of parts of them
+        for t1, t2 in [(0, 300 * 3000), (300, 600), (150, 1050), (-500, 10**7), (700, 700)]:
+            expected = 0
+            for i, value in enumerate(irradiance):
+                overlap = min(t2, 300 * (i + 1)) - max(t1, 300 * i)
+                if overlap > 0:
+                    expected += 2 * overlap * value
+            found = pyramid.energy_between(t1, t2, pv_area=2)
+            assert abs(found - expected) < 1e-6, f'Energy between {t1} and {t2} should be {expected} instead of {found}'
+
+        batch = pyramid.energy_between(np.array([0, 150]), np.array([300, 1050]))
+        assert np.allclose(batch, [pyramid.energy_between(0, 300), pyramid.energy_between(150, 1050)]), 'Batch queries differ'
+
+        # Levels, as the statistics of the rows of each block
+        for rows in [12, 288, 2016, 8640, 7]:
+            count, mean, m2, energy = pyramid.stats(rows)
+            assert len(count) == -(-len(irradiance) // rows), f'Blocks of {rows} rows should cover the series'
+            for block in [0, len(count) - 1]:
+                values = irradiance[block * rows:(block + 1) * rows]
+                assert count[block] == len(values), f'Block {block} of {rows} rows should have {len(values)} rows'
+                assert abs(mean[block] - statistics.mean(values)) < 1e-9, f'Block {block} of {rows} rows has a wrong mean'
+                if len(values) > 1:
+                    std = (m2[block] / (count[block] - 1))**0.5
+                    assert abs(std - statistics.stdev(values)) < 1e-9, f'Block {block} of {rows} rows has a wrong std'
+                assert abs(energy[block] - 300 * sum(values)) < 1e-6, f'Block {block} of {rows} rows has a wrong energy'
+
+        # Loaded from the file
+        loaded = open_pv_pyramid(csv_file)
+        assert np.array_equal(loaded.level('weekly')[1], pyramid.level('weekly')[1]), 'Saved pyramid should be loaded'
+
+
+if __name__ == '__main__':
+    __test_pv_pyramid()
+
+    for csv_file in ['../data/photovolta_2016_part_1.csv', '../data/photovolta_2016_part_2.csv']:
+        open_pv_pyramid(csv_file)
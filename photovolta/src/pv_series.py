@@ -0,0 +1,188 @@
+import os
+import struct
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Binary columnar version of the processed photovolta CSV files
+# (timestamp,interval_in_seconds,solar_irradiance_in_W_m2).
+#
+# Layout (little endian):
+#   header      64 bytes, see HEADER_FORMAT
+#   timestamps  int64[count], seconds since 1970-01-01 of the naive timestamp
+#   irradiance  float64[count], solar_irradiance_in_W_m2, the values of the
+#               CSV (as float(row[2])), so the green energy is the same
+#   intervals   int32[count], interval_in_seconds
+#
+# The header stores the interval size when the series is regular, so the row
+# of an interval is found by arithmetic; otherwise it is found by binary search.
+
+PV_SERIES_EXTENSION = '.pvs'
+
+MAGIC = b'PVSERIE2' # 1 had float32 irradiance
+HEADER_FORMAT = '<8sQqqq24x' # magic, count, step (0 if irregular), first interval, source mtime (ns)
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+EPOCH = datetime(1970, 1, 1)
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def series_file_name(csv_file):
+    return os.path.splitext(csv_file)[0] + PV_SERIES_EXTENSION
+
+
+def convert_pv_csv(csv_file, series_file=None):
+    if series_file is None:
+        series_file = series_file_name(csv_file)
+
+    with open(csv_file, 'r', encoding='UTF-8') as f:
+        next(f, None) # Skip Header
+        rows = [line.strip().split(',') for line in f if line.strip()]
+
+    count = len(rows)
+    timestamps = np.array([row[0] for row in rows], dtype='datetime64[s]').astype(np.int64)
+    intervals = np.array([row[1] for row in rows], dtype=np.int64).astype(np.int32)
+    irradiance = np.array([row[2] for row in rows], dtype=np.float64)
+
+    step = 0
+    if count > 1:
+        diffs = np.diff(intervals)
+        if np.all(diffs == diffs[0]) and diffs[0] > 0:
+            step = int(diffs[0])
+    first_interval = int(intervals[0]) if count else 0
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, count, step, first_interval, os.stat(csv_file).st_mtime_ns)
+
+    # Written to a temporary file first, so readers never map a partial series
+    tmp_file = f'{series_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(header)
+        f.write(timestamps.astype('<i8').tobytes())
+        f.write(irradiance.astype('<f8').tobytes())
+        f.write(intervals.astype('<i4').tobytes())
+    os.replace(tmp_file, series_file)
+
+    return series_file
+
+
+class PVSeries:
+    # Memory-mapped series. The pages are shared by every process that maps
+    # the same file, and pickling only sends the file name.
+
+    def __init__(self, series_file):
+        self.series_file = series_file
+
+        with open(series_file, 'rb') as f:
+            magic, count, step, first_interval, source_mtime = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+        if magic != MAGIC:
+            raise Exception(f'{series_file} is not a PV series file')
+
+        self.count = count
+        self.step = step
+        self.first_interval = first_interval
+        self.source_mtime = source_mtime
+
+        if count == 0:
+            self.timestamps = np.empty(0, dtype='<i8')
+            self.intervals = np.empty(0, dtype='<i4')
+            self.irradiance = np.empty(0, dtype='<f8')
+            return
+
+        data = np.memmap(series_file, dtype=np.uint8, mode='r', offset=HEADER_SIZE)
+        self.timestamps = data[:8 * count].view('<i8')
+        self.irradiance = data[8 * count:16 * count].view('<f8')
+        self.intervals = data[16 * count:20 * count].view('<i4')
+
+    def __reduce__(self):
+        return (PVSeries, (self.series_file,))
+
+    def __len__(self):
+        return self.count
+
+    def index_of(self, interval_time):
+        # First row with interval_in_seconds >= interval_time
+        if self.step > 0:
+            i = -(-(interval_time - self.first_interval) // self.step) # ceil
+            return int(min(max(i, 0), self.count))
+        return int(np.searchsorted(self.intervals, interval_time, side='left'))
+
+    def date_time(self, i):
+        return EPOCH + timedelta(seconds=int(self.timestamps[i]))
+
+    def date_time_str(self, i):
+        return self.date_time(i).strftime(DATE_FORMAT)
+
+
+def is_current_series_file(series_file):
+    # False for the files of older versions of the layout
+    with open(series_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_pv_series(pv_file):
+    # Accepts a series file or a CSV file. The series of a CSV file is created
+    # next to it on the first use and again when the CSV is modified.
+    if pv_file.endswith(PV_SERIES_EXTENSION):
+        return PVSeries(pv_file)
+
+    series_file = series_file_name(pv_file)
+    if os.path.exists(series_file) and is_current_series_file(series_file):
+        series = PVSeries(series_file)
+        if series.source_mtime == os.stat(pv_file).st_mtime_ns:
+            return series
+
+    return PVSeries(convert_pv_csv(pv_file, series_file))
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_pv_series():
+    import pickle, tempfile
+
+    rows = [
+        ('2016-04-12 00:00:01', 300, 0),
+        ('2016-04-12 00:05:01', 600, 21),
+        ('2016-04-12 00:10:02', 900, 25.3),
+        ('2016-04-12 00:15:01', 1200, 0.1)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, 'pv.csv')
+        with open(csv_file, 'w') as f:
+            f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+            for row in rows:
+                f.write(','.join(map(str, row)) + '\n')
+
+        series = open_pv_series(csv_file)
+        assert series.step == 300, 'Series should be regular'
+        assert len(series) == len(rows), f'Series should have {len(rows)} rows'
+
+        for i, (date_time, interval, irradiance) in enumerate(rows):
+            assert series.date_time_str(i) == date_time, f'Row {i} timestamp should be {date_time}'
+            assert series.intervals[i] == interval, f'Row {i} interval should be {interval}'
+            assert series.irradiance[i] == irradiance, f'Row {i} irradiance should be {irradiance}'
+
+        for interval_time, expected in [(0, 0), (300, 0), (301, 1), (1200, 3), (5000, 4)]:
+            assert series.index_of(interval_time) == expected, f'Index of {interval_time} should be {expected}'
+
+        copy = pickle.loads(pickle.dumps(series))
+        assert np.array_equal(copy.irradiance, series.irradiance), 'Unpickled series should map the same file'
+
+        assert open_pv_series(series.series_file).count == len(rows), 'Series file should open directly'
+
+        # A series of an older layout is converted again
+        with open(series.series_file, 'r+b') as f:
+            f.write(b'PVSERIE1')
+        assert open_pv_series(csv_file).irradiance[2] == 25.3, 'Older series should be converted again'
+
+
+if __name__ == '__main__':
+    __test_pv_series()
+
+    for csv_file in ['../data/photovolta_2016_part_1.csv', '../data/photovolta_2016_part_2.csv']:
+        print(f'Writing {convert_pv_csv(csv_file)}')
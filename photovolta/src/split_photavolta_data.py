@@ -1,69 +1,260 @@
 import csv
-import statistics
+import math
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+from pv_pyramid import open_pv_pyramid
+from pv_series import open_pv_series
+
+INTERVAL_SIZE = 300 # 300s = 5min
+DAY = 86400 # 1 Day = 86400s
+
+WINDOW_SIZES = {
+    'daily': DAY,
+    'weekly': 7 * DAY,
+    'monthly': 30 * DAY
+}
+
+REPORT_FIELDS = ['window', 'index', 'file', 'first_timestamp', 'last_timestamp', 'elements', 'mean', 'std']
+
 def to_date_time(date_time_str):
     date_format = '%Y-%m-%d %H:%M:%S'
     return datetime.strptime(date_time_str, date_format)
-    
-def split_photovolta(source_file, new_files_prefix, report_file_name):
-    with open(source_file, 'r', encoding='UTF-8') as photovolta_file:
-        
-        WINDOW_SIZE = 604800 # 7 days = 7 * 86400s; 1 Day = 86400s
-        
-        
-        writer = None
-        i = 0
-        interval_values = []
-        
-        files_count = 0
-        
-        report_file = open(report_file_name, 'w')                 
-        
-        for line_number, line in enumerate(photovolta_file):
-            if(line_number == 0): 
-                continue # skip header
-               
-            row = line.strip().split(',')
-            date_time = to_date_time(row[0])
-            interval_in_seconds = int(row[1])
-            solar_irradiance = float(row[2])
-            
-            # Create a new file for each new subset
-            if i == 0:         
-                file_name = f'{new_files_prefix}_{files_count}.csv'
-                msg = f'[{files_count}] Writing file {file_name}'
-                print(msg)
-                report_file.writelines(msg)
-                f = open(file_name, 'w')                
-                writer = csv.writer(f)       
-                writer.writerow(['timestamp', 'interval_in_seconds', 'solar_irradiance_in_W_m2'])
-                
-            writer.writerow([date_time, interval_in_seconds, solar_irradiance])
-            interval_values.append(solar_irradiance)
-            i += 300
-                
-            if i >= WINDOW_SIZE:
-            
-                std = statistics.stdev(interval_values)
-                mean = statistics.mean(interval_values)
-                
-                report_file.write(f'\n\tElements: {len(interval_values)}\n')
-                report_file.write('\tStandard Deviation: %.2f\n' % std)
-                report_file.write('\tMean: %.2f\n\n' % mean)
-              
-                f.close()
-                writer = None
-                i = 0
-                interval_values = []
-                files_count += 1
-        report_file.close()
-    
+
+
+class RunningStats:
+    # Welford accumulator of the mean and the sum of squared differences (m2).
+    # Batches of values and other accumulators are merged with the pairwise
+    # update of Chan et al., so a window split between workers has the same
+    # statistics as a window read in one pass.
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def add_values(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) > 0:
+            mean = values.mean()
+            self.merge(RunningStats(len(values), mean, ((values - mean)**2).sum()))
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+    def std(self):
+        # Sample standard deviation, as statistics.stdev
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+
+def window_rows(window_size):
+    # A window has the rows until the sum of their intervals reaches its size
+    return -(-window_size // INTERVAL_SIZE)
+
+
+def _calc_window_stats(irradiance, first_row, rows):
+    # Partial statistics of the windows (of rows rows) that have rows in
+    # irradiance, which starts at first_row of the series. Each chunk takes two
+    # vectorized passes (means, then squared deviations), not the Welford
+    # update of each value; the chunks are merged with RunningStats.
+    window = (first_row + np.arange(len(irradiance))) // rows
+    starts = np.flatnonzero(np.diff(window, prepend=-1))
+    counts = np.diff(np.append(starts, len(irradiance)))
+
+    means = np.add.reduceat(irradiance, starts) / counts
+    m2 = np.add.reduceat((irradiance - np.repeat(means, counts))**2, starts)
+
+    return [
+        (int(window[s]), first_row + int(s), first_row + int(s + c) - 1, RunningStats(int(c), float(mean), float(d)))
+        for s, c, mean, d in zip(starts, counts, means, m2)
+    ]
+
+
+def _split_rows(pv_series, start, end, windows_rows, split_rows, new_files_prefix):
+    # Rows [start, end) of the series. start is aligned to the split window,
+    # so each file is written by a single worker.
+    irradiance = np.asarray(pv_series.irradiance[start:end])
+
+    stats = {name: _calc_window_stats(irradiance, start, rows) for name, rows in windows_rows.items()}
+
+    files = []
+    if split_rows is not None:
+        date_times = np.char.replace(np.datetime_as_string(pv_series.timestamps[start:end].astype('datetime64[s]'), unit='s'), 'T', ' ')
+        lines = list(map(','.join, zip(date_times.tolist(), pv_series.intervals[start:end].astype(str).tolist(), irradiance.astype(str).tolist())))
+
+        for a in range(0, end - start, split_rows):
+            file_name = f'{new_files_prefix}_{(start + a) // split_rows}.csv'
+            with open(file_name, 'w', newline='') as f:
+                f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\r\n')
+                f.write('\r\n'.join(lines[a:a + split_rows]))
+                f.write('\r\n')
+            files.append(file_name)
+
+    return stats, files
+
+
+def split_photovolta(source_file, new_files_prefix, report_file_name, windows=None, split_window='weekly', workers=None, use_pyramid=True):
+    # Splits the series in one file per split_window and reports the
+    # statistics of every window of windows (name -> size in seconds; weekly
+    # by default) in a CSV file. The rows of the memory-mapped series are
+    # processed in chunks aligned to the split window by parallel workers.
+    # With use_pyramid, the statistics are read from the PV pyramid of the
+    # series instead of being computed by the workers.
+    pv_series = open_pv_series(source_file)
+
+    if windows is None:
+        windows = {'weekly': WINDOW_SIZES['weekly']}
+    windows_rows = {name: window_rows(size) for name, size in windows.items()}
+    workers_windows_rows = {} if use_pyramid else windows_rows
+
+    split_rows = windows_rows[split_window] if split_window is not None else None
+    chunk_alignment = split_rows if split_rows is not None else min(windows_rows.values())
+
+    count_rows = len(pv_series)
+    windows_count = -(-count_rows // chunk_alignment)
+    chunk_windows = max(1, windows_count // (4 * (workers or 1)))
+    chunk_size = chunk_windows * chunk_alignment
+    chunk_starts = list(range(0, count_rows, chunk_size))
+    chunk_ends = [min(start + chunk_size, count_rows) for start in chunk_starts]
+
+    args = [
+        [pv_series] * len(chunk_starts),
+        chunk_starts,
+        chunk_ends,
+        [workers_windows_rows] * len(chunk_starts),
+        [split_rows] * len(chunk_starts),
+        [new_files_prefix] * len(chunk_starts)
+    ]
+    if workers == 1 or len(chunk_starts) <= 1:
+        results = list(map(_split_rows, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_split_rows, *args))
+
+    merged = {name: {} for name in windows}
+    if use_pyramid:
+        pyramid = open_pv_pyramid(source_file)
+        for name, rows in windows_rows.items():
+            count, mean, m2, _ = pyramid.stats(rows)
+            for index, (c, m, d) in enumerate(zip(count.tolist(), mean.tolist(), m2.tolist())):
+                merged[name][index] = [RunningStats(int(c), m, d), index * rows, min((index + 1) * rows, count_rows) - 1]
+
+    # Windows that cross chunks are merged
+    files = []
+    for stats, chunk_files in results:
+        files.extend(chunk_files)
+        for name, window_stats in stats.items():
+            for index, first_row, last_row, s in window_stats:
+                if index in merged[name]:
+                    known = merged[name][index]
+                    known[0].merge(s)
+                    known[2] = last_row
+                else:
+                    merged[name][index] = [s, first_row, last_row]
+
+    for files_count, file_name in enumerate(files):
+        print(f'[{files_count}] Writing file {file_name}')
+
+    with open(report_file_name, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for name in windows:
+            for index, (s, first_row, last_row) in sorted(merged[name].items()):
+                writer.writerow({
+                    'window': name,
+                    'index': index,
+                    'file': files[index] if name == split_window else '',
+                    'first_timestamp': pv_series.date_time_str(first_row),
+                    'last_timestamp': pv_series.date_time_str(last_row),
+                    'elements': s.count,
+                    'mean': s.mean,
+                    'std': s.std()
+                })
+
+    return merged
+
+
+# * * * * * * * * * * * * * * * * *  \/  * * * * * * * * * * * * * * * * * #
+#                                                                          #
+#                                  T E S T                                 #
+#                                                                          #
+# * * * * * * * * * * * * * * * * *  /\  * * * * * * * * * * * * * * * * * #
+
+def __test_running_stats():
+    import random, statistics
+
+    values = [random.uniform(0, 1000) for _ in range(1000)]
+
+    a = RunningStats()
+    for value in values[:300]:
+        a.add(value)
+    b = RunningStats()
+    b.add_values(values[300:])
+    a.merge(b)
+
+    assert a.count == len(values), 'Merged count should have every value'
+    assert abs(a.mean - statistics.mean(values)) < 1e-9, 'Merged mean should be the mean of every value'
+    assert abs(a.std() - statistics.stdev(values)) < 1e-9, 'Merged std should be the std of every value'
+
+
+def __test_split_photovolta():
+    import os, statistics, tempfile
+
+    rows = 3 * window_rows(WINDOW_SIZES['daily']) + 100
+    irradiance = [round(i % 97 * 0.1, 1) for i in range(rows)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, 'pv.csv')
+        with open(csv_file, 'w') as f:
+            f.write('timestamp,interval_in_seconds,solar_irradiance_in_W_m2\n')
+            for i, value in enumerate(irradiance):
+                date_time = datetime(2016, 4, 12, 0, 0, 1).timestamp() + i * INTERVAL_SIZE
+                f.write(f'{datetime.fromtimestamp(date_time)},{(i + 1) * INTERVAL_SIZE},{value}\n')
+
+        windows = {'daily': WINDOW_SIZES['daily'], 'two_days': 2 * DAY}
+        prefix = os.path.join(tmp_dir, 'split')
+
+        for workers, use_pyramid in [(1, False), (2, False), (1, True), (2, True)]:
+            merged = split_photovolta(csv_file, prefix, os.path.join(tmp_dir, 'report.csv'), windows, 'daily', workers, use_pyramid)
+
+            for name, size in windows.items():
+                n = window_rows(size)
+                assert len(merged[name]) == -(-rows // n), f'Every {name} window should be reported'
+                for index, (s, first_row, last_row) in merged[name].items():
+                    values = irradiance[index * n:(index + 1) * n]
+                    assert s.count == len(values) and first_row == index * n, f'Window {name} {index} should have its rows'
+                    assert abs(s.mean - statistics.mean(values)) < 1e-9, f'Window {name} {index} has a wrong mean'
+                    assert abs(s.std() - statistics.stdev(values)) < 1e-9, f'Window {name} {index} has a wrong std'
+
+            with open(f'{prefix}_3.csv') as f:
+                lines = f.read().splitlines()
+            assert len(lines) == 101, 'Last file should have the remaining rows'
+            assert [line.split(',')[2] for line in lines[1:]] == [str(value) for value in irradiance[-100:]], 'Split files should have the values of the source'
+
+            with open(os.path.join(tmp_dir, 'report.csv')) as f:
+                report = list(csv.DictReader(f))
+            assert len(report) == 4 + 2, 'Report should have a row for every window'
+            assert report[0]['file'] == f'{prefix}_0.csv', 'Report should have the file of the split windows'
+
+
 if __name__ == '__main__':
-    split_photovolta('../data/photovolta_2016_part_1.csv', '../data/splitted/photovolta_2016_part_1', '../data/splitted/report_part_1.txt')
-    split_photovolta('../data/photovolta_2016_part_2.csv', '../data/splitted/photovolta_2016_part_2', '../data/splitted/report_part_2.txt')
-                          
-        
-        
-        
+    __test_running_stats()
+    __test_split_photovolta()
+
+    split_photovolta('../data/photovolta_2016_part_1.csv', '../data/splitted/photovolta_2016_part_1', '../data/splitted/report_part_1.csv')
+    split_photovolta('../data/photovolta_2016_part_2.csv', '../data/splitted/photovolta_2016_part_2', '../data/splitted/report_part_2.csv')